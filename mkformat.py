@@ -4,10 +4,11 @@ import sys
 import pymake.parser
 
 filename = sys.argv[1]
-source = None
 
 with open(filename, 'rU') as fh:
-    source = fh.read()
-
-statements = pymake.parser.parsestring(source, filename)
-print(statements.to_source())
+    # The same output as print(statements.to_source()) of a whole StatementList
+    separator = ''
+    for statement in pymake.parser.iterparse(fh, filename):
+        sys.stdout.write(separator + statement.to_source())
+        separator = '\n'
+    sys.stdout.write('\n')
@@ -6,7 +6,10 @@ import pymake.parser
 for f in sys.argv[1:]:
     print("Parsing %s" % f)
     fd = open(f, 'rU')
-    s = fd.read()
-    fd.close()
-    stmts = pymake.parser.parsestring(s, f)
-    print(stmts)
+    try:
+        for stmt in pymake.parser.iterparse(fd, f):
+            stmt.dump(sys.stdout, '')
+        # As print(stmts) of a whole StatementList did
+        sys.stdout.write('\n')
+    finally:
+        fd.close()
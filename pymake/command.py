@@ -11,7 +11,7 @@ except when a submake specifies -j1 when the parent make is building in parallel
 
 import os, subprocess, sys, logging, time, traceback, re
 from optparse import OptionParser
-import data, parserdata, process, util
+import data, parser, parserdata, parsecache, shellcache, functions, evaltemplates, process, util
 from pymake import errors
 
 # TODO: If this ever goes from relocatable package to system-installed, this may need to be
@@ -158,6 +158,18 @@ class _MakeContext(object):
                 print("make.py[%i]: Leaving directory '%s'" % (self.makelevel, self.workdir))
             sys.stdout.flush()
 
+            scache = functions.getshellcache()
+            if scache is not None:
+                _log.info("make.py[%i]: $(shell) cache: %i hits, %i misses",
+                          self.makelevel, scache.hits, scache.misses)
+
+            caches = [('$(eval) cache', parser.evalcache),
+                      ('$(eval) templates', evaltemplates.gettemplates())]
+            for name, cache in caches:
+                if cache is not None and cache.hits + cache.misses:
+                    _log.info("make.py[%i]: %s: %i hits, %i misses, %i evictions",
+                              self.makelevel, name, cache.hits, cache.misses, cache.evictions)
+
             self.context.defer(self.cb, 0)
         else:
             self.makefile.gettarget(self.realtargets.pop(0)).make(self.makefile, self.tstack, self.makecb)
@@ -200,6 +212,31 @@ def main(args, env, cwd, cb):
         op.add_option('-n', '--just-print', '--dry-run', '--recon',
                       action="store_true",
                       dest="justprint", default=False)
+        op.add_option('--parse-cache',
+                      dest="parsecache", default=None)
+        op.add_option('--parse-cache-size', type="int",
+                      dest="parsecachesize",
+                      default=parsecache.DEFAULT_MAXSIZE // (1024 * 1024))
+        op.add_option('--shell-cache', action="store_true",
+                      dest="shellcache", default=False)
+        op.add_option('--shell-cache-dir',
+                      dest="shellcachedir", default=None)
+        op.add_option('--shell-cache-ttl', type="int",
+                      dest="shellcachettl", default=shellcache.DEFAULT_TTL)
+        op.add_option('--shell-coprocess', action="store_true",
+                      dest="coprocessing", default=False)
+        op.add_option('--lazy-conditions', action="store_true",
+                      dest="lazyconditions", default=False)
+        op.add_option('--intern-expansions', action="store_true",
+                      dest="interning", default=False)
+        op.add_option('--eval-templates', action="store_true",
+                      dest="evaltemplates", default=False)
+        op.add_option('--memoize-expansions', action="store_true",
+                      dest="memoizing", default=False)
+        op.add_option('--fold-constants', action="store_true",
+                      dest="folding", default=False)
+        op.add_option('--freeze-variables', action="store_true",
+                      dest="freezing", default=False)
 
         options, arguments1 = op.parse_args(parsemakeflags(env))
         options, arguments2 = op.parse_args(args, values=options)
@@ -244,6 +281,44 @@ def main(args, env, cwd, cb):
         else:
             workdir = util.normaljoin(cwd, options.directory)
 
+        if options.parsecache:
+            # Submakes run in other directories, so pass down an absolute path
+            cachedir = os.path.abspath(util.normaljoin(cwd, options.parsecache))
+            longflags.append('--parse-cache=%s' % cachedir)
+            longflags.append('--parse-cache-size=%i' % options.parsecachesize)
+
+        if options.shellcachedir:
+            options.shellcache = True
+            shellcachedir = os.path.abspath(util.normaljoin(cwd, options.shellcachedir))
+            longflags.append('--shell-cache-dir=%s' % shellcachedir)
+            longflags.append('--shell-cache-ttl=%i' % options.shellcachettl)
+        else:
+            shellcachedir = None
+
+        if options.shellcache:
+            longflags.append('--shell-cache')
+
+        if options.coprocessing:
+            longflags.append('--shell-coprocess')
+
+        if options.lazyconditions:
+            longflags.append('--lazy-conditions')
+
+        if options.interning:
+            longflags.append('--intern-expansions')
+
+        if options.evaltemplates:
+            longflags.append('--eval-templates')
+
+        if options.memoizing:
+            longflags.append('--memoize-expansions')
+
+        if options.folding:
+            longflags.append('--fold-constants')
+
+        if options.freezing:
+            longflags.append('--freeze-variables')
+
         if options.jobcount != 1:
             longflags.append('-j%i' % (options.jobcount,))
 
@@ -253,6 +328,41 @@ def main(args, env, cwd, cb):
 
         logging.basicConfig(level=loglevel, **logkwargs)
 
+        # Submakes run in this process share the cache of their parent, if they use the same one
+        if options.parsecache:
+            maxsize = options.parsecachesize * 1024 * 1024
+            diskcache = parser.getdiskcache()
+            if diskcache is None or diskcache.cachedir != cachedir or diskcache.maxsize != maxsize:
+                try:
+                    diskcache = parsecache.ParseCache(cachedir, maxsize)
+                except OSError as e:
+                    _log.warning("Not using parse cache '%s': %s", cachedir, e)
+                    diskcache = None
+                parser.setdiskcache(diskcache)
+        else:
+            parser.setdiskcache(None)
+
+        if options.shellcache:
+            # Submakes run in this process share the cache of their parent
+            scache = functions.getshellcache()
+            if scache is None or scache.cachedir != shellcachedir or scache.ttl != options.shellcachettl:
+                try:
+                    scache = shellcache.ShellCache(shellcachedir, options.shellcachettl)
+                except OSError as e:
+                    _log.warning("Not using shell cache directory '%s': %s", shellcachedir, e)
+                    scache = shellcache.ShellCache()
+                functions.setshellcache(scache)
+        else:
+            functions.setshellcache(None)
+
+        parser.setlazyconditions(options.lazyconditions)
+        parser.setinterning(options.interning)
+        parser.setfolding(options.folding)
+        evaltemplates.setenabled(options.evaltemplates)
+        data.setmemoizing(options.memoizing)
+        data.setfreezing(options.freezing)
+        process.setcoprocessing(options.coprocessing)
+
         context = process.getcontext(options.jobcount)
 
         if options.printdir:
@@ -2,17 +2,12 @@
 A representation of makefile data structures.
 """
 
-import logging, re, os, sys
+import logging, re, os, sys, weakref
 from functools import reduce
 import parserdata, parser, functions, process, util, implicit
 import globrelative
 from pymake import errors
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from io import StringIO
-
 
 if sys.version_info[0] < 3:
     str_type = basestring
@@ -66,6 +61,30 @@ def _if_else(c, t, f):
     return f()
 
 
+# Shared expansion and function nodes, see internnode
+_internednodes = weakref.WeakValueDictionary()
+
+def internnode(node):
+    """
+    Return a node structurally equal to the expansion or function `node`, shared with every other
+    caller which interned an equal node, or `node` itself if there is none. Nodes which are
+    interned must be finished and never modified afterwards, and their children must already have
+    been interned. Nodes are only shared while something refers to them.
+    """
+    key = node.internkey()
+    shared = _internednodes.get(key)
+    if shared is None:
+        _internednodes[key] = node
+        return node
+
+    return shared
+
+def _constant(s):
+    """A compiled expansion (see Expansion.compile) which always resolves to `s`."""
+    def resolvestr(makefile, variables, setting):
+        return s
+    return resolvestr
+
 class BaseExpansion(object):
     """Base class for expansions.
 
@@ -166,6 +185,12 @@ class StringExpansion(BaseExpansion):
     def resolvesplit(self, i, j, k=None):
         return self.s.split()
 
+    def compile(self):
+        return _constant(self.s)
+
+    def internkey(self):
+        return StringExpansion, self.s
+
     def clone(self):
         e = Expansion(self.loc)
         e.appendstr(self.s)
@@ -185,6 +210,9 @@ class StringExpansion(BaseExpansion):
     def __repr__(self):
         return "Exp<%s>(%r)" % (self.loc, self.s)
 
+    def __reduce__(self):
+        return StringExpansion, (self.s, self.loc)
+
     def __eq__(self, other):
         """We only compare the string contents."""
         return self.s == other
@@ -212,13 +240,18 @@ class Expansion(BaseExpansion, list):
     the same context in a make file.
     """
 
-    __slots__ = ('loc',)
+    __slots__ = ('loc', '_compiled')
     simple = False
 
     def __init__(self, loc=None):
         # A list of (element, isfunc) tuples
         # element is either a string or a function
         self.loc = loc
+        self._compiled = None
+
+    def __reduce__(self):
+        # The compiled form is not picklable, and is cheap to recreate.
+        return Expansion, (self.loc,), None, iter(self)
 
     @staticmethod
     def fromstring(s, path):
@@ -235,10 +268,12 @@ class Expansion(BaseExpansion, list):
             return
 
         self.append((s, False))
+        self._compiled = None
 
     def appendfunc(self, func):
         assert isinstance(func, functions.Function)
         self.append((func, True))
+        self._compiled = None
 
     def concat(self, o):
         """Concatenate the other expansion on to this one."""
@@ -246,12 +281,17 @@ class Expansion(BaseExpansion, list):
             self.appendstr(o.s)
         else:
             self.extend(o)
+            self._compiled = None
 
     def isempty(self):
         return (not len(self)) or self[0] == ('', False)
 
+    def internkey(self):
+        return (Expansion,) + tuple([id(e) if isfunc else e for e, isfunc in self])
+
     def lstrip(self):
         """Strip leading literal whitespace from this expansion."""
+        self._compiled = None
         while True:
             i, isfunc = self[0]
             if isfunc:
@@ -266,6 +306,7 @@ class Expansion(BaseExpansion, list):
 
     def rstrip(self):
         """Strip trailing literal whitespace from this expansion."""
+        self._compiled = None
         while True:
             i, isfunc = self[-1]
             if isfunc:
@@ -304,9 +345,61 @@ class Expansion(BaseExpansion, list):
 
         if len(elements) < len(self):
             self[:] = elements
+            self._compiled = None
 
         return self
 
+    def compile(self):
+        """
+        Compile this expansion into a function(makefile, variables, setting) which returns
+        the resolved string. Adjacent literal strings are joined, and each function is
+        compiled in turn (see functions.Function.compile).
+
+        The compiled function is cached by resolvestr until this expansion is modified.
+        """
+        parts = []
+        for e, isfunc in self:
+            if isfunc:
+                parts.append(e.compile())
+            elif len(parts) and isinstance(parts[-1], str_type):
+                parts[-1] += e
+            else:
+                parts.append(e)
+
+        if not len(parts):
+            return _constant('')
+
+        if len(parts) == 1:
+            if isinstance(parts[0], str_type):
+                return _constant(parts[0])
+            return parts[0]
+
+        if len(parts) == 2:
+            a, b = parts
+            if isinstance(a, str_type):
+                def resolvestr(makefile, variables, setting):
+                    return a + b(makefile, variables, setting)
+            elif isinstance(b, str_type):
+                def resolvestr(makefile, variables, setting):
+                    return a(makefile, variables, setting) + b
+            else:
+                def resolvestr(makefile, variables, setting):
+                    return a(makefile, variables, setting) + b(makefile, variables, setting)
+            return resolvestr
+
+        # The literal strings stay in place in a template list; the result of each
+        # function is slotted in at its index.
+        template = [None if callable(p) else p for p in parts]
+        funcs = [(i, p) for i, p in enumerate(parts) if callable(p)]
+
+        def resolvestr(makefile, variables, setting):
+            l = template[:]
+            for i, f in funcs:
+                l[i] = f(makefile, variables, setting)
+            return ''.join(l)
+
+        return resolvestr
+
     def resolve(self, makefile, variables, fd, setting=[]):
         """
         Resolve this variable into a value, by interpolating the value
@@ -316,23 +409,21 @@ class Expansion(BaseExpansion, list):
                being set, if any. Setting variables must avoid self-referential
                loops.
         """
-        assert isinstance(makefile, Makefile)
-        assert isinstance(variables, Variables)
-        assert isinstance(setting, list)
-
-        for e, isfunc in self:
-            if isfunc:
-                e.resolve(makefile, variables, fd, setting)
-            else:
-                assert isinstance(e, str_type)
-                fd.write(e)
+        fd.write(self.resolvestr(makefile, variables, setting))
 
     def resolvestr(self, makefile, variables, setting=[]):
-        fd = StringIO()
-        self.resolve(makefile, variables, fd, setting)
-        return fd.getvalue()
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compiled = self.compile()
+        return compiled(makefile, variables, setting)
 
     def resolvesplit(self, makefile, variables, setting=[]):
+        # The words of a single function call can be passed on without joining and splitting them.
+        if len(self) == 1:
+            e, isfunc = self[0]
+            if isfunc:
+                return e.resolvesplit(makefile, variables, setting)
+
         return self.resolvestr(makefile, variables, setting).split()
 
     @property
@@ -347,11 +438,14 @@ class Expansion(BaseExpansion, list):
 
     def functions(self, descend=False):
         for e, is_func in self:
-            if is_func:
-                yield e
+            if not is_func:
+                continue
+
+            yield e
 
             if descend:
-                for exp in e.expansions(descend=True):
+                # functions(descend=True) reaches the deeper expansions itself
+                for exp in e.expansions():
                     for f in exp.functions(descend=True):
                         yield f
 
@@ -420,13 +514,235 @@ class Expansion(BaseExpansion, list):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+# Whether the expansions of variables are memoized, see setmemoizing
+_memoizing = False
+
+# The names read by each variable expansion being memoized, innermost last
+_memoreads = []
+
+def setmemoizing(enabled):
+    """
+    Memoize the expansions of variables referenced by $(VAR). The expansion of a variable is
+    remembered, by the outermost scope it was read from, with every variable the expansion read
+    (see Variables.resolvestr). It is reused until any of those is set or appended to in the
+    scopes it is read from. Expansions which use the filesystem or a shell, or which have side
+    effects, are not memoized.
+    """
+    global _memoizing
+    _memoizing = enabled
+
+def _isvolatile(exp):
+    """
+    Whether the result of `exp` may differ between expansions with the same variables, or
+    expanding it does anything but return a result.
+    """
+    if exp.is_filesystem_dependent or exp.is_shell_dependent:
+        return True
+
+    for f in exp.functions(descend=True):
+        if isinstance(f, (functions.EvalFunction, functions.InfoFunction, functions.WarningFunction)):
+            return True
+
+    return False
+
+# Whether variables are frozen once parsing is finished, see setfreezing
+_freezing = False
+
+def setfreezing(enabled):
+    """
+    Freeze the variables of makefiles when parsing is finished (see Variables.freeze), except
+    those which read automatic variables or variables set for targets or patterns.
+    """
+    global _freezing
+    _freezing = enabled
+
+def _references(exp):
+    """
+    The names of the variables `exp` reads by name, or None if it reads any variable whose name
+    is computed.
+    """
+    names = set()
+    for f in exp.functions(descend=True):
+        if isinstance(f, (functions.VariableRef, functions.SubstitutionRef)):
+            vname = f.vname
+        elif isinstance(f, (functions.CallFunction, functions.ValueFunction,
+                            functions.OriginFunction, functions.FlavorFunction)):
+            vname = f._arguments[0]
+        else:
+            continue
+
+        if not vname.is_static_string:
+            return None
+        names.add(vname.resolvestr(None, None))
+
+    return names
+
+class _FrozenVariables(object):
+    """
+    What is known about the frozen variables of an outermost scope, see Variables.freeze.
+    """
+
+    __slots__ = ('exclude', 'reads', 'values')
+
+    def __init__(self, exclude):
+        self.exclude = exclude
+        self.thaw()
+
+    def thaw(self):
+        self.reads = dict.fromkeys(self.exclude, False) # vname -> names read, or False
+        self.values = {} # vname -> value
+
+def _binds(maps, names):
+    """
+    Whether any of the variable maps `maps` has any of `names`.
+    """
+    for m in maps:
+        if len(names) < len(m):
+            for n in names:
+                if n in m:
+                    return True
+        elif not names.isdisjoint(m):
+            return True
+
+    return False
+
+def _memoentries(maps, name):
+    return [m[name] for m in maps if name in m]
+
+def _memovalid(maps, reads, setting):
+    """
+    Whether the variables in `reads`, a list of (name, entries), still have the same entries in
+    `maps` and are not being set.
+    """
+    for name, entries in reads:
+        if name in setting:
+            return False
+
+        i = 0
+        for m in maps:
+            e = m.get(name)
+            if e is not None:
+                if i == len(entries) or entries[i] is not e:
+                    return False
+                i += 1
+
+        if i != len(entries):
+            return False
+
+    return True
+
+def _parsevalue(s, valueexp, name):
+    """
+    The parsed form of the value `s` of a variable: `valueexp` if it is an expansion, the result
+    of calling it if it is a function, or `s` parsed if it is None.
+    """
+    if isinstance(valueexp, BaseExpansion):
+        return valueexp
+
+    if valueexp is None:
+        d = parser.Data.fromstring(s, "Expansion of variables '%s'" % (name,))
+        valueexp, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
+        return valueexp
+
+    return valueexp()
+
+class _AppendedValue(object):
+    """
+    The value of a variable which has been appended to with +=, kept as the list of values it
+    was set and appended to, so that appending doesn't copy the value. The values are joined,
+    or their expansions concatenated, when the variable is next read; the result is reused
+    until it is appended to again.
+
+    Each value is kept with its parsed form, if any, as given to Variables.set. Only the values
+    of recursive variables are ever parsed.
+    """
+
+    __slots__ = ('_values', '_joined', '_exp', '_appendedstr', '_appendedexp')
+
+    def __init__(self, value, valueexp):
+        self._values = [(value, valueexp)]
+        self._changed()
+
+    def _changed(self):
+        self._joined = None
+        self._exp = None
+        self._appendedstr = None
+        self._appendedexp = None
+
+    def add(self, value, valueexp=None):
+        self._values.append((value, valueexp))
+        self._changed()
+
+    def joined(self):
+        if self._joined is None:
+            self._joined = ' '.join([value for value, valueexp in self._values])
+        return self._joined
+
+    def expansion(self, name):
+        if self._exp is None:
+            values = self._values
+            if all([isinstance(valueexp, BaseExpansion) for value, valueexp in values]):
+                e = Expansion()
+                for i in range(0, len(values)):
+                    if i:
+                        e.appendstr(' ')
+                    e.concat(values[i][1])
+            else:
+                # An appended value may not parse on its own, as in "A = $(B" "A += C)", so
+                # parse the whole value, which will then only need appending to.
+                e = _parsevalue(self.joined(), None, name)
+                self._values = [(self._joined, e)]
+            self._exp = e
+        return self._exp
+
+    def appendto(self, pvalue, expand, name):
+        """
+        This value appended to `pvalue`, the value of the variable in the parent scope, which is
+        an expansion if `expand`, or else a string. The result is reused for as long as the
+        parent returns the same value.
+        """
+        if not expand:
+            if self._appendedstr is None or self._appendedstr[0] is not pvalue:
+                self._appendedstr = pvalue, pvalue + ' ' + self.joined()
+            return self._appendedstr[1]
+
+        # Simple variables are returned in a new expansion each time.
+        key = pvalue.s if pvalue.simple else pvalue
+        if self._appendedexp is None or self._appendedexp[0] is not key:
+            e = pvalue.clone()
+            e.appendstr(' ')
+            e.concat(self.expansion(name))
+            self._appendedexp = key, e
+        return self._appendedexp[1]
+
+class RecursionGuard(object):
+    """
+    The names of the variables being expanded, which may not be referenced again: `name` and the
+    names in `outer`, which is another guard or a list. Unlike `outer + [name]`, a guard does not
+    copy the names of the expansions it is nested in.
+    """
+
+    __slots__ = ('name', 'outer')
+
+    def __init__(self, name, outer):
+        self.name = name
+        self.outer = outer
+
+    def __contains__(self, name):
+        g = self
+        while isinstance(g, RecursionGuard):
+            if g.name == name:
+                return True
+            g = g.outer
+        return name in g
+
 class Variables(object):
     """
     A mapping from variable names to variables. Variables have flavor, source, and value. The value is an 
     expansion object.
     """
 
-    __slots__ = ('parent', '_map')
+    __slots__ = ('parent', '_map', '_memo', '_frozen')
 
     FLAVOR_RECURSIVE = 0
     FLAVOR_SIMPLE = 1
@@ -440,8 +756,10 @@ class Variables(object):
     SOURCE_IMPLICIT = 5
 
     def __init__(self, parent=None):
-        self._map = {} # vname -> flavor, source, valuestr, valueexp
+        self._map = {} # vname -> flavor, source, valuestr, valueexp (or a function returning it)
         self.parent = parent
+        self._memo = None # vname -> value, volatile, [(name read, its entries)] (see resolvestr)
+        self._frozen = None # a _FrozenVariables (see freeze)
 
     def readfromenvironment(self, env):
         for k, v in env.items():
@@ -456,36 +774,18 @@ class Variables(object):
         @param expand If true, the value will be returned as an expansion. If false,
         it will be returned as an unexpanded string.
         """
+        if len(_memoreads):
+            _memoreads[-1].add(name)
+
         flavor, source, valuestr, valueexp = self._map.get(name, (None, None, None, None))
         if flavor is not None:
-            if expand and flavor != self.FLAVOR_SIMPLE and valueexp is None:
-                d = parser.Data.fromstring(valuestr, parserdata.Location("Expansion of variables '%s'" % (name,), 1, 0))
-                valueexp, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
-                self._map[name] = flavor, source, valuestr, valueexp
-
-            if flavor == self.FLAVOR_APPEND:
-                if self.parent:
-                    pflavor, psource, pvalue = self.parent.get(name, expand)
-                else:
-                    pflavor, psource, pvalue = None, None, None
+            if isinstance(valuestr, _deferredvalues):
+                return self._getdeferred(name, flavor, source, valuestr, expand)
 
-                if pvalue is None:
-                    flavor = self.FLAVOR_RECURSIVE
-                    # fall through
-                else:
-                    if source > psource:
-                        # TODO: log a warning?
-                        return pflavor, psource, pvalue
-
-                    if not expand:
-                        return pflavor, psource, pvalue + ' ' + valuestr
-
-                    pvalue = pvalue.clone()
-                    pvalue.appendstr(' ')
-                    pvalue.concat(valueexp)
+            if expand and flavor != self.FLAVOR_SIMPLE and not isinstance(valueexp, BaseExpansion):
+                valueexp = _parsevalue(valuestr, valueexp, name)
+                self._map[name] = flavor, source, valuestr, valueexp
 
-                    return pflavor, psource, pvalue
-                    
             if not expand:
                 return flavor, source, valuestr
 
@@ -501,10 +801,239 @@ class Variables(object):
 
         return (None, None, None)
 
-    def set(self, name, flavor, source, value, force=False):
+    def _getdeferred(self, name, flavor, source, value, expand):
+        """
+        get() for a variable whose value is an _AppendedValue or _AutomaticValue. A variable which
+        was only appended to in this scope appends to its value in the parent scope, if any.
+        """
+        if flavor == self.FLAVOR_APPEND:
+            if self.parent:
+                pflavor, psource, pvalue = self.parent.get(name, expand)
+            else:
+                pflavor, psource, pvalue = None, None, None
+
+            if pvalue is not None:
+                if source > psource:
+                    # TODO: log a warning?
+                    return pflavor, psource, pvalue
+
+                return pflavor, psource, value.appendto(pvalue, expand, name)
+
+            flavor = self.FLAVOR_RECURSIVE
+
+        if not expand:
+            return flavor, source, value.joined()
+
+        if flavor == self.FLAVOR_RECURSIVE:
+            return flavor, source, value.expansion(name)
+
+        return flavor, source, Expansion.fromstring(value.joined(), "Expansion of variable '%s'" % (name,))
+
+    def resolvestr(self, name, makefile, setting=[]):
+        """
+        Expand the named variable, returning its value as a string, or None if it is not set.
+        Variables which are part of `setting` are being set, and may not be read.
+
+        If memoization is enabled (see setmemoizing), the result is remembered by the outermost
+        scope along with the names of all the variables the expansion read, and their entries
+        in each scope it was read from. Setting or appending to a variable replaces its entry,
+        so the result is reused until one of those entries is replaced.
+        """
+        if _freezing:
+            value = self._frozenvalue(name, makefile)
+            if value is not None:
+                return value
+
+        if not _memoizing:
+            value = self._simplevalue(name)
+            if value is not None:
+                return value
+
+            flavor, source, value = self.get(name)
+            if value is None:
+                return None
+            return value.resolvestr(makefile, self, RecursionGuard(name, setting))
+
+        maps = []
+        v = self
+        while v.parent is not None:
+            maps.append(v._map)
+            v = v.parent
+        maps.append(v._map)
+
+        memo = v._memo
+        if memo is None:
+            memo = v._memo = {}
+
+        volatile = None
+        m = memo.get(name)
+        if m is not None and _memovalid(maps, m[2], setting):
+            value, volatile, reads = m
+            if not volatile:
+                if len(_memoreads):
+                    _memoreads[-1].update([n for n, entries in reads])
+                return value
+
+        reads = set()
+        _memoreads.append(reads)
+        try:
+            flavor, source, exp = self.get(name)
+            if exp is None:
+                value = None
+            else:
+                value = exp.resolvestr(makefile, self, RecursionGuard(name, setting))
+                if volatile is None:
+                    volatile = _isvolatile(exp)
+        finally:
+            _memoreads.pop()
+
+        # A volatile expansion makes the expansions which read it volatile too.
+        volatile = volatile or None in reads
+        if len(_memoreads):
+            _memoreads[-1].update(reads)
+            if volatile:
+                _memoreads[-1].add(None)
+
+        reads.discard(None)
+        memo[name] = value, volatile, [(n, _memoentries(maps, n)) for n in reads]
+        return value
+
+    def resolvesplit(self, name, makefile, setting=[]):
+        """
+        Expand the named variable like resolvestr, returning a list of its words, or None if
+        it is not set.
+        """
+        if _memoizing:
+            value = self.resolvestr(name, makefile, setting)
+            if value is None:
+                return None
+            return value.split()
+
+        if _freezing:
+            value = self._frozenvalue(name, makefile)
+            if value is not None:
+                return value.split()
+
+        value = self._simplevalue(name)
+        if value is not None:
+            return value.split()
+
+        flavor, source, value = self.get(name)
+        if value is None:
+            return None
+        return value.resolvesplit(makefile, self, RecursionGuard(name, setting))
+
+    def _simplevalue(self, name):
+        """
+        The value of the named variable if it is simply expanded, in which case it is the string
+        it was set to, or None.
+        """
+        v = self
+        while v is not None:
+            entry = v._map.get(name)
+            if entry is not None:
+                if entry[0] != self.FLAVOR_SIMPLE:
+                    return None
+                if isinstance(entry[2], _deferredvalues):
+                    return entry[2].joined()
+                return entry[2]
+            v = v.parent
+        return None
+
+    def freeze(self, exclude):
+        """
+        Freeze the variables of this scope, which must be the outermost. A frozen variable is
+        expanded once, when it is first read, and its value is reused wherever none of the
+        variables it reads (including itself) are set in an inner scope, such as by $(foreach).
+
+        Variables which read any of the variables named in `exclude`, read variables whose names
+        are computed, or are volatile (see _isvolatile) are not frozen. Setting or appending to
+        any variable of this scope thaws them all.
+        """
+        assert self.parent is None
+        self._frozen = _FrozenVariables(exclude)
+
+    def _frozenreads(self, name):
+        """
+        The names of the variables read by expanding the named variable of this, the outermost
+        scope, or False if it can't be frozen.
+        """
+        reads = self._frozen.reads.get(name)
+        if reads is not None:
+            return reads
+
+        # A variable which reads itself can't be expanded, let alone frozen.
+        self._frozen.reads[name] = False
+
+        flavor, source, valuestr, valueexp = self._map.get(name, (None, None, None, None))
+        reads = set([name])
+        if flavor is not None and flavor != self.FLAVOR_SIMPLE:
+            try:
+                flavor, source, exp = self.get(name)
+            except errors.SyntaxError:
+                return False
+
+            if _isvolatile(exp):
+                return False
+
+            names = _references(exp)
+            if names is None:
+                return False
+
+            for n in names:
+                r = self._frozenreads(n)
+                if r is False:
+                    return False
+                reads.update(r)
+
+        self._frozen.reads[name] = reads
+        return reads
+
+    def _frozenvalue(self, name, makefile):
+        """
+        The value of the named variable if it is frozen and none of the variables it reads are
+        set in this or any scope before the outermost, or else None.
+        """
+        maps = []
+        v = self
+        while v.parent is not None:
+            maps.append(v._map)
+            v = v.parent
+
+        if v._frozen is None:
+            return None
+
+        # Simple variables are their own values.
+        entry = v._map.get(name)
+        if entry is None or entry[0] == self.FLAVOR_SIMPLE:
+            return None
+
+        reads = v._frozenreads(name)
+        if reads is False:
+            return None
+
+        if _binds(maps, reads):
+            return None
+
+        value = v._frozen.values.get(name)
+        if value is None:
+            flavor, source, exp = v.get(name)
+            value = v._frozen.values[name] = exp.resolvestr(makefile, v, [name])
+
+        if len(_memoreads):
+            _memoreads[-1].update(reads)
+        return value
+
+    def set(self, name, flavor, source, value, force=False, valueexp=None):
+        """
+        Set a variable. The parsed form of a recursive `value` may be given as `valueexp`: either
+        an expansion, or a function returning one which is called when the value is first expanded.
+        The value of a simple variable may be an _AppendedValue or _AutomaticValue.
+        """
         assert flavor in (self.FLAVOR_RECURSIVE, self.FLAVOR_SIMPLE)
         assert source in (self.SOURCE_OVERRIDE, self.SOURCE_COMMANDLINE, self.SOURCE_MAKEFILE, self.SOURCE_ENVIRONMENT, self.SOURCE_AUTOMATIC, self.SOURCE_IMPLICIT)
-        assert isinstance(value, str_type), "expected str, got %s" % type(value)
+        assert isinstance(value, str_type) or (flavor == self.FLAVOR_SIMPLE and isinstance(value, _deferredvalues)), "expected str, got %s" % type(value)
+        assert valueexp is None or flavor == self.FLAVOR_RECURSIVE
 
         prevflavor, prevsource, prevvalue = self.get(name)
         if prevsource is not None and source > prevsource and not force:
@@ -512,31 +1041,41 @@ class Variables(object):
             _log.info("not setting variable '%s', set by higher-priority source to value '%s'" % (name, prevvalue))
             return
 
-        self._map[name] = flavor, source, value, None
+        self._map[name] = flavor, source, value, valueexp
+        if self._frozen is not None:
+            self._frozen.thaw()
 
-    def append(self, name, source, value, variables, makefile):
+    def append(self, name, source, value, variables, makefile, valueexp=None):
+        """
+        Append to a variable. `valueexp` is the parsed form of `value`, as for set().
+        """
         assert source in (self.SOURCE_OVERRIDE, self.SOURCE_MAKEFILE, self.SOURCE_AUTOMATIC)
         assert isinstance(value, str_type)
 
+        if self._frozen is not None:
+            self._frozen.thaw()
+
         if name not in self._map:
-            self._map[name] = self.FLAVOR_APPEND, source, value, None
+            self._map[name] = self.FLAVOR_APPEND, source, _AppendedValue(value, valueexp), None
             return
 
-        prevflavor, prevsource, prevvalue, valueexp = self._map[name]
+        prevflavor, prevsource, prevvalue, prevexp = self._map[name]
         if source > prevsource:
             # TODO: log a warning?
             return
 
         if prevflavor == self.FLAVOR_SIMPLE:
-            d = parser.Data.fromstring(value, parserdata.Location("Expansion of variables '%s'" % (name,), 1, 0))
-            valueexp, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
+            value = _parsevalue(value, valueexp, name).resolvestr(makefile, variables, [name])
+            valueexp = None
 
-            val = valueexp.resolvestr(makefile, variables, [name])
-            self._map[name] = prevflavor, prevsource, prevvalue + ' ' + val, None
-            return
+        if not isinstance(prevvalue, _AppendedValue):
+            if isinstance(prevvalue, _deferredvalues):
+                prevvalue = prevvalue.joined()
+            prevvalue = _AppendedValue(prevvalue, prevexp)
+        prevvalue.add(value, valueexp)
 
-        newvalue = prevvalue + ' ' + value
-        self._map[name] = prevflavor, prevsource, newvalue, None
+        # The value is appended to in place, but the entry is replaced, as by set().
+        self._map[name] = prevflavor, prevsource, prevvalue, None
 
     def merge(self, other):
         assert isinstance(other, Variables)
@@ -545,11 +1084,26 @@ class Variables(object):
 
     def __iter__(self):
         for k, (flavor, source, value, valueexp) in self._map.items():
+            if isinstance(value, _deferredvalues):
+                value = value.joined()
             yield k, flavor, source, value
 
     def __contains__(self, item):
         return item in self._map
 
+class ParameterScope(Variables):
+    """
+    The scope of the parameters of a $(foreach) or $(call). As in GNU make, parameters are simply
+    expanded and their $(origin) is "automatic", but they hide variables of any origin, so they
+    are bound directly rather than through set(). $(foreach) binds the same scope to each word
+    in turn.
+    """
+
+    __slots__ = ()
+
+    def bind(self, name, value):
+        self._map[name] = self.FLAVOR_SIMPLE, self.SOURCE_AUTOMATIC, value, None
+
 class Pattern(object):
     """
     A pattern is a string, possibly with a % substitution character. From the GNU make manual:
@@ -674,6 +1228,94 @@ class Pattern(object):
 
         return self._backre.sub(r'\\\1', self.data[0]) + '%' + self.data[1]
 
+class PatternSet(object):
+    """
+    The whitespace-separated patterns in `s`, compiled to test whether any of them matches a
+    word. Patterns without % are kept in a set. Patterns with % are kept in a set of their
+    (prefix, suffix) pairs, one for each combination of prefix and suffix lengths, so matching
+    a word takes one lookup per combination instead of one test per pattern.
+    """
+
+    __slots__ = ('_exact', '_affixes')
+
+    def __init__(self, s):
+        self._exact = set()
+        affixes = {} # (prefix length, suffix length) -> set of (prefix, suffix)
+        for w in s.split():
+            d = Pattern(w).data
+            if len(d) == 1:
+                self._exact.add(d[0])
+            else:
+                affixes.setdefault((len(d[0]), len(d[1])), set()).add(d)
+
+        self._affixes = [(l1, l2, l1 + l2, a) for (l1, l2), a in affixes.items()]
+
+    def match(self, word):
+        if word in self._exact:
+            return True
+
+        wlen = len(word)
+        for l1, l2, l, a in self._affixes:
+            if wlen >= l and (word[:l1], word[wlen - l2:]) in a:
+                return True
+
+        return False
+
+    def filter(self, words, keep=True):
+        """
+        The words which match any of the patterns, or which don't if `keep` is False.
+        """
+        match = self.match
+        if keep:
+            return [w for w in words if match(w)]
+        return [w for w in words if not match(w)]
+
+class PatternSubst(object):
+    """
+    A substitution of the pattern `pattern` by `replacement`, as Pattern.subst: the replacement
+    is parsed once, when the substitution is created.
+    """
+
+    __slots__ = ('pattern', '_replacement')
+
+    def __init__(self, pattern, replacement):
+        self.pattern = Pattern(pattern)
+        if self.pattern.ispattern():
+            self._replacement = Pattern(replacement).data
+        else:
+            # if the pattern isn't a pattern, the replacement is not parsed as a pattern either
+            self._replacement = (replacement,)
+
+    def subst(self, word):
+        stem = self.pattern.match(word)
+        if stem is None:
+            return word
+
+        r = self._replacement
+        if len(r) == 1:
+            return r[0]
+        return r[0] + stem + r[1]
+
+# Compiled PatternSets and PatternSubsts, bounded by the total length of their patterns
+PATTERNCACHE_SIZE = 256 * 1024
+
+def _patternsize(key, o):
+    if isinstance(key, tuple):
+        return len(key[0]) + len(key[1])
+    return len(key)
+
+patternsets = util.LRUCache(PATTERNCACHE_SIZE, PatternSet, weightfunc=_patternsize)
+patternsubsts = util.LRUCache(PATTERNCACHE_SIZE, lambda key: PatternSubst(*key),
+                              weightfunc=_patternsize)
+
+def getpatternset(s):
+    """Return the PatternSet of the patterns in `s`, from a cache."""
+    return patternsets.get(s)
+
+def getpatternsubst(pattern, replacement):
+    """Return the PatternSubst of `pattern` by `replacement`, from a cache."""
+    return patternsubsts.get((pattern, replacement))
+
 class RemakeTargetSerially(object):
     __slots__ = ('target', 'makefile', 'indent', 'rlist')
 
@@ -1176,7 +1818,7 @@ class Target(object):
                         libname = lp.resolve('', stem)
 
                         for dir in searchdirs:
-                            libpath = util.normaljoin(dir, libname).replace('\\', '/')
+                            libpath = util.slashjoin(dir, libname)
                             fspath = util.normaljoin(makefile.workdir, libpath)
                             mtime = getmtime(fspath)
                             if mtime is not None:
@@ -1190,7 +1832,7 @@ class Target(object):
 
         search = [self.target]
         if not os.path.isabs(self.target):
-            search += [util.normaljoin(dir, self.target).replace('\\', '/')
+            search += [util.slashjoin(dir, self.target)
                        for dir in makefile.getvpath(self.target)]
 
         targetandtime = self.searchinlocs(makefile, search)
@@ -1208,7 +1850,7 @@ class Target(object):
         if not.
         """
         for t in locs:
-            fspath = util.normaljoin(makefile.workdir, t).replace('\\', '/')
+            fspath = util.slashjoin(makefile.workdir, t)
             mtime = getmtime(fspath)
 #            _log.info("Searching %s ... checking %s ... mtime %r" % (t, fspath, mtime))
             if mtime is not None:
@@ -1329,24 +1971,99 @@ def filepart(p):
     d, s, f = util.strrpartition(p, '/')
     return f
 
+# The names of the variables set by setautomaticvariables
+_automaticvariables = [n + s for n in '@<?^+*' for s in ('', 'D', 'F')]
+
+class _AutomaticValue(object):
+    """
+    The value of an automatic variable: a list of paths, or their directory or file parts.
+    """
+
+    __slots__ = ('_paths', '_part', '_joined')
+
+    def __init__(self, paths, part):
+        self._paths = paths # a function returning the paths
+        self._part = part
+        self._joined = None
+
+    def joined(self):
+        if self._joined is None:
+            paths = self._paths()
+            if self._part is not None:
+                paths = [self._part(p) for p in paths]
+            self._joined = ' '.join(paths)
+        return self._joined
+
+# Values of variables which are computed when they are first read. Their joined() method returns
+# the value as a string.
+_deferredvalues = (_AppendedValue, _AutomaticValue)
+
+class _RulePaths(object):
+    """
+    The paths of the prerequisites of a target which the automatic variables of the rule
+    remaking it are set to, found when they are first needed.
+    """
+
+    __slots__ = ('makefile', 'mtime', 'prerequisites', '_targets', '_all', '_unique', '_outofdate')
+
+    def __init__(self, makefile, target, prerequisites):
+        self.makefile = makefile
+        self.mtime = target.mtime
+        self.prerequisites = prerequisites
+        self._targets = None
+        self._all = None
+        self._unique = None
+        self._outofdate = None
+
+    def _gettargets(self):
+        if self._targets is None:
+            self._targets = [self.makefile.gettarget(p) for p in self.prerequisites]
+        return self._targets
+
+    def all(self):
+        if self._all is None:
+            self._all = [pt.vpathtarget for pt in self._gettargets()]
+        return self._all
+
+    def first(self):
+        return self.all()[:1]
+
+    def unique(self):
+        if self._unique is None:
+            self._unique = list(withoutdups(self.all()))
+        return self._unique
+
+    def outofdate(self):
+        if self._outofdate is None:
+            self._outofdate = [pt.vpathtarget for pt in withoutdups(self._gettargets())
+                               if self.mtime is None or mtimeislater(pt.mtime, self.mtime)]
+        return self._outofdate
+
 def setautomatic(v, name, plist):
-    v.set(name, Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join(plist))
-    v.set(name + 'D', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join((dirpart(p) for p in plist)))
-    v.set(name + 'F', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join((filepart(p) for p in plist)))
+    """
+    Set the automatic variable `name`, and its D and F variants, to the paths `plist`, or to
+    the paths returned by `plist` when one of the variables is first read, if it is a function.
+    """
+    if isinstance(plist, list):
+        v.set(name, Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join(plist))
+        v.set(name + 'D', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join((dirpart(p) for p in plist)))
+        v.set(name + 'F', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join((filepart(p) for p in plist)))
+        return
+
+    v.set(name, Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, _AutomaticValue(plist, None))
+    v.set(name + 'D', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, _AutomaticValue(plist, dirpart))
+    v.set(name + 'F', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, _AutomaticValue(plist, filepart))
 
 def setautomaticvariables(v, makefile, target, prerequisites):
-    prtargets = [makefile.gettarget(p) for p in prerequisites]
-    prall = [pt.vpathtarget for pt in prtargets]
-    proutofdate = [pt.vpathtarget for pt in withoutdups(prtargets)
-                   if target.mtime is None or mtimeislater(pt.mtime, target.mtime)]
-    
+    paths = _RulePaths(makefile, target, prerequisites)
+
     setautomatic(v, '@', [target.vpathtarget])
-    if len(prall):
-        setautomatic(v, '<', [prall[0]])
+    if len(prerequisites):
+        setautomatic(v, '<', paths.first)
 
-    setautomatic(v, '?', proutofdate)
-    setautomatic(v, '^', list(withoutdups(prall)))
-    setautomatic(v, '+', prall)
+    setautomatic(v, '?', paths.outofdate)
+    setautomatic(v, '^', paths.unique)
+    setautomatic(v, '+', paths.all)
 
 def splitcommand(command):
     """
@@ -1429,6 +2146,94 @@ class _NativeWrapper(_CommandWrapper):
                             loc=self.loc, cb=self._cb, context=self.context,
                             pycommandpath=self.pycommandpath, **self.kwargs)
 
+class _RecipeTemplate(object):
+    """
+    The commands of a rule, split into literal text, the function calls which expand the same
+    for every target, and the rest. A call expands the same for every target if it only reads
+    frozen variables (see Variables.freeze) and none of them are set for the target, in which
+    case it is only expanded the first time.
+
+    A template is built from the frozen variables of a makefile, and must be rebuilt when they
+    are thawed.
+    """
+
+    __slots__ = ('values', '_commands')
+
+    def __init__(self, commands, variables):
+        self.values = variables._frozen.values
+        self._commands = [self._split(c, variables) for c in commands]
+
+    @staticmethod
+    def _split(c, variables):
+        if c.simple:
+            return [c.s]
+
+        # A list of literal strings and [compiled call, names read or None, value or None]
+        segments = []
+        for e, isfunc in c:
+            if not isfunc:
+                segments.append(e)
+                continue
+
+            exp = Expansion()
+            exp.appendfunc(e)
+            reads = None
+            if not _isvolatile(exp):
+                names = _references(exp)
+                if names is not None:
+                    reads = set()
+                    for n in names:
+                        r = variables._frozenreads(n)
+                        if r is False:
+                            reads = None
+                            break
+                        reads.update(r)
+
+            segments.append([e.compile(), reads, None])
+
+        return segments
+
+    def resolvestr(self, i, makefile, variables):
+        """
+        Expand command `i` in the scope `variables`, whose outermost scope must be the one
+        the template was built from.
+        """
+        maps = []
+        v = variables
+        while v.parent is not None:
+            maps.append(v._map)
+            v = v.parent
+
+        parts = []
+        for s in self._commands[i]:
+            if not isinstance(s, list):
+                parts.append(s)
+                continue
+
+            f, reads, value = s
+            if reads is None or _binds(maps, reads):
+                parts.append(f(makefile, variables, []))
+                continue
+
+            if value is None:
+                value = s[2] = f(makefile, v, [])
+            parts.append(value)
+
+        return ''.join(parts)
+
+def _gettemplate(rule, makefile):
+    """
+    The _RecipeTemplate of the commands of `rule`, a Rule or PatternRule, or None if the
+    variables of `makefile` are not frozen.
+    """
+    frozen = makefile.variables._frozen
+    if frozen is None:
+        return None
+
+    if rule._template is None or rule._template.values is not frozen.values:
+        rule._template = _RecipeTemplate(rule.commands, makefile.variables)
+    return rule._template
+
 def getcommandsforrule(rule, target, makefile, prerequisites, stem):
     v = Variables(parent=target.variables)
     setautomaticvariables(v, makefile, target, prerequisites)
@@ -1436,9 +2241,14 @@ def getcommandsforrule(rule, target, makefile, prerequisites, stem):
         setautomatic(v, '*', [stem])
 
     env = makefile.getsubenvironment(v)
+    template = rule.gettemplate(makefile)
 
-    for c in rule.commands:
-        cstring = c.resolvestr(makefile, v)
+    for i in range(0, len(rule.commands)):
+        c = rule.commands[i]
+        if template is None:
+            cstring = c.resolvestr(makefile, v)
+        else:
+            cstring = template.resolvestr(i, makefile, v)
         for cline in splitcommand(cstring):
             cline, isHidden, isRecursive, ignoreErrors, isNative = findmodifiers(cline)
             if (isHidden or makefile.silent) and not makefile.justprint:
@@ -1470,10 +2280,15 @@ class Rule(object):
         self.commands = []
         self.loc = loc
         self.weakdeps = weakdeps
+        self._template = None
 
     def addcommand(self, c):
         assert isinstance(c, (Expansion, StringExpansion))
         self.commands.append(c)
+        self._template = None
+
+    def gettemplate(self, makefile):
+        return _gettemplate(self, makefile)
 
     def getcommands(self, target, makefile):
         assert isinstance(target, Target)
@@ -1516,6 +2331,9 @@ class PatternRuleInstance(object):
         assert isinstance(target, Target)
         return getcommandsforrule(self, target, makefile, self.prerequisites, stem=self.dir + self.stem)
 
+    def gettemplate(self, makefile):
+        return self.prule.gettemplate(makefile)
+
     def __str__(self):
         return "Pattern rule at %s with stem '%s', matchany: %s doublecolon: %s" % (self.loc,
                                                                                     self.dir + self.stem,
@@ -1534,10 +2352,15 @@ class PatternRule(object):
         self.doublecolon = doublecolon
         self.loc = loc
         self.commands = []
+        self._template = None
 
     def addcommand(self, c):
         assert isinstance(c, (Expansion, StringExpansion))
         self.commands.append(c)
+        self._template = None
+
+    def gettemplate(self, makefile):
+        return _gettemplate(self, makefile)
 
     def ismatchany(self):
         return util.any((t.ismatchany() for t in self.targetpatterns))
@@ -1643,7 +2466,7 @@ class Makefile(object):
 
         if workdir is None:
             workdir = os.getcwd()
-        workdir = os.path.realpath(workdir)
+        workdir = util.realpath(workdir)
         self.workdir = workdir
         self.variables.set('CURDIR', Variables.FLAVOR_SIMPLE,
                            Variables.SOURCE_AUTOMATIC, workdir.replace('\\','/'))
@@ -1772,6 +2595,14 @@ class Makefile(object):
         if value is not None:
             self.defaulttarget = value.resolvestr(self, self.variables, ['.DEFAULT_GOAL']).strip()
 
+        if _freezing:
+            exclude = set(_automaticvariables)
+            for t in self._targets.values():
+                exclude.update([k for k, flavor, source, value in t.variables])
+            for p, v in self._patternvariables:
+                exclude.update([k for k, flavor, source, value in v])
+            self.variables.freeze(exclude)
+
         self.error = False
 
     def include(self, path, required=True, weak=False, loc=None):
@@ -1790,6 +2621,9 @@ class Makefile(object):
                     stmts = parser.parsedepfile(fspath)
                 else:
                     stmts = parser.parsefile(fspath)
+                    # Only parallel builds have a pool of processes to parse in
+                    if self.context.jcount > 1:
+                        parser.prefetch(stmts, self.workdir, self.context.processpool)
                 self.variables.append('MAKEFILE_LIST', Variables.SOURCE_AUTOMATIC, path, None, self)
                 stmts.execute(self, weak=weak)
                 self.gettarget(path).explicit = True
@@ -1835,11 +2669,9 @@ class Makefile(object):
         env = dict(self.env)
         for vname, v in self.exportedvars.items():
             if v:
-                flavor, source, val = variables.get(vname)
-                if val is None:
+                strval = variables.resolvestr(vname, self)
+                if strval is None:
                     strval = ''
-                else:
-                    strval = val.resolvestr(self, variables, [vname])
                 env[vname] = strval
             else:
                 env.pop(vname, None)
@@ -0,0 +1,328 @@
+"""
+Template evaluation of $(eval $(call NAME,args...)).
+
+Makefiles commonly generate rules with
+
+  $(foreach x,$(LIST),$(eval $(call TEMPLATE,$(x))))
+
+where each evaluation produces the same text apart from the arguments substituted for
+$(1)...$(n). Rather than parsing the generated text for every argument, template
+evaluation expands the body of TEMPLATE with a placeholder in place of each top-level
+$(1)...$(n) reference, parses that text once, and then substitutes the arguments into the
+parsed statements.
+
+This is only equivalent to parsing the generated text when the arguments couldn't have
+changed the way it parses, so template evaluation falls back to parsing the text when an
+argument contains characters which are significant to the parser, or could begin a
+directive, or when a placeholder ends up somewhere which can't be substituted (inside a
+function call, for instance).
+"""
+
+import logging, re, copy
+import data, functions, parser, parserdata, util
+from pymake import errors
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+_log = logging.getLogger('pymake.parser')
+
+_enabled = False
+
+# Parsed templates, keyed by their text: created when templates are first enabled, because
+# this module is imported while the parser is still being set up.
+_templates = None
+
+def setenabled(enabled):
+    """
+    Evaluate $(eval $(call NAME,args...)) through parsed templates of NAME.
+    """
+    global _enabled, _templates
+    _enabled = enabled
+    if enabled and _templates is None:
+        _templates = util.LRUCache(256, _createtemplate)
+
+def gettemplates():
+    """
+    The cache of parsed templates, a util.LRUCache, or None if templates were never enabled.
+    """
+    return _templates
+
+# \x01 has no meaning in makefile syntax, so placeholders parse as ordinary text.
+def _placeholder(i):
+    return '\x01%i\x01' % i
+
+_placeholderre = re.compile('\x01(\\d+)\x01')
+
+# Arguments containing any of these could change how the text around them parses.
+_unsafechars = re.compile(r'''[\x01$#\\\n:=;(){},'"|+?!]''')
+
+# Placeholders in the first word of a line, possibly after directives that take another
+# directive, and in the first word of a variable reference. An argument there could turn the
+# word into a directive or a function name.
+_linestartre = re.compile(r'^[ \t]*(?:(?:override|export|unexport)[ \t]+)*()\x01(\d+)\x01(\S*)', re.M)
+_refstartre = re.compile(r'\$[({]([^\s$(){}\x01]*)\x01(\d+)\x01([^\s$(){}]*)')
+
+# The fields of each class which hold expansions. Other functions hold their arguments in
+# Function._arguments.
+_expfields = {
+    'VariableRef': ('vname',),
+    'SubstitutionRef': ('vname', 'substfrom', 'substto'),
+    'Rule': ('targetexp', 'depexp'),
+    'StaticPatternRule': ('targetexp', 'patternexp', 'depexp'),
+    'Command': ('exp',),
+    'SetVariable': ('vnameexp', 'targetexp'),
+    'Include': ('exp',),
+    'VPathDirective': ('exp',),
+    'ExportDirective': ('exp',),
+    'UnexportDirective': ('exp',),
+    'EmptyDirective': ('exp',),
+    'EqCondition': ('exp1', 'exp2'),
+    'IfdefCondition': ('exp',),
+    'ElseCondition': (),
+}
+
+class _Binder(object):
+    """
+    Substitutes arguments for the placeholders in parsed statements, counting the
+    substitutions made. Statements and functions without placeholders are shared, not copied.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.count = 0
+
+    def _replace(self, m):
+        self.count += 1
+        return self.args[int(m.group(1))]
+
+    def bindstr(self, s):
+        if '\x01' not in s:
+            return s
+        return _placeholderre.sub(self._replace, s)
+
+    def bindexp(self, e):
+        if e is None:
+            return None
+
+        if isinstance(e, data.StringExpansion):
+            s = self.bindstr(e.s)
+            if s is e.s:
+                return e
+            return data.StringExpansion(s, e.loc)
+
+        changed = False
+        elements = []
+        for s, isfunc in e:
+            if isfunc:
+                bound = self.bindobject(s)
+            else:
+                bound = self.bindstr(s)
+            changed = changed or bound is not s
+            elements.append((bound, isfunc))
+
+        if not changed:
+            return e
+
+        bound = data.Expansion(e.loc)
+        for s, isfunc in elements:
+            if isfunc:
+                bound.appendfunc(s)
+            else:
+                bound.appendstr(s)
+        return bound
+
+    def bindobject(self, o):
+        changes = []
+        fields = _expfields.get(type(o).__name__)
+        if fields is None:
+            args = [self.bindexp(e) for e in o._arguments]
+            for i in range(0, len(args)):
+                if args[i] is not o._arguments[i]:
+                    changes.append(('_arguments', args))
+                    break
+        else:
+            for field in fields:
+                e = getattr(o, field)
+                bound = self.bindexp(e)
+                if bound is not e:
+                    changes.append((field, bound))
+
+        if isinstance(o, parserdata.SetVariable):
+            value = self.bindstr(o.value)
+            if value is not o.value:
+                changes.append(('value', value))
+
+                # The placeholders in the parsed value are the ones just counted in the text.
+                if o._valueexp is not None:
+                    count = self.count
+                    changes.append(('_valueexp', self.bindexp(o._valueexp)))
+                    self.count = count
+
+        if not len(changes):
+            return o
+
+        o = copy.copy(o)
+        for field, bound in changes:
+            setattr(o, field, bound)
+        return o
+
+    def bindstatements(self, stmts):
+        bound = parserdata.StatementList()
+        for s in stmts:
+            if isinstance(s, parserdata.ConditionBlock):
+                block = None
+                for c, branch in s:
+                    c = self.bindobject(c)
+                    if block is None:
+                        block = parserdata.ConditionBlock(s.loc, c)
+                    else:
+                        block.addcondition(c.loc, c)
+                    for s2 in self.bindstatements(branch):
+                        block.append(s2)
+                s = block
+            else:
+                s = self.bindobject(s)
+            bound.append(s)
+        return bound
+
+class _Template(object):
+    """
+    Makefile text containing placeholders, parsed once.
+    """
+    __slots__ = ('stmts', 'nargs', 'firstwords')
+
+    def __init__(self, s, filename):
+        self.stmts = None
+        self.nargs = max([int(i) for i in _placeholderre.findall(s)])
+
+        # (prefix, argument, suffix, keywords) for each placeholder in a first word
+        self.firstwords = []
+        for r, keywords in ((_linestartre, parser._directivestokenlist),
+                            (_refstartre, functions.functionmap)):
+            for m in r.finditer(s):
+                prefix, i, suffix = m.groups()
+                if '\x01' in suffix:
+                    return
+                self.firstwords.append((prefix, int(i), suffix, keywords))
+
+        # A placeholder may stand for several words, so calls on one can't be folded.
+        folding = parser._folding
+        parser.setfolding(False)
+        try:
+            stmts = parser.parsestring(s, filename)
+        except errors.MakeError:
+            # Let the error be reported by parsing the real text.
+            return
+        finally:
+            parser.setfolding(folding)
+
+        # Every placeholder must be somewhere bind can find it.
+        binder = _Binder(['x'] * (self.nargs + 1))
+        binder.bindstatements(stmts)
+        if binder.count != s.count('\x01') // 2:
+            _log.debug("%s: not using a template: arguments are substituted into functions", filename)
+            return
+
+        self.stmts = stmts
+
+    def accepts(self, args):
+        """
+        Whether substituting `args` (indexed from 1) into the statements is equivalent to
+        parsing the text with `args` substituted.
+        """
+        if self.stmts is None:
+            return False
+
+        for a in args[1:self.nargs + 1]:
+            if _unsafechars.search(a) or a != a.strip():
+                return False
+
+        for prefix, i, suffix, keywords in self.firstwords:
+            if args[i] == '' or (prefix + args[i] + suffix).split()[0] in keywords:
+                return False
+
+        return True
+
+    def bind(self, args):
+        return _Binder(args).bindstatements(self.stmts)
+
+def _createtemplate(key):
+    return _Template(*key)
+
+def _expandcall(call, makefile, variables, setting):
+    """
+    Expand a $(call) the way functions.CallFunction does, but with placeholders in place of
+    the top-level references to its arguments. Returns the text and the arguments, indexed
+    from 1.
+    """
+    vname = call._arguments[0].resolvestr(makefile, variables, setting)
+    if vname in setting:
+        raise errors.DataError("Recursively setting variable '%s'" % (vname,))
+
+    args = [vname]
+    v = data.ParameterScope(parent=variables)
+    v.bind('0', vname)
+    for i in range(1, len(call._arguments)):
+        param = call._arguments[i].resolvestr(makefile, variables, setting)
+        v.bind(str(i), param)
+        args.append(param)
+
+    flavor, source, e = variables.get(vname)
+    if e is None:
+        return '', args
+
+    if flavor == data.Variables.FLAVOR_SIMPLE:
+        _log.warning("%s: calling variable '%s' which is simply-expanded" % (call.loc, vname))
+
+    if isinstance(e, data.StringExpansion):
+        return e.s, args
+
+    params = dict((str(i), i) for i in range(1, len(args)))
+    setting = data.RecursionGuard(vname, setting)
+    fd = StringIO()
+    for s, isfunc in e:
+        if not isfunc:
+            fd.write(s)
+            continue
+
+        if isinstance(s, functions.VariableRef) and isinstance(s.vname, data.StringExpansion):
+            i = params.get(s.vname.s)
+            if i is not None:
+                fd.write(_placeholder(i))
+                continue
+
+        s.resolve(makefile, v, fd, setting)
+
+    return fd.getvalue(), args
+
+def evaluate(fn, makefile, variables, setting):
+    """
+    Evaluate the EvalFunction `fn` through a template, if template evaluation is enabled and
+    its argument is a single $(call). Returns whether the evaluation was done.
+    """
+    if not _enabled:
+        return False
+
+    arg = fn._arguments[0]
+    if not isinstance(arg, data.Expansion) or len(arg) != 1:
+        return False
+
+    call, isfunc = arg[0]
+    if not isfunc or not isinstance(call, functions.CallFunction):
+        return False
+
+    s, args = _expandcall(call, makefile, variables, setting)
+    filename = 'evaluation from %s' % fn.loc
+
+    if '\x01' in s:
+        template = _templates.get((s, filename))
+        if template.accepts(args):
+            template.bind(args).execute(makefile)
+            return True
+
+        s = _placeholderre.sub(lambda m: args[int(m.group(1))], s)
+
+    parser.parseeval(s, filename).execute(makefile)
+    return True
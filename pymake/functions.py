@@ -3,11 +3,16 @@ Makefile functions.
 """
 from __future__ import print_function
 
-import parser, util
+import parser, util, evaltemplates
 import subprocess, os, logging, sys
 from globrelative import glob
 from pymake import errors
 
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 log = logging.getLogger('pymake.data')
 
 def emit_expansions(descend, *expansions):
@@ -18,14 +23,17 @@ def emit_expansions(descend, *expansions):
         if not descend or not isinstance(expansion, list):
             continue
 
+        # Literal strings within an expansion aren't expansions themselves
         for e, is_func in expansion:
             if is_func:
                 for exp in e.expansions(True):
                     yield exp
-            else:
-                yield e
 
-class Function(object):
+class _Node(object):
+    # Functions may be shared through a weak table, see data.internnode
+    __slots__ = ('__weakref__',)
+
+class Function(_Node):
     """
     An object that represents a function call. This class is always subclassed
     with the following methods and attributes:
@@ -40,6 +48,9 @@ class Function(object):
 
     __slots__ = ('_arguments', 'loc')
 
+    # Whether the result only depends on the arguments: no variables, filesystem, shell or eval
+    pure = False
+
     def __init__(self, loc):
         self._arguments = []
         self.loc = loc
@@ -60,6 +71,60 @@ class Function(object):
         assert isinstance(arg, (data.Expansion, data.StringExpansion))
         self._arguments.append(arg)
 
+    def internarguments(self):
+        """
+        Replace the arguments with shared nodes before this function is interned.
+        See data.internnode.
+        """
+        self._arguments = [data.internnode(a) for a in self._arguments]
+
+    def internkey(self):
+        return (type(self),) + tuple([id(a) for a in self._arguments])
+
+    def fold(self):
+        """
+        Return the result of this function as a string if it can be evaluated before it is
+        used: the function is pure and all its arguments are static strings. Otherwise, or if
+        evaluating it fails, return None and leave any error to be reported when it is used.
+        """
+        if not self.pure:
+            return None
+
+        for a in self._arguments:
+            if not a.is_static_string:
+                return None
+
+        try:
+            return self.compile()(None, None, [])
+        except (errors.DataError, ValueError):
+            return None
+
+    def resolvesplit(self, makefile, variables, setting):
+        """
+        Return the words of the result of this function. Functions whose results are lists of
+        words override this to return their words without joining them into a string, so a
+        function whose argument is a single call of another (see data.Expansion.resolvesplit)
+        doesn't have to split the string again.
+        """
+        fd = StringIO()
+        self.resolve(makefile, variables, fd, setting)
+        return fd.getvalue().split()
+
+    def compile(self):
+        """
+        Return a function(makefile, variables, setting) which returns the result of this
+        function call as a string. See data.Expansion.compile.
+
+        Subclasses may return a specialized function. By default, the result is collected
+        from resolve().
+        """
+        resolve = self.resolve
+        def resolvestr(makefile, variables, setting):
+            fd = StringIO()
+            resolve(makefile, variables, fd, setting)
+            return fd.getvalue()
+        return resolvestr
+
     def to_source(self):
         """Convert the function back to make file "source" code."""
         if not hasattr(self, 'name'):
@@ -141,13 +206,7 @@ class Function(object):
             # arguments is *not* part of the argument's value. So, we do a
             # whitespace-agnostic comparison.
             if i == 0:
-                a = self._arguments[i]
-                a.lstrip()
-
-                b = other._arguments[i]
-                b.lstrip()
-
-                if a != b:
+                if _lstripped(self._arguments[i]) != _lstripped(other._arguments[i]):
                     return False
 
                 continue
@@ -160,6 +219,33 @@ class Function(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+def _lstripped(e):
+    """
+    Return the expansion `e` without leading literal whitespace, leaving `e` itself unchanged.
+    """
+    if e.simple:
+        return data.StringExpansion(e.s.lstrip(), e.loc)
+
+    e = e.clone()
+    e.lstrip()
+    return e
+
+def _iswords(s):
+    """Whether joining words with `s` can't add or remove words."""
+    return s == '' or s.split() == [s]
+
+def _substwords(subst, r, words):
+    """
+    The words of ' '.join([subst.subst(w) for w in words]), where `subst` is a
+    data.PatternSubst whose replacement is `r`.
+    """
+    subst = subst.subst
+    if not _iswords(r):
+        return ' '.join([subst(w) for w in words]).split()
+
+    # A word may still be replaced by nothing.
+    return [w for w in [subst(w) for w in words] if w != '']
+
 class VariableRef(Function):
     AUTOMATIC_VARIABLES = set(['@', '%', '<', '?', '^', '+', '|', '*'])
 
@@ -173,17 +259,54 @@ class VariableRef(Function):
     def setup(self):
         assert False, "Shouldn't get here"
 
+    def internarguments(self):
+        self.vname = data.internnode(self.vname)
+
+    def internkey(self):
+        return VariableRef, id(self.vname)
+
     def resolve(self, makefile, variables, fd, setting):
         vname = self.vname.resolvestr(makefile, variables, setting)
         if vname in setting:
             raise errors.DataError("Setting variable '%s' recursively references itself." % (vname,), self.loc)
 
-        flavor, source, value = variables.get(vname)
+        value = variables.resolvestr(vname, makefile, setting)
         if value is None:
-            log.debug("%s: variable '%s' was not set" % (self.loc, vname))
+            log.debug("%s: variable '%s' was not set", self.loc, vname)
             return
 
-        value.resolve(makefile, variables, fd, setting + [vname])
+        fd.write(value)
+
+    def resolvesplit(self, makefile, variables, setting):
+        vname = self.vname.resolvestr(makefile, variables, setting)
+        if vname in setting:
+            raise errors.DataError("Setting variable '%s' recursively references itself." % (vname,), self.loc)
+
+        words = variables.resolvesplit(vname, makefile, setting)
+        if words is None:
+            log.debug("%s: variable '%s' was not set", self.loc, vname)
+            return []
+
+        return words
+
+    def compile(self):
+        if not self.vname.is_static_string:
+            return Function.compile(self)
+
+        # The variable name is constant: resolve it once.
+        vname = self.vname.resolvestr(None, None)
+        loc = self.loc
+        def resolvestr(makefile, variables, setting):
+            if vname in setting:
+                raise errors.DataError("Setting variable '%s' recursively references itself." % (vname,), loc)
+
+            value = variables.resolvestr(vname, makefile, setting)
+            if value is None:
+                log.debug("%s: variable '%s' was not set", loc, vname)
+                return ''
+
+            return value
+        return resolvestr
 
     def to_source(self):
         if isinstance(self.vname, data.StringExpansion):
@@ -220,7 +343,19 @@ class SubstitutionRef(Function):
     def setup(self):
         assert False, "Shouldn't get here"
 
-    def resolve(self, makefile, variables, fd, setting):
+    def internarguments(self):
+        self.vname = data.internnode(self.vname)
+        self.substfrom = data.internnode(self.substfrom)
+        self.substto = data.internnode(self.substto)
+
+    def internkey(self):
+        return SubstitutionRef, id(self.vname), id(self.substfrom), id(self.substto)
+
+    def _substitute(self, makefile, variables, setting):
+        """
+        Returns the pattern and replacement of this substitution, and the words of the variable,
+        or None if it is not set.
+        """
         vname = self.vname.resolvestr(makefile, variables, setting)
         if vname in setting:
             raise errors.DataError("Setting variable '%s' recursively references itself." % (vname,), self.loc)
@@ -230,16 +365,31 @@ class SubstitutionRef(Function):
 
         flavor, source, value = variables.get(vname)
         if value is None:
-            log.debug("%s: variable '%s' was not set" % (self.loc, vname))
-            return
+            log.debug("%s: variable '%s' was not set", self.loc, vname)
+            return None
 
-        f = data.Pattern(substfrom)
-        if not f.ispattern():
-            f = data.Pattern('%' + substfrom)
+        f = data.getpatternsubst(substfrom, substto)
+        if not f.pattern.ispattern():
             substto = '%' + substto
+            f = data.getpatternsubst('%' + substfrom, substto)
+
+        return f, substto, value.resolvesplit(makefile, variables, data.RecursionGuard(vname, setting))
 
-        fd.write(' '.join([f.subst(substto, word, False)
-                           for word in value.resolvesplit(makefile, variables, setting + [vname])]))
+    def resolve(self, makefile, variables, fd, setting):
+        r = self._substitute(makefile, variables, setting)
+        if r is None:
+            return
+
+        f, substto, words = r
+        fd.write(' '.join([f.subst(word) for word in words]))
+
+    def resolvesplit(self, makefile, variables, setting):
+        r = self._substitute(makefile, variables, setting)
+        if r is None:
+            return []
+
+        f, substto, words = r
+        return _substwords(f, substto, words)
 
     def to_source(self):
         return '$(%s:%s=%s)' % (
@@ -266,6 +416,7 @@ class SubstFunction(Function):
     name = 'subst'
     minargs = 3
     maxargs = 3
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -279,6 +430,7 @@ class PatSubstFunction(Function):
     name = 'patsubst'
     minargs = 3
     maxargs = 3
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -286,24 +438,36 @@ class PatSubstFunction(Function):
         s = self._arguments[0].resolvestr(makefile, variables, setting)
         r = self._arguments[1].resolvestr(makefile, variables, setting)
 
-        p = data.Pattern(s)
-        fd.write(' '.join([p.subst(r, word, False)
+        subst = data.getpatternsubst(s, r).subst
+        fd.write(' '.join([subst(word)
                            for word in self._arguments[2].resolvesplit(makefile, variables, setting)]))
 
+    def resolvesplit(self, makefile, variables, setting):
+        s = self._arguments[0].resolvestr(makefile, variables, setting)
+        r = self._arguments[1].resolvestr(makefile, variables, setting)
+
+        return _substwords(data.getpatternsubst(s, r), r,
+                           self._arguments[2].resolvesplit(makefile, variables, setting))
+
 class StripFunction(Function):
     name = 'strip'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
         util.joiniter(fd, self._arguments[0].resolvesplit(makefile, variables, setting))
 
+    def resolvesplit(self, makefile, variables, setting):
+        return self._arguments[0].resolvesplit(makefile, variables, setting)
+
 class FindstringFunction(Function):
     name = 'findstring'
     minargs = 2
     maxargs = 2
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -318,45 +482,51 @@ class FilterFunction(Function):
     name = 'filter'
     minargs = 2
     maxargs = 2
+    pure = True
 
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
-        plist = [data.Pattern(p)
-                 for p in self._arguments[0].resolvesplit(makefile, variables, setting)]
+        fd.write(' '.join(self.resolvesplit(makefile, variables, setting)))
 
-        fd.write(' '.join([w for w in self._arguments[1].resolvesplit(makefile, variables, setting)
-                           if util.any((p.match(w) for p in plist))]))
+    def resolvesplit(self, makefile, variables, setting):
+        patterns = data.getpatternset(self._arguments[0].resolvestr(makefile, variables, setting))
+        return patterns.filter(self._arguments[1].resolvesplit(makefile, variables, setting))
 
 class FilteroutFunction(Function):
     name = 'filter-out'
     minargs = 2
     maxargs = 2
+    pure = True
 
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
-        plist = [data.Pattern(p)
-                 for p in self._arguments[0].resolvesplit(makefile, variables, setting)]
+        fd.write(' '.join(self.resolvesplit(makefile, variables, setting)))
 
-        fd.write(' '.join([w for w in self._arguments[1].resolvesplit(makefile, variables, setting)
-                           if not util.any((p.match(w) for p in plist))]))
+    def resolvesplit(self, makefile, variables, setting):
+        patterns = data.getpatternset(self._arguments[0].resolvestr(makefile, variables, setting))
+        return patterns.filter(self._arguments[1].resolvesplit(makefile, variables, setting), keep=False)
 
 class SortFunction(Function):
     name = 'sort'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
-        d = set(self._arguments[0].resolvesplit(makefile, variables, setting))
-        util.joiniter(fd, sorted(d))
+        util.joiniter(fd, self.resolvesplit(makefile, variables, setting))
+
+    def resolvesplit(self, makefile, variables, setting):
+        return sorted(set(self._arguments[0].resolvesplit(makefile, variables, setting)))
 
 class WordFunction(Function):
     name = 'word'
     minargs = 2
     maxargs = 2
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -373,10 +543,14 @@ class WordlistFunction(Function):
     name = 'wordlist'
     minargs = 3
     maxargs = 3
+    pure = True
 
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
+        util.joiniter(fd, self.resolvesplit(makefile, variables, setting))
+
+    def resolvesplit(self, makefile, variables, setting):
         nfrom = self._arguments[0].resolvestr(makefile, variables, setting)
         nto = self._arguments[1].resolvestr(makefile, variables, setting)
         # TODO: provide better errors if this doesn't convert
@@ -390,12 +564,13 @@ class WordlistFunction(Function):
         if nto < 1:
             nto = 1
 
-        util.joiniter(fd, words[nfrom - 1:nto])
+        return words[nfrom - 1:nto]
 
 class WordsFunction(Function):
     name = 'words'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -406,6 +581,7 @@ class FirstWordFunction(Function):
     name = 'firstword'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -418,6 +594,7 @@ class LastWordFunction(Function):
     name = 'lastword'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -441,15 +618,20 @@ class DirFunction(Function):
     name = 'dir'
     minargs = 1
     maxargs = 1
+    pure = True
 
     def resolve(self, makefile, variables, fd, setting):
-        fd.write(' '.join([pathsplit(path)[0]
-                           for path in self._arguments[0].resolvesplit(makefile, variables, setting)]))
+        fd.write(' '.join(self.resolvesplit(makefile, variables, setting)))
+
+    def resolvesplit(self, makefile, variables, setting):
+        return [pathsplit(path)[0]
+                for path in self._arguments[0].resolvesplit(makefile, variables, setting)]
 
 class NotDirFunction(Function):
     name = 'notdir'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -457,10 +639,17 @@ class NotDirFunction(Function):
         fd.write(' '.join([pathsplit(path)[1]
                            for path in self._arguments[0].resolvesplit(makefile, variables, setting)]))
 
+    def resolvesplit(self, makefile, variables, setting):
+        # The file part of a path ending in a slash is empty.
+        return [file for dir, file in
+                [pathsplit(path) for path in self._arguments[0].resolvesplit(makefile, variables, setting)]
+                if file != '']
+
 class SuffixFunction(Function):
     name = 'suffix'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -475,10 +664,14 @@ class SuffixFunction(Function):
     def resolve(self, makefile, variables, fd, setting):
         util.joiniter(fd, self.suffixes(self._arguments[0].resolvesplit(makefile, variables, setting)))
 
+    def resolvesplit(self, makefile, variables, setting):
+        return list(self.suffixes(self._arguments[0].resolvesplit(makefile, variables, setting)))
+
 class BasenameFunction(Function):
     name = 'basename'
     minargs = 1
     maxargs = 1
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -495,10 +688,15 @@ class BasenameFunction(Function):
     def resolve(self, makefile, variables, fd, setting):
         util.joiniter(fd, self.basenames(self._arguments[0].resolvesplit(makefile, variables, setting)))
 
+    def resolvesplit(self, makefile, variables, setting):
+        return [b for b in self.basenames(self._arguments[0].resolvesplit(makefile, variables, setting))
+                if b != '']
+
 class AddSuffixFunction(Function):
     name = 'addsuffix'
     minargs = 2
     maxargs = 2
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -507,20 +705,38 @@ class AddSuffixFunction(Function):
 
         fd.write(' '.join([w + suffix for w in self._arguments[1].resolvesplit(makefile, variables, setting)]))
 
+    def resolvesplit(self, makefile, variables, setting):
+        suffix = self._arguments[0].resolvestr(makefile, variables, setting)
+
+        words = [w + suffix for w in self._arguments[1].resolvesplit(makefile, variables, setting)]
+        if not _iswords(suffix):
+            return ' '.join(words).split()
+        return words
+
 class AddPrefixFunction(Function):
     name = 'addprefix'
     minargs = 2
     maxargs = 2
+    pure = True
 
     def resolve(self, makefile, variables, fd, setting):
         prefix = self._arguments[0].resolvestr(makefile, variables, setting)
 
         fd.write(' '.join([prefix + w for w in self._arguments[1].resolvesplit(makefile, variables, setting)]))
 
+    def resolvesplit(self, makefile, variables, setting):
+        prefix = self._arguments[0].resolvestr(makefile, variables, setting)
+
+        words = [prefix + w for w in self._arguments[1].resolvesplit(makefile, variables, setting)]
+        if not _iswords(prefix):
+            return ' '.join(words).split()
+        return words
+
 class JoinFunction(Function):
     name = 'join'
     minargs = 2
     maxargs = 2
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -537,6 +753,12 @@ class JoinFunction(Function):
 
         util.joiniter(fd, self.iterjoin(list1, list2))
 
+    def resolvesplit(self, makefile, variables, setting):
+        list1 = list(self._arguments[0].resolvesplit(makefile, variables, setting))
+        list2 = list(self._arguments[1].resolvesplit(makefile, variables, setting))
+
+        return list(self.iterjoin(list1, list2))
+
 class WildcardFunction(Function):
     name = 'wildcard'
     minargs = 1
@@ -561,7 +783,7 @@ class RealpathFunction(Function):
     maxargs = 1
 
     def resolve(self, makefile, variables, fd, setting):
-        fd.write(' '.join([os.path.realpath(os.path.join(makefile.workdir, path)).replace('\\', '/')
+        fd.write(' '.join([util.realpath(util.normaljoin(makefile.workdir, path)).replace('\\', '/')
                            for path in self._arguments[0].resolvesplit(makefile, variables, setting)]))
 
     def is_filesystem_dependent(self):
@@ -576,13 +798,14 @@ class AbspathFunction(Function):
 
     def resolve(self, makefile, variables, fd, setting):
         assert os.path.isabs(makefile.workdir)
-        fd.write(' '.join([util.normaljoin(makefile.workdir, path).replace('\\', '/')
+        fd.write(' '.join([util.slashjoin(makefile.workdir, path)
                            for path in self._arguments[0].resolvesplit(makefile, variables, setting)]))
 
 class IfFunction(Function):
     name = 'if'
     minargs = 1
     maxargs = 3
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -599,10 +822,20 @@ class IfFunction(Function):
         elif len(self._arguments) > 2:
             return self._arguments[2].resolve(makefile, variables, fd, setting)
 
+    def resolvesplit(self, makefile, variables, setting):
+        condition = self._arguments[0].resolvestr(makefile, variables, setting)
+
+        if len(condition):
+            return self._arguments[1].resolvesplit(makefile, variables, setting)
+        elif len(self._arguments) > 2:
+            return self._arguments[2].resolvesplit(makefile, variables, setting)
+        return []
+
 class OrFunction(Function):
     name = 'or'
     minargs = 1
     maxargs = 0
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -617,6 +850,7 @@ class AndFunction(Function):
     name = 'and'
     minargs = 1
     maxargs = 0
+    pure = True
 
     __slots__ = Function.__slots__
 
@@ -641,7 +875,7 @@ class ForEachFunction(Function):
         vname = self._arguments[0].resolvestr(makefile, variables, setting)
         e = self._arguments[2]
 
-        v = data.Variables(parent=variables)
+        v = data.ParameterScope(parent=variables)
         firstword = True
 
         for w in self._arguments[1].resolvesplit(makefile, variables, setting):
@@ -650,13 +884,22 @@ class ForEachFunction(Function):
             else:
                 fd.write(' ')
 
-            # The $(origin) of the local variable must be "automatic" to
-            # conform with GNU make. However, automatic variables have low
-            # priority. So, we must force its assignment to occur.
-            v.set(vname, data.Variables.FLAVOR_SIMPLE,
-                    data.Variables.SOURCE_AUTOMATIC, w, force=True)
+            v.bind(vname, w)
             e.resolve(makefile, v, fd, setting)
 
+    def resolvesplit(self, makefile, variables, setting):
+        vname = self._arguments[0].resolvestr(makefile, variables, setting)
+        e = self._arguments[2]
+
+        v = data.ParameterScope(parent=variables)
+        words = []
+
+        for w in self._arguments[1].resolvesplit(makefile, variables, setting):
+            v.bind(vname, w)
+            words.extend(e.resolvesplit(makefile, v, setting))
+
+        return words
+
 class CallFunction(Function):
     name = 'call'
     minargs = 1
@@ -669,11 +912,10 @@ class CallFunction(Function):
         if vname in setting:
             raise errors.DataError("Recursively setting variable '%s'" % (vname,))
 
-        v = data.Variables(parent=variables)
-        v.set('0', data.Variables.FLAVOR_SIMPLE, data.Variables.SOURCE_AUTOMATIC, vname)
+        v = data.ParameterScope(parent=variables)
+        v.bind('0', vname)
         for i in range(1, len(self._arguments)):
-            param = self._arguments[i].resolvestr(makefile, variables, setting)
-            v.set(str(i), data.Variables.FLAVOR_SIMPLE, data.Variables.SOURCE_AUTOMATIC, param)
+            v.bind(str(i), self._arguments[i].resolvestr(makefile, variables, setting))
 
         flavor, source, e = variables.get(vname)
 
@@ -684,7 +926,7 @@ class CallFunction(Function):
             log.warning("%s: calling variable '%s' which is simply-expanded" % (self.loc, vname))
 
         # but we'll do it anyway
-        e.resolve(makefile, v, fd, setting + [vname])
+        e.resolve(makefile, v, fd, data.RecursionGuard(vname, setting))
 
 class ValueFunction(Function):
     name = 'value'
@@ -711,8 +953,11 @@ class EvalFunction(Function):
             # command execution. This seems really dumb to me, so I don't!
             raise errors.DataError("$(eval) not allowed via recursive expansion after parsing is finished", self.loc)
 
-        stmts = parser.parsestring(self._arguments[0].resolvestr(makefile, variables, setting),
-                                   'evaluation from %s' % self.loc)
+        if evaltemplates.evaluate(self, makefile, variables, setting):
+            return
+
+        stmts = parser.parseeval(self._arguments[0].resolvestr(makefile, variables, setting),
+                                 'evaluation from %s' % self.loc)
         stmts.execute(makefile)
 
 class OriginFunction(Function):
@@ -763,6 +1008,19 @@ class FlavorFunction(Function):
             r = 'simple'
         fd.write(r)
 
+_shellcache = None
+
+def setshellcache(cache):
+    """
+    Reuse the results of $(shell) commands through the given shellcache.ShellCache.
+    Pass None to run every command.
+    """
+    global _shellcache
+    _shellcache = cache
+
+def getshellcache():
+    return _shellcache
+
 class ShellFunction(Function):
     name = 'shell'
     minargs = 1
@@ -771,10 +1029,47 @@ class ShellFunction(Function):
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
-        from process import prepare_command
+        from process import prepare_command, getcoprocess
         cline = self._arguments[0].resolvestr(makefile, variables, setting)
         executable, cline = prepare_command(cline, makefile.workdir, self.loc)
 
+        # Only the results of commands marked as cacheable are reused, see shellcache
+        cache = _shellcache
+        if cache is not None:
+            cachekey = variables.resolvestr('.SHELL_CACHE_KEY', makefile, setting)
+            if cachekey is None or cachekey.strip() == '':
+                cache = None
+        if cache is not None:
+            key = cache.getkey(executable, cline, makefile.workdir, makefile.env, cachekey)
+            stdout = cache.get(key)
+            if stdout is not None:
+                log.debug("%s: reusing the output of command '%s'", self.loc, ' '.join(cline))
+                fd.write(stdout)
+                return
+
+        stdout = None
+        coprocess = getcoprocess(makefile.env)
+        if coprocess is not None:
+            stdout = coprocess.run(executable, cline, makefile.workdir, self.loc)
+        if stdout is None:
+            stdout = self._spawn(makefile, executable, cline)
+            if stdout is None:
+                return
+
+        # The command may have changed symbolic links
+        util.invalidaterealpaths()
+
+        stdout = stdout.replace('\r\n', '\n')
+        if stdout.endswith('\n'):
+            stdout = stdout[:-1]
+        stdout = stdout.replace('\n', ' ')
+
+        if cache is not None:
+            cache.put(key, stdout)
+
+        fd.write(stdout)
+
+    def _spawn(self, makefile, executable, cline):
         # subprocess.Popen doesn't use the PATH set in the env argument for
         # finding the executable on some platforms (but strangely it does on
         # others!), so set os.environ['PATH'] explicitly.
@@ -782,23 +1077,18 @@ class ShellFunction(Function):
         if makefile.env is not None and 'PATH' in makefile.env:
             os.environ['PATH'] = makefile.env['PATH']
 
-        log.debug("%s: running command '%s'" % (self.loc, ' '.join(cline)))
+        log.debug("%s: running command '%s'", self.loc, ' '.join(cline))
         try:
             p = subprocess.Popen(cline, executable=executable, env=makefile.env, shell=False,
                                  stdout=subprocess.PIPE, cwd=makefile.workdir)
         except OSError as e:
             print("Error executing command %s" % cline[0], e, file=sys.stderr)
-            return
+            return None
         finally:
             os.environ['PATH'] = oldpath
 
         stdout, stderr = p.communicate()
-        stdout = stdout.replace('\r\n', '\n')
-        if stdout.endswith('\n'):
-            stdout = stdout[:-1]
-        stdout = stdout.replace('\n', ' ')
-
-        fd.write(stdout)
+        return stdout
 
 class ErrorFunction(Function):
     name = 'error'
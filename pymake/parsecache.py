@@ -0,0 +1,203 @@
+"""
+A persistent, on-disk cache of parsed makefiles.
+
+Each separate make.py process keeps its own in-memory cache of parsed makefiles (see
+parser.parsefile), but a recursive build runs many processes which all parse the same
+shared makefiles. This cache stores the parsed parserdata.StatementList for a makefile
+in a directory shared between processes, so only the first process has to parse it.
+
+Each entry is a file containing two pickles: a small header identifying the source file
+(path, size, mtime) and the pymake version which parsed it, and the statement list
+itself. The header is checked before the statement list is loaded, so stale entries are
+cheap to reject. Stale or corrupt entries are discarded and the makefile is parsed again.
+
+The total size of the cache directory is bounded: when an entry is written and the cache
+is over its size limit, the least-recently-used entries are evicted.
+"""
+
+import os, sys, logging, hashlib, tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_log = logging.getLogger('pymake.parser')
+
+# Bump this when the layout of a cache entry changes.
+_FORMAT = 1
+
+# The modules whose classes are stored in cache entries. A change to any of them
+# invalidates the entire cache.
+_MODULES = ('data', 'functions', 'parser', 'parserdata', 'parsecache')
+
+_SUFFIX = '.pmc'
+
+DEFAULT_MAXSIZE = 64 * 1024 * 1024
+
+_version = None
+def getversion():
+    """
+    Return a key identifying this version of pymake. pymake doesn't have release
+    numbers, so we fingerprint the modules which define the parsed data structures.
+    """
+    global _version
+    if _version is None:
+        moddir = os.path.dirname(os.path.abspath(__file__))
+        fingerprint = [_FORMAT, sys.version_info[:2]]
+        for m in _MODULES:
+            try:
+                st = os.stat(os.path.join(moddir, m + '.py'))
+                fingerprint.append((m, st.st_size, st.st_mtime))
+            except OSError:
+                fingerprint.append((m, None, None))
+        _version = tuple(fingerprint)
+    return _version
+
+def _entryname(path):
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return hashlib.sha1(path).hexdigest() + _SUFFIX
+
+class ParseCache(object):
+    """
+    A directory of parsed makefiles, shared between processes.
+
+    @param cachedir the directory in which to store entries. It is created if necessary.
+    @param maxsize the maximum total size of the cache entries, in bytes. 0 means unlimited.
+    """
+
+    def __init__(self, cachedir, maxsize=DEFAULT_MAXSIZE):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # Another process may have created it first.
+                if not os.path.isdir(cachedir):
+                    raise
+
+    def _entrypath(self, path):
+        return os.path.join(self.cachedir, _entryname(path))
+
+    @staticmethod
+    def _header(path, st):
+        return (getversion(), path, st.st_size, st.st_mtime)
+
+    def load(self, path, st):
+        """
+        Load the statements for the makefile at `path`, whose current os.stat result is `st`.
+        Returns None if there is no valid entry.
+        """
+        entrypath = self._entrypath(path)
+        try:
+            fd = open(entrypath, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            try:
+                header = pickle.load(fd)
+                if header != self._header(path, st):
+                    _log.debug("Parse cache entry for '%s' is stale", path)
+                    stmts = None
+                else:
+                    stmts = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception as e:
+            _log.debug("Discarding corrupt parse cache entry for '%s': %s", path, e)
+            self._remove(entrypath)
+            stmts = None
+
+        if stmts is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        _log.debug("Loaded '%s' from parse cache", path)
+
+        # Track recent use for eviction.
+        try:
+            os.utime(entrypath, None)
+        except OSError:
+            pass
+
+        return stmts
+
+    def store(self, path, st, stmts):
+        """
+        Save the parsed statements for the makefile at `path`. Errors writing the cache are
+        not fatal: they are logged and ignored.
+        """
+        temppath = None
+        try:
+            fdno, temppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+            fd = os.fdopen(fdno, 'wb')
+            try:
+                pickle.dump(self._header(path, st), fd, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(stmts, fd, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+
+            entrypath = self._entrypath(path)
+            try:
+                os.rename(temppath, entrypath)
+            except OSError:
+                # Windows can't rename over an existing file.
+                self._remove(entrypath)
+                os.rename(temppath, entrypath)
+        except (EnvironmentError, pickle.PicklingError) as e:
+            _log.warning("Unable to write parse cache entry for '%s': %s", path, e)
+            if temppath is not None:
+                self._remove(temppath)
+            return
+
+        if self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least-recently-used entries until the cache is within its size limit.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cachedir):
+            if not name.endswith(_SUFFIX):
+                continue
+
+            entrypath = os.path.join(self.cachedir, name)
+            try:
+                st = os.stat(entrypath)
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, entrypath))
+            total += st.st_size
+
+        if total <= self.maxsize:
+            return
+
+        entries.sort()
+        for mtime, size, entrypath in entries:
+            if total <= self.maxsize:
+                break
+
+            _log.debug("Evicting parse cache entry %s", entrypath)
+            self._remove(entrypath)
+            self.evictions += 1
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -17,23 +17,14 @@ Otherwise, they are parsed as makefile syntax.
 This file parses into the data structures defined in the parserdata module. Those classes are what actually
 do the dirty work of "executing" the parsed data into a data.Makefile.
 
-Four iterator functions are available:
-* iterdata
-* itermakefilechars
-* itercommandchars
-
-The iterators handle line continuations and comments in different ways, but share a common calling
-convention:
-
-Called with (data, startoffset, tokenlist, finditer)
-
-yield 4-tuples (flatstr, token, tokenoffset, afteroffset)
-flatstr is data, guaranteed to have no tokens (may be '')
-token, tokenoffset, afteroffset *may be None*. That means there is more text
-coming.
+parsemakesyntax walks the token stream of a line (Data.gettokens), treating line continuations and
+comments according to one of three modes:
+* iterdata: flat data without line continuations, comments, or any special escaped characters
+* itermakefilechars: makefile syntax
+* itercommandchars: command syntax
 """
 
-import logging, re, os, sys
+import logging, re, os, sys, bisect, collections
 import data, functions, util, parserdata
 from pymake import errors
 
@@ -46,17 +37,18 @@ class Data(object):
     continuations.
     """
 
-    __slots__ = ('s', 'lstart', 'lend', 'loc')
+    __slots__ = ('s', 'lstart', 'lend', 'loc', 'tokens')
 
     def __init__(self, s, lstart, lend, loc):
         self.s = s
         self.lstart = lstart
         self.lend = lend
         self.loc = loc
+        self.tokens = None
 
     @staticmethod
     def fromstring(s, path):
-        return Data(s, 0, len(s), parserdata.Location(path, 1, 0))
+        return Data(s, 0, len(s), parserdata.Source(path, s).location(0))
 
     def getloc(self, offset):
         assert offset >= self.lstart and offset <= self.lend
@@ -73,31 +65,81 @@ class Data(object):
 
         return m.start(0)
 
+    def gettokens(self, offset):
+        """
+        Return the tokens in this line as a list of (start, end, token) tuples, and the index of the
+        first token at or after offset. The line is only scanned once: later calls share the list.
+        """
+        tokens = self.tokens
+        if tokens is None:
+            tokens = self.tokens = [m.span() + (m.group(),)
+                                    for m in _alltokens.finditer(self.s, self.lstart, self.lend)]
+
+        i = bisect.bisect_left(tokens, (offset,))
+        if i > 0 and tokens[i - 1][1] > offset:
+            # offset is in the middle of a token: scanning from here may find different tokens
+            return [m.span() + (m.group(),)
+                    for m in _alltokens.finditer(self.s, offset, self.lend)], 0
+
+        return tokens, i
+
 _linere = re.compile(r'\\*\n')
-def enumeratelines(s, filename):
+def enumeratelines(s, filename, lineno=1, start=0, base=None):
     """
     Enumerate lines in a string as Data objects, joining line
-    continuations.
+    continuations. `start` is the offset of the line to start at. `base` is
+    the location `s` was taken from, if any, see parserdata.Source.
+    """
+
+    source = parserdata.Source(filename, s, lineno, base=base)
+
+    try:
+        off = start
+        for m in _linere.finditer(s, start):
+            start, end = m.span(0)
+
+            if (start - end) % 2 == 0:
+                # odd number of backslashes is a continuation
+                continue
+
+            yield Data(s, off, end - 1, source.location(off))
+
+            off = end
+
+        yield Data(s, off, len(s), source.location(off))
+    finally:
+        # Also when parsing stops early, see _reparse
+        source.release()
+
+def enumeratefilelines(fd, filename):
+    """
+    Enumerate lines read from a file object as Data objects, joining line
+    continuations. Unlike enumeratelines, the file is read incrementally.
     """
 
-    off = 0
     lineno = 1
     curlines = 0
-    for m in _linere.finditer(s):
+    pending = []
+    for line in fd:
+        pending.append(line)
+        if line[-1:] != '\n':
+            break
+
         curlines += 1
-        start, end = m.span(0)
 
-        if (start - end) % 2 == 0:
-            # odd number of backslashes is a continuation
+        # odd number of backslashes is a continuation
+        if (len(line) - len(line[:-1].rstrip('\\'))) % 2 == 0:
             continue
 
-        yield Data(s, off, end - 1, parserdata.Location(filename, lineno, 0))
+        s = ''.join(pending)
+        yield Data(s, 0, len(s) - 1, parserdata.Source(filename, s, lineno).location(0))
 
         lineno += curlines
         curlines = 0
-        off = end
+        pending = []
 
-    yield Data(s, off, len(s), parserdata.Location(filename, lineno, 0))
+    s = ''.join(pending)
+    yield Data(s, 0, len(s), parserdata.Source(filename, s, lineno).location(0))
 
 _alltokens = re.compile(r'''\\*\# | # hash mark preceeded by any number of backslashes
                             := |
@@ -108,31 +150,6 @@ _alltokens = re.compile(r'''\\*\# | # hash mark preceeded by any number of backs
                             :(?![\\/]) | # colon followed by anything except a slash (Windows path detection)
                             [=#{}();,|'"]''' % '|'.join(functions.functionmap.keys()), re.VERBOSE)
 
-def iterdata(d, offset, tokenlist, it):
-    """
-    Iterate over flat data without line continuations, comments, or any special escaped characters.
-
-    Typically used to parse recursively-expanded variables.
-    """
-
-    assert len(tokenlist), "Empty tokenlist passed to iterdata is meaningless!"
-    assert offset >= d.lstart and offset <= d.lend, "offset %i should be between %i and %i" % (offset, d.lstart, d.lend)
-
-    if offset == d.lend:
-        return
-
-    s = d.s
-    for m in it:
-        mstart, mend = m.span(0)
-        token = s[mstart:mend]
-        if token in tokenlist or (token[0] == '$' and '$' in tokenlist):
-            yield s[offset:mstart], token, mstart, mend
-        else:
-            yield s[offset:mend], None, None, mend
-        offset = mend
-
-    yield s[offset:d.lend], None, None, None
-
 # multiple backslashes before a newline are unescaped, halving their total number
 _makecontinuations = re.compile(r'(?:\s*|((?:\\\\)+))\\\n\s*')
 def _replacemakecontinuations(m):
@@ -141,41 +158,6 @@ def _replacemakecontinuations(m):
         return ' '
     return ' '.rjust((end - start) // 2 + 1, '\\')
 
-def itermakefilechars(d, offset, tokenlist, it, ignorecomments=False):
-    """
-    Iterate over data in makefile syntax. Comments are found at unescaped # characters, and escaped newlines
-    are converted to single-space continuations.
-    """
-
-    assert offset >= d.lstart and offset <= d.lend, "offset %i should be between %i and %i" % (offset, d.lstart, d.lend)
-
-    if offset == d.lend:
-        return
-
-    s = d.s
-    for m in it:
-        mstart, mend = m.span(0)
-        token = s[mstart:mend]
-
-        starttext = _makecontinuations.sub(_replacemakecontinuations, s[offset:mstart])
-
-        if token[-1] == '#' and not ignorecomments:
-            l = mend - mstart
-            # multiple backslashes before a hash are unescaped, halving their total number
-            if l % 2:
-                # found a comment
-                yield starttext + token[:(l - 1) // 2], None, None, None
-                return
-            else:
-                yield starttext + token[-l // 2:], None, None, mend
-        elif token in tokenlist or (token[0] == '$' and '$' in tokenlist):
-            yield starttext, token, mstart, mend
-        else:
-            yield starttext + token, None, None, mend
-        offset = mend
-
-    yield _makecontinuations.sub(_replacemakecontinuations, s[offset:d.lend]), None, None, None
-
 _findcomment = re.compile(r'\\*\#')
 def flattenmakesyntax(d, offset):
     """
@@ -206,31 +188,6 @@ def flattenmakesyntax(d, offset):
     elements.append(s[offset:])
     return ''.join(elements)
 
-def itercommandchars(d, offset, tokenlist, it):
-    """
-    Iterate over command syntax. # comment markers are not special, and escaped newlines are included
-    in the output text.
-    """
-
-    assert offset >= d.lstart and offset <= d.lend, "offset %i should be between %i and %i" % (offset, d.lstart, d.lend)
-
-    if offset == d.lend:
-        return
-
-    s = d.s
-    for m in it:
-        mstart, mend = m.span(0)
-        token = s[mstart:mend]
-        starttext = s[offset:mstart].replace('\n\t', '\n')
-
-        if token in tokenlist or (token[0] == '$' and '$' in tokenlist):
-            yield starttext, token, mstart, mend
-        else:
-            yield starttext + token, None, None, mend
-        offset = mend
-
-    yield s[offset:d.lend].replace('\n\t', '\n'), None, None, None
-
 _redefines = re.compile('\s*define|\s*endef')
 def iterdefinelines(it, startloc):
     """
@@ -344,11 +301,224 @@ _directivesre = re.compile(r'(%s)(?:$|\s+)' % '|'.join(_directivestokenlist))
 
 _varsettokens = (':=', '+=', '?=', '=')
 
-def _parsefile(pathname):
+# Whether the branches of conditional blocks are parsed only when they are used
+_lazyconditions = False
+
+def setlazyconditions(enabled):
+    """
+    Parse the branches of conditional blocks lazily. The structure of each block is still read
+    and checked immediately, so unbalanced conditionals are reported at parse time, but the
+    statements in a branch are only parsed the first time the branch is executed or inspected.
+    Errors in the statements of a branch which is never used are not reported.
+    """
+    global _lazyconditions
+    _lazyconditions = enabled
+
+# Whether identical function calls and variable references are shared between parsed makefiles
+_interning = False
+
+def setinterning(enabled):
+    """
+    Share structurally identical function calls and variable references, and their arguments,
+    between everything parsed while interning is enabled (see data.internnode). This saves a lot
+    of memory when many similar makefiles are held at once. A shared node keeps the location of
+    its first occurrence, so errors it reports may point at an identical fragment elsewhere.
+    """
+    global _interning
+    _interning = enabled
+
+# Whether pure functions with static arguments are replaced by their results
+_folding = False
+
+def setfolding(enabled):
+    """
+    Evaluate calls of pure functions, such as $(subst) or $(addprefix), whose arguments are
+    static strings while parsing, and keep the result in place of the call (see
+    functions.Function.fold). Nested calls are folded first, so their results may make the
+    calls around them static too. Folded calls no longer appear in the parsed statements.
+    """
+    global _folding
+    _folding = enabled
+
+def _intern(fn):
+    if not _interning:
+        return fn
+
+    fn.internarguments()
+    return data.internnode(fn)
+
+def _findtoken(d, offset, stopon):
+    """
+    Find the first of the tokens in stopon outside of any variable reference or function call, as
+    parsemakesyntax(d, offset, stopon, itermakefilechars) would, but without building expansions.
+    Returns the token and the offset after it, or (None, None).
+    """
+
+    tokens, i = d.gettokens(offset)
+    braces = []
+    for tokenoffset, offset, token in tokens[i:]:
+        if token[-1] == '#':
+            if (offset - tokenoffset) % 2:
+                break
+        elif token[0] == '$':
+            if tokenoffset + 1 == d.lend:
+                break
+            c = token[1]
+            if c in ('(', '{'):
+                braces.append((c, _matchingbrace[c]))
+        elif braces:
+            openbrace, closebrace = braces[-1]
+            if token == openbrace:
+                braces.append(braces[-1])
+            elif token == closebrace:
+                braces.pop()
+        elif token in stopon:
+            return token, offset
+
+    return None, None
+
+def _classifyline(d, offset, currule):
+    """
+    Return whether the makefile syntax line d (not a directive) leaves the parser inside a rule,
+    whose commands follow.
+    """
+
+    token, offset = _findtoken(d, offset, _varsettokens + ('::', ':'))
+    if token is None:
+        return currule
+
+    if token in _varsettokens:
+        return False
+
+    token, offset = _findtoken(d, offset, _varsettokens + (':', '|', ';'))
+    return token not in _varsettokens
+
+def _recordlines(fdlines, lines):
+    for d in fdlines:
+        lines.append(d)
+        yield d
+
+def _unparsedbranch(lines, currule):
+    if not len(lines):
+        return parserdata.StatementList()
+
+    source = '\n'.join([d.s[d.lstart:d.lend] for d in lines])
+    return parserdata.UnparsedStatements(source, lines[0].loc, currule)
+
+def _scanconditionblock(cb, fdlines, currule):
+    """
+    Read the branches of the ConditionBlock cb up to its endif without parsing their statements,
+    adding them to cb as parserdata.UnparsedStatements. Conditions and the nesting of directives
+    are checked. Returns whether the parser is inside a rule after the block.
+    """
+
+    depth = 0
+    lines = []
+    branchcurrule = currule
+    for d in fdlines:
+        offset = d.lstart
+        if currule and offset < d.lend and d.s[offset] == '\t':
+            lines.append(d)
+            continue
+
+        offset = d.skipwhitespace(offset)
+        m = _directivesre.match(d.s, offset, d.lend)
+        if m is None:
+            currule = _classifyline(d, offset, currule)
+            lines.append(d)
+            continue
+
+        kword = m.group(1)
+        offset = m.end(0)
+
+        if kword in _conditionkeywords:
+            depth += 1
+        elif kword == 'endif':
+            if depth == 0:
+                _ensureend(d, offset, "Unexpected data after 'endif' directive")
+                cb.setstatements(_unparsedbranch(lines, branchcurrule))
+                cb.endloc = d.getloc(offset)
+                return currule
+
+            depth -= 1
+        elif kword == 'else':
+            if depth == 0:
+                cb.setstatements(_unparsedbranch(lines, branchcurrule))
+                cb.addcondition(*_elsecondition(d, offset))
+                lines = []
+                branchcurrule = currule
+                continue
+        elif kword == 'endef':
+            raise errors.SyntaxError("endef without matching define", d.getloc(offset))
+        elif kword == 'define':
+            currule = False
+            lines.append(d)
+            iterdefinelines(_recordlines(fdlines, lines), d.getloc(d.lstart))
+            continue
+        elif kword != 'unexport':
+            currule = False
+
+        lines.append(d)
+
+    raise errors.SyntaxError("Condition never terminated with endif", cb.loc)
+
+def _elsecondition(d, offset):
+    """
+    Parse the remainder of an else directive, returning the location and condition of the branch.
+    """
+
+    m = _conditionre.match(d.s, offset, d.lend)
+    if m is None:
+        _ensureend(d, offset, "Unexpected data after 'else' directive.")
+        return d.getloc(offset), parserdata.ElseCondition()
+
+    kword = m.group(1)
+    if kword not in _conditionkeywords:
+        raise errors.SyntaxError("Unexpected condition after 'else' directive.",
+                          d.getloc(offset))
+
+    startoffset = offset
+    offset = d.skipwhitespace(m.end(1))
+    return d.getloc(startoffset), _conditionkeywords[kword](d, offset)
+
+# A parsecache.ParseCache shared with other processes, if any
+_diskcache = None
+
+def setdiskcache(cache):
+    """
+    Share parsed makefiles with other processes through the given parsecache.ParseCache.
+    Pass None to stop using a persistent cache.
+    """
+    global _diskcache
+    _diskcache = cache
+
+def getdiskcache():
+    return _diskcache
+
+def _parsefile(pathname, stale=None):
+    """
+    Parse a makefile. If it was parsed before into `stale` and has changed since, only the
+    statements from the lines which changed are parsed again.
+    """
     fd = open(pathname, "rU")
-    stmts = parsestring(fd.read(), pathname)
-    stmts.mtime = os.fstat(fd.fileno()).st_mtime
-    fd.close()
+    try:
+        st = os.fstat(fd.fileno())
+
+        stmts = None
+        if _diskcache is not None:
+            stmts = _diskcache.load(pathname, st)
+
+        if stmts is None:
+            if stale is None:
+                stmts = _parsesegments(fd.read(), pathname)
+            else:
+                stmts = _reparse(stale, fd.read(), pathname)
+            if _diskcache is not None:
+                _diskcache.store(pathname, st, stmts)
+    finally:
+        fd.close()
+
+    stmts.mtime = st.st_mtime
     return stmts
 
 def _checktime(path, stmts):
@@ -359,77 +529,478 @@ def _checktime(path, stmts):
 
     return True
 
-_parsecache = util.MostUsedCache(50, _parsefile, _checktime)
+def _sourcesize(path, stmts):
+    # Parsed makefiles take memory roughly in proportion to the size of their source.
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# The parsed makefiles kept in memory, bounded by the total size of their source
+PARSECACHE_SIZE = 8 * 1024 * 1024
+
+# Least frequently used makefiles are evicted first. Submakes of a recursive build run in this
+# process, and each of them includes the same shared makefiles (config.mk, rules.mk...) once,
+# while the Makefile of each directory is used by a single submake. In LRU order, a long run of
+# such one-off Makefiles would evict the shared ones between two uses; in LFU order the one-off
+# Makefiles go first, least recently used first. The price is that a makefile used often early
+# on is only evicted once no makefile has been used fewer times, which a single build rarely
+# notices.
+
+_parsecache = util.LFUCache(PARSECACHE_SIZE, _parsefile, _checktime, _sourcesize, _parsefile)
 
 def parsefile(pathname):
     """
     Parse a filename into a parserdata.StatementList. A cache is used to avoid re-parsing
-    makefiles that have already been parsed and have not changed.
+    makefiles that have already been parsed and have not changed, and a cached makefile which
+    has been edited is only re-parsed from the first statement the edit affects to the last. If
+    a persistent cache has been set with setdiskcache, makefiles parsed by other processes are
+    loaded from it.
     """
 
-    pathname = os.path.realpath(pathname)
+    pathname = util.realpath(pathname)
+
+    result = _prefetched.pop(pathname, None)
+    if result is not None:
+        _collectprefetch(pathname, result)
+
     return _parsecache.get(pathname)
 
+class _LineTracker(object):
+    """
+    Iterates over the Data objects from enumeratelines, keeping track of where the last one ended.
+    """
+    __slots__ = ('lines', 'end', 'source')
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.end = None
+        self.source = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        d = next(self.lines)
+        self.end = min(d.lend + 1, len(d.s))
+        self.source = d.loc.source
+        return d
+
+    __next__ = next
+
+class _Segments(object):
+    """
+    The text of a parsed makefile, divided at the boundaries between its top-level statements,
+    where the parser has no state but whether it is in a rule. Segment i is the text from
+    bounds[i] to bounds[i + 1]: parsing it produced counts[i] statements, whose locations are at
+    srcpos[i] onwards in sources[i]. currules[i] is whether a command line at bounds[i] would
+    belong to the rule before it.
+    """
+    __slots__ = ('text', 'bounds', 'currules', 'counts', 'sources', 'srcpos')
+
+    def __init__(self, text, start, currule):
+        self.text = text
+        self.bounds = [start]
+        self.currules = [currule]
+        self.counts = []
+        self.sources = []
+        self.srcpos = []
+
+    def add(self, end, currule, count, source):
+        self.sources.append(source)
+        self.srcpos.append(self.bounds[-1])
+        self.counts.append(count)
+        self.bounds.append(end)
+        self.currules.append(currule)
+
+def _parsesegments(s, filename, start=0, currule=False, stop=None):
+    """
+    Parse the text of a makefile into a parserdata.StatementList, recording its _Segments.
+    Parsing begins at `start`, which must be a boundary between top-level statements where
+    `currule` was the parser state. If `stop` is given, it is called as stop(offset, currule) at
+    each boundary, and parsing ends at the first one where it returns True.
+    """
+    lines = _LineTracker(enumeratelines(s, filename, start=start))
+    segments = _Segments(s, start, currule)
+    stmts = parserdata.StatementList()
+    counted = [0]
+
+    def boundary(currule):
+        segments.add(lines.end, currule, len(stmts) - counted[0], lines.source)
+        counted[0] = len(stmts)
+        return stop is not None and stop(lines.end, currule)
+
+    for stmt in _iterstatements(lines, currule, boundary):
+        stmts.append(stmt)
+
+    stmts.segments = segments
+    return stmts
+
+def _commonprefix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _commonsuffix(a, b, limit):
+    lo, hi = 0, limit
+    la, lb = len(a), len(b)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _reparse(stale, s, filename):
+    """
+    Parse `s`, the new text of a makefile which was parsed into `stale`. Statements from the
+    segments before and after the changed lines are reused: the new ones are parsed from the
+    last boundary before the change until the parser reaches a boundary after it, in the same
+    state, which was also a boundary in the old text.
+    """
+    old = getattr(stale, 'segments', None)
+    if old is None:
+        return _parsesegments(s, filename)
+    if s == old.text:
+        return stale
+
+    # The changed lines are old.text[start:oldend], and s[start:oldend + delta].
+    p = _commonprefix(old.text, s)
+    p = old.text.rfind('\n', 0, p) + 1
+    oldend = len(old.text) - _commonsuffix(old.text, s, min(len(old.text), len(s)) - p)
+    if oldend > 0 and old.text[oldend - 1] != '\n':
+        oldend = old.text.find('\n', oldend)
+        oldend = len(old.text) if oldend == -1 else oldend + 1
+    delta = len(s) - len(old.text)
+
+    # Start before the boundary at the change too, in case the line ending there was continued.
+    i = max(bisect.bisect_left(old.bounds, p) - 1, 0)
+    start = old.bounds[i]
+    resumed = []
+
+    def stop(offset, currule):
+        if offset < oldend + delta:
+            return False
+        j = bisect.bisect_left(old.bounds, offset - delta)
+        if j == len(old.bounds) or old.bounds[j] != offset - delta or old.currules[j] != currule:
+            return False
+        resumed.append(j)
+        return True
+
+    new = _parsesegments(s, filename, start, old.currules[i], stop)
+    segments = new.segments
+
+    stmts = parserdata.StatementList(stale[:sum(old.counts[:i])])
+    stmts.extend(new)
+    stmts.segments = segments
+
+    segments.bounds[0:0] = old.bounds[:i]
+    segments.currules[0:0] = old.currules[:i]
+    segments.counts[0:0] = old.counts[:i]
+    segments.sources[0:0] = old.sources[:i]
+    segments.srcpos[0:0] = old.srcpos[:i]
+
+    if len(resumed):
+        j, = resumed
+        count = sum(old.counts[j:])
+        if count:
+            stmts.extend(stale[-count:])
+
+        segments.bounds.extend([b + delta for b in old.bounds[j + 1:]])
+        segments.currules.extend(old.currules[j + 1:])
+        segments.counts.extend(old.counts[j:])
+        segments.sources.extend(old.sources[j:])
+        segments.srcpos.extend(old.srcpos[j:])
+
+        # Move the locations of the reused statements to their new lines.
+        lines = s.count('\n', start, old.bounds[j] + delta) - old.text.count('\n', start, old.bounds[j])
+        if lines:
+            shifted = set()
+            for source, pos in zip(old.sources[j:], old.srcpos[j:]):
+                if source not in shifted:
+                    source.shiftlines(pos, lines)
+                    shifted.add(source)
+        end = old.bounds[j] + delta
+    else:
+        end = len(s)
+
+    _log.debug("Re-parsed makefile '%s' from line %i to line %i", filename,
+               s.count('\n', 0, start) + 1, s.count('\n', 0, end))
+    return stmts
+
+# Parses started by prefetch which haven't been collected yet: realpath -> AsyncResult
+_prefetched = {}
+
+# $(MAKE) -C dir, where dir is a literal directory name
+_submakedir = re.compile(r'\s-C\s*([^\s$]+)(?:\s|$)')
+
+def _staticstring(exp):
+    if isinstance(exp, data.StringExpansion):
+        return exp.s
+    if not exp.is_static_string:
+        return None
+    return ''.join(s for s, isfunc in exp)
+
+def _iterstatictree(stmts):
+    """
+    Yield the statements of a statement list, descending into conditional branches which
+    have already been parsed.
+    """
+    for s in stmts:
+        if isinstance(s, parserdata.ConditionBlock):
+            for c, branch in s._groups:
+                if isinstance(branch, parserdata.StatementList):
+                    for s2 in _iterstatictree(branch):
+                        yield s2
+        else:
+            yield s
+
+def _iterprefetchpaths(stmts, workdir):
+    """
+    Find the makefiles which `stmts` are likely to need: yields (path, submake) for the
+    includes with literal file names, and for the Makefile of each directory named by
+    `$(MAKE) -C dir` in a recipe.
+    """
+    for s in _iterstatictree(stmts):
+        if isinstance(s, parserdata.Include):
+            if s.weak:
+                continue
+            paths = _staticstring(s.exp)
+            if paths is None:
+                continue
+            for path in paths.split():
+                if data.Makefile._globcheck.search(path) is None:
+                    yield util.normaljoin(workdir, path), False
+        elif isinstance(s, parserdata.Command):
+            exp = s.exp
+            for i in range(0, len(exp) - 1):
+                e, isfunc = exp[i]
+                if not isfunc or not isinstance(e, functions.VariableRef) or \
+                        _staticstring(e.vname) != 'MAKE':
+                    continue
+                e, isfunc = exp[i + 1]
+                if isfunc:
+                    continue
+                m = _submakedir.match(e)
+                if m is not None:
+                    yield util.normaljoin(util.normaljoin(workdir, m.group(1)), 'Makefile'), True
+
+def _prefetchworker(pathname, submake, diskcache):
+    """
+    Parse a makefile in a worker process. Returns (mtime, statementlist), or None if the
+    makefile couldn't be parsed. Makefiles of submakes are only parsed into the persistent
+    cache, where the submake will find them.
+    """
+    setdiskcache(diskcache)
+
+    try:
+        stmts = _parsefile(pathname)
+    except Exception as e:
+        # The main process will parse the file again and report the error, if needed.
+        _log.debug("Unable to prefetch makefile '%s': %s", pathname, e)
+        return None
+
+    if submake:
+        return None
+    return stmts.mtime, stmts
+
+def _collectprefetch(pathname, result):
+    try:
+        r = result.get()
+    except Exception as e:
+        _log.debug("Prefetch of '%s' failed: %s", pathname, e)
+        return
+
+    if r is not None and pathname not in _parsecache:
+        mtime, stmts = r
+        stmts.mtime = mtime
+        _parsecache.put(pathname, stmts)
+
+def prefetch(stmts, workdir, pool):
+    """
+    Start parsing the makefiles that `stmts` include, or whose directories they make
+    recursively, in the given multiprocessing pool: one job for each makefile. parsefile waits
+    for the job of a makefile when it is asked for it, and the includes of that makefile are
+    prefetched in turn when it is included (see data.Makefile.include), so the rest of an
+    include chain is parsed while the main process evaluates the makefiles before it. Makefiles
+    of submakes are only prefetched when there is a persistent cache to store them in (see
+    setdiskcache).
+    """
+    for pathname, submake in _iterprefetchpaths(stmts, workdir):
+        if submake and _diskcache is None:
+            continue
+
+        pathname = util.realpath(pathname)
+        if pathname in _prefetched or pathname in _parsecache:
+            continue
+        if not os.path.isfile(pathname):
+            continue
+
+        _log.debug("Prefetching makefile '%s'", pathname)
+        result = pool.apply_async(_prefetchworker, args=(pathname, submake, _diskcache))
+        if not submake:
+            _prefetched[pathname] = result
+
+try:
+    _internstr = intern
+except NameError:
+    _internstr = sys.intern
+
 # colon followed by anything except a slash (Windows path detection)
 _depfilesplitter = re.compile(r':(?![\\/])')
 # simple variable references
 _vars = re.compile('\$\((\w+)\)')
 
+# a backslash-newline continuation in a dependency file, with any trailing whitespace
+_depcontinuation = re.compile(r'\\+[^\S\n]*(?:\n|\Z)')
+
+def _depexpansion(s):
+    if '$' not in s:
+        return data.StringExpansion(s, None)
+
+    expansion = data.Expansion()
+    # for an input like e.g. "foo $(bar) baz",
+    # _vars.split returns ["foo", "bar", "baz"]
+    # every other element is a variable name.
+    for i, element in enumerate(_vars.split(s)):
+        if i % 2:
+            expansion.appendfunc(functions.VariableRef(None,
+                data.StringExpansion(element, None)))
+        elif element:
+            expansion.appendstr(element)
+
+    return expansion
+
 def parsedepfile(pathname):
     """
     Parse a filename listing only depencencies into a parserdata.StatementList.
     Simple variable references are allowed in such files.
-    """
-    def continuation_iter(lines):
-        current_line = []
-        for line in lines:
-            line = line.rstrip()
-            if line.endswith("\\"):
-                current_line.append(line.rstrip("\\"))
-                continue
-            if not len(line):
-                continue
-            current_line.append(line)
-            yield ''.join(current_line)
-            current_line = []
-        if current_line:
-            yield ''.join(current_line)
-
-    def get_expansion(s):
-        if '$' in s:
-            expansion = data.Expansion()
-            # for an input like e.g. "foo $(bar) baz",
-            # _vars.split returns ["foo", "bar", "baz"]
-            # every other element is a variable name.
-            for i, element in enumerate(_vars.split(s)):
-                if i % 2:
-                    expansion.appendfunc(functions.VariableRef(None,
-                        data.StringExpansion(element, None)))
-                elif element:
-                    expansion.appendstr(element)
-
-            return expansion
 
-        return data.StringExpansion(s, None)
+    Lines without variable references are split into parserdata.Dependencies right away. The
+    words of a dependency file are interned and identical prerequisite lists are shared, since
+    the same headers are listed over and over again.
+    """
+    pathname = util.realpath(pathname)
+    fd = open(pathname)
+    try:
+        s = fd.read()
+    finally:
+        fd.close()
+
+    if s.count('\\') == s.count('\\\n') and '\\\\' not in s:
+        # Only simple continuations: much faster than the regular expression
+        s = s.replace('\\\n', '')
+    else:
+        s = _depcontinuation.sub('', s)
 
-    pathname = os.path.realpath(pathname)
     stmts = parserdata.StatementList()
-    for line in continuation_iter(open(pathname).readlines()):
+    deplists = {}
+    for line in s.split('\n'):
+        if not len(line) or line.isspace():
+            continue
+
         target, deps = _depfilesplitter.split(line, 1)
-        stmts.append(parserdata.Rule(get_expansion(target),
-                                     get_expansion(deps), False))
+        if '$' in line:
+            stmts.append(parserdata.Rule(_depexpansion(target.rstrip()),
+                                         _depexpansion(deps.rstrip()), False))
+            continue
+
+        prerequisites = deplists.get(deps)
+        if prerequisites is None:
+            prerequisites = _depwords(deps)
+            deplists[deps] = prerequisites
+
+        stmts.append(parserdata.Dependencies(_depwords(target), prerequisites))
     return stmts
 
+def _depwords(s):
+    words = s.split()
+    if './' in s:
+        words = data.stripdotslashes(words)
+    return list(map(_internstr, words))
+
 def parsestring(s, filename):
     """
     Parse a string containing makefile data into a parserdata.StatementList.
     """
 
-    currule = False
+    stmts = parserdata.StatementList()
+    stmts.extend(_iterstatements(enumeratelines(s, filename)))
+    return stmts
+
+def _parseevalkey(key):
+    return parsestring(*key)
+
+def _evaltextsize(key, stmts):
+    return len(key[0])
+
+# Statements parsed from $(eval) text, keyed by the text and the name it is parsed under, so
+# that locations in cached statements are the ones a fresh parse would give. Bounded by the
+# total size of the text.
+EVALCACHE_SIZE = 1024 * 1024
+
+evalcache = util.LRUCache(EVALCACHE_SIZE, _parseevalkey, weightfunc=_evaltextsize)
+
+def parseeval(s, filename):
+    """
+    Parse the text of an $(eval) into a parserdata.StatementList, reusing the result of an
+    earlier evaluation of the same text if there is one in evalcache. The statements are shared,
+    so callers must not modify them.
+    """
+    return evalcache.get((s, filename))
+
+def iterparse(fd, filename):
+    """
+    Parse makefile data read incrementally from a file object, yielding top-level statements as
+    soon as they are complete: a ConditionBlock is yielded when its endif has been read. Large
+    makefiles can be processed or executed (see parserdata.executestatements) without holding
+    the whole file or its parsed form in memory.
+    """
+
+    return _iterstatements(enumeratefilelines(fd, filename))
+
+def parsebranch(source, loc, currule):
+    """
+    Parse the source of a conditional branch which was read lazily. See setlazyconditions.
+    """
+
+    # Locations within the branch follow the lines of the text around it, see Source.shiftlines
+    if isinstance(loc, parserdata.OffsetLocation):
+        base = loc
+    else:
+        base = None
+
+    stmts = parserdata.StatementList()
+    stmts.extend(_iterstatements(enumeratelines(source, loc.path, loc.line, base=base), currule))
+    return stmts
+
+def _iterstatements(fdlines, currule=False, boundary=None):
+    """
+    Parse lines into statements. If `boundary` is given, it is called as boundary(currule) after
+    each group of top-level statements has been yielded, and parsing stops if it returns True.
+    """
     condstack = [parserdata.StatementList()]
 
-    fdlines = enumeratelines(s, filename)
-    for d in fdlines:
+    while True: # this is not a for loop so that finished statements are yielded before reading on
+        if len(condstack) == 1 and len(condstack[0]):
+            for stmt in condstack[0]:
+                yield stmt
+            del condstack[0][:]
+
+            if boundary is not None and boundary(currule):
+                return
+
+        try:
+            d = next(fdlines)
+        except StopIteration:
+            break
+
         assert len(condstack) > 0
 
         offset = d.lstart
@@ -468,27 +1039,17 @@ def parsestring(s, filename):
                     raise errors.SyntaxError("unmatched 'else' directive",
                                       d.getloc(offset))
 
-                m = _conditionre.match(d.s, offset, d.lend)
-                if m is None:
-                    _ensureend(d, offset, "Unexpected data after 'else' directive.")
-                    condstack[-1].addcondition(d.getloc(offset), parserdata.ElseCondition())
-                else:
-                    kword = m.group(1)
-                    if kword not in _conditionkeywords:
-                        raise errors.SyntaxError("Unexpected condition after 'else' directive.",
-                                          d.getloc(offset))
-
-                    startoffset = offset
-                    offset = d.skipwhitespace(m.end(1))
-                    c = _conditionkeywords[kword](d, offset)
-                    condstack[-1].addcondition(d.getloc(startoffset), c)
+                condstack[-1].addcondition(*_elsecondition(d, offset))
                 continue
 
             if kword in _conditionkeywords:
                 c = _conditionkeywords[kword](d, offset)
                 cb = parserdata.ConditionBlock(d.getloc(d.lstart), c)
                 condstack[-1].append(cb)
-                condstack.append(cb)
+                if _lazyconditions:
+                    currule = _scanconditionblock(cb, fdlines, currule)
+                else:
+                    condstack.append(cb)
                 continue
 
             if kword == 'endef':
@@ -630,8 +1191,6 @@ def parsestring(s, filename):
     if len(condstack) != 1:
         raise errors.SyntaxError("Condition never terminated with endif", condstack[-1].loc)
 
-    return condstack[0]
-
 _PARSESTATE_TOPLEVEL = 0    # at the top level
 _PARSESTATE_FUNCTION = 1    # expanding a function call
 _PARSESTATE_VARNAME = 2     # expanding a variable expansion.
@@ -660,15 +1219,38 @@ _matchingbrace = {
     '{': '}',
     }
 
-def parsemakesyntax(d, offset, stopon, iterfunc):
+def _flattencommand(s):
+    return s.replace('\n\t', '\n')
+
+def _flattenmakefile(s):
+    if '\n' not in s:
+        return s
+    return _makecontinuations.sub(_replacemakecontinuations, s)
+
+# How parsemakesyntax treats text: (comments, toplevel flatten, nested flatten). The names are
+# those of the iterator functions which once did the same.
+
+# Flat data without line continuations, comments, or any special escaped characters. Typically
+# used to parse recursively-expanded variables.
+iterdata = (False, None, None)
+
+# Makefile syntax: comments are found at unescaped # characters, and escaped newlines are
+# converted to single-space continuations.
+itermakefilechars = (True, _flattenmakefile, _flattenmakefile)
+
+# Command syntax: # comment markers are not special, and escaped newlines are included in the
+# output text.
+itercommandchars = (False, _flattencommand, _flattenmakefile)
+
+def parsemakesyntax(d, offset, stopon, mode):
     """
     Given Data, parse it into a data.Expansion.
 
     @param stopon (sequence)
         Indicate characters where toplevel parsing should stop.
 
-    @param iterfunc (generator function)
-        A function which is used to iterate over d, yielding (char, offset, loc)
+    @param mode
+        Indicates how comments and line continuations are treated:
         @see iterdata
         @see itermakefilechars
         @see itercommandchars
@@ -677,26 +1259,53 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
     token and offset will be None
     """
 
-    assert callable(iterfunc)
+    comments, topflatten, nestedflatten = mode
 
     stacktop = ParseStackFrame(_PARSESTATE_TOPLEVEL, None, data.Expansion(loc=d.getloc(d.lstart)),
                                tokenlist=stopon + ('$',),
                                openbrace=None, closebrace=None)
 
-    tokeniterator = _alltokens.finditer(d.s, offset, d.lend)
+    s = d.s
+    lend = d.lend
+    tokens, i = d.gettokens(offset)
+    ntokens = len(tokens)
+
+    # Text from textstart up to the next interesting token hasn't been added to an expansion yet.
+    textstart = offset
+    flatten = topflatten
 
-    di = iterfunc(d, offset, stacktop.tokenlist, tokeniterator)
-    while True: # this is not a for loop because `di` changes during the function
-        assert stacktop is not None
-        try:
-            s, token, tokenoffset, offset = next(di)
-        except StopIteration:
-            break
+    while i < ntokens:
+        tokenoffset, offset, token = tokens[i]
+        i += 1
 
-        stacktop.expansion.appendstr(s)
-        if token is None:
+        if token[-1] == '#':
+            if not comments:
+                continue
+
+            # multiple backslashes before a hash are unescaped, halving their total number
+            l = offset - tokenoffset
+            text = s[textstart:tokenoffset]
+            if flatten is not None:
+                text = flatten(text)
+            if l % 2:
+                # found a comment
+                stacktop.expansion.appendstr(text + token[:(l - 1) // 2])
+                textstart = lend = tokenoffset
+                break
+
+            stacktop.expansion.appendstr(text + token[-l // 2:])
+            textstart = offset
+            continue
+
+        if token[0] != '$' and token not in stacktop.tokenlist:
             continue
 
+        text = s[textstart:tokenoffset]
+        if flatten is not None:
+            text = flatten(text)
+        stacktop.expansion.appendstr(text)
+        textstart = offset
+
         parsestate = stacktop.parsestate
 
         if token[0] == '$':
@@ -732,8 +1341,8 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
                                                openbrace=c, closebrace=closebrace, loc=loc)
             else:
                 assert len(token) == 2
-                e = data.Expansion.fromstring(c, loc)
-                stacktop.expansion.appendfunc(functions.VariableRef(loc, e))
+                e = data.StringExpansion(c, loc)
+                stacktop.expansion.appendfunc(_intern(functions.VariableRef(loc, e)))
         elif token in ('(', '{'):
             assert token == stacktop.openbrace
 
@@ -763,7 +1372,13 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
                 fn.setup()
                 
                 stacktop = stacktop.parent
-                stacktop.expansion.appendfunc(fn)
+                folded = None
+                if _folding:
+                    folded = fn.fold()
+                if folded is None:
+                    stacktop.expansion.appendfunc(_intern(fn))
+                else:
+                    stacktop.expansion.appendstr(folded)
             else:
                 assert False, "Not reached, _PARSESTATE_FUNCTION"
         elif parsestate == _PARSESTATE_VARNAME:
@@ -775,7 +1390,7 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
             elif token in (')', '}'):
                 fn = functions.VariableRef(stacktop.loc, stacktop.expansion.finish())
                 stacktop = stacktop.parent
-                stacktop.expansion.appendfunc(fn)
+                stacktop.expansion.appendfunc(_intern(fn))
             else:
                 assert False, "Not reached, _PARSESTATE_VARNAME"
         elif parsestate == _PARSESTATE_SUBSTFROM:
@@ -793,7 +1408,7 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
                 stacktop.varname.concat(stacktop.expansion)
                 fn = functions.VariableRef(stacktop.loc, stacktop.varname.finish())
                 stacktop = stacktop.parent
-                stacktop.expansion.appendfunc(fn)
+                stacktop.expansion.appendfunc(_intern(fn))
             else:
                 assert False, "Not reached, _PARSESTATE_SUBSTFROM"
         elif parsestate == _PARSESTATE_SUBSTTO:
@@ -802,18 +1417,22 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
             fn = functions.SubstitutionRef(stacktop.loc, stacktop.varname.finish(),
                                            stacktop.substfrom.finish(), stacktop.expansion.finish())
             stacktop = stacktop.parent
-            stacktop.expansion.appendfunc(fn)
+            stacktop.expansion.appendfunc(_intern(fn))
         else:
             assert False, "Unexpected parse state %s" % stacktop.parsestate
 
-        if stacktop.parent is not None and iterfunc == itercommandchars:
-            di = itermakefilechars(d, offset, stacktop.tokenlist, tokeniterator,
-                                   ignorecomments=True)
+        if stacktop.parent is None:
+            flatten = topflatten
         else:
-            di = iterfunc(d, offset, stacktop.tokenlist, tokeniterator)
+            flatten = nestedflatten
+
+    text = s[textstart:lend]
+    if flatten is not None:
+        text = flatten(text)
+    stacktop.expansion.appendstr(text)
 
     if stacktop.parent is not None:
-        raise errors.SyntaxError("Unterminated function call", d.getloc(offset))
+        raise errors.SyntaxError("Unterminated function call", d.getloc(lend))
 
     assert stacktop.parsestate == _PARSESTATE_TOPLEVEL
 
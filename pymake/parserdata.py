@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-import logging, re, os
+import logging, re, os, bisect, array
 import data, parser, util
 from pymake.globrelative import hasglob, glob
 from pymake import errors
@@ -14,6 +14,40 @@ except ImportError:
 _log = logging.getLogger('pymake.data')
 _tabwidth = 4
 
+def _advancecolumn(s, start, end, column):
+    """
+    Return the column reached from `column` by the text s[start:end], which contains no newlines.
+    """
+    while True:
+        j = s.find('\t', start, end)
+        if j == -1:
+            return column + end - start
+
+        column += j - start
+        column += _tabwidth
+        column -= column % _tabwidth
+        start = j + 1
+
+def _advancetabs(tabs, start, end, column):
+    """
+    _advancecolumn, for a text of which only the sorted offsets of the tabs, `tabs`, are known.
+    """
+    i = bisect.bisect_left(tabs, start)
+    while i < len(tabs) and tabs[i] < end:
+        j = tabs[i]
+        column += j - start
+        column += _tabwidth
+        column -= column % _tabwidth
+        start = j + 1
+        i += 1
+    return column + end - start
+
+def _offsets(s, c):
+    """
+    The offsets of the character `c` in `s`, as a compact array.
+    """
+    return array.array('i', [m.start(0) for m in re.finditer(re.escape(c), s)])
+
 class Location(object):
     """
     A location within a makefile.
@@ -21,6 +55,9 @@ class Location(object):
     For the moment, locations are just path/line/column, but in the future
     they may reference parent locations for more accurate "included from"
     or "evaled at" error reporting.
+
+    Locations created by the parser are OffsetLocations, which compute their line and column
+    only when asked.
     """
     __slots__ = ('path', 'line', 'column')
 
@@ -48,22 +85,144 @@ class Location(object):
         else:
             column = self.column
 
-        while True:
-            j = s.find('\t', start, end)
-            if j == -1:
-                column += end - start
-                break
-
-            column += j - start
-            column += _tabwidth
-            column -= column % _tabwidth
-            start = j + 1
+        return Location(self.path, line, _advancecolumn(s, start, end, column))
 
-        return Location(self.path, line, column)
+    def __reduce__(self):
+        # Pickle compactly: parsed makefiles (see parsecache) contain many locations.
+        return Location, (self.path, self.line, self.column)
 
     def __str__(self):
         return "%s:%s:%s" % (self.path, self.line, self.column)
 
+class Source(object):
+    """
+    The text of a makefile (or of a string being parsed), shared by the OffsetLocations within it.
+    `line` and `column` are the location of the start of the text.
+
+    If the text was taken from another Source, such as a conditional branch which was parsed
+    lazily, `base` is the location of its first line there, and the line it starts at is read
+    from `base`, so that it follows when the enclosing text is shifted.
+
+    Once the text has been parsed, release() drops it: the locations within it may be kept by
+    the parsed statements for much longer.
+    """
+    __slots__ = ('path', 's', 'line', 'column', 'base', '_newlines', '_tabs', '_shifts')
+
+    def __init__(self, path, s, line=1, column=0, base=None):
+        self.path = path
+        self.s = s
+        self.line = line
+        self.column = column
+        self.base = base
+        self._newlines = None
+        self._tabs = None
+        self._shifts = None
+
+    def shiftlines(self, pos, lines):
+        """
+        Move the text from offset `pos` onwards by a number of lines, because lines before it
+        have been added or removed since it was parsed. See parser.parsefile.
+        """
+        if self._shifts is None:
+            self._shifts = []
+        self._shifts.append((pos, lines))
+
+    def location(self, pos):
+        return OffsetLocation(self, pos)
+
+    def release(self):
+        """
+        Drop the text, keeping only the offsets of its newlines and tabs, which are all linecolumn
+        needs.
+        """
+        if self.s is None:
+            return
+
+        if self._newlines is None:
+            self._newlines = _offsets(self.s, '\n')
+        self._tabs = _offsets(self.s, '\t')
+        self.s = None
+
+    def linecolumn(self, pos):
+        """
+        Return the line and column of the offset `pos` in the text.
+        """
+        if self._newlines is None:
+            self._newlines = _offsets(self.s, '\n')
+
+        skiplines = bisect.bisect_left(self._newlines, pos)
+        if skiplines:
+            start = self._newlines[skiplines - 1] + 1
+            column = 0
+        else:
+            start = 0
+            column = self.column
+
+        if self.base is None:
+            line = self.line + skiplines
+        else:
+            line = self.base.line + skiplines
+        if self._shifts is not None:
+            for shiftpos, lines in self._shifts:
+                if pos >= shiftpos:
+                    line += lines
+
+        if self.s is None:
+            return line, _advancetabs(self._tabs, start, pos, column)
+        return line, _advancecolumn(self.s, start, pos, column)
+
+    def __reduce__(self):
+        return Source, (self.path, self.s, self.line, self.column, self.base), (self._newlines, self._tabs, self._shifts)
+
+    def __setstate__(self, state):
+        self._newlines, self._tabs, self._shifts = state
+
+class OffsetLocation(object):
+    """
+    A location given as a Source and an offset into its text. This is much cheaper to create than
+    a Location: the line and column are only worked out when they are used, typically when an
+    error message or debug log is formatted.
+    """
+    __slots__ = ('source', 'pos')
+
+    def __init__(self, source, pos):
+        self.source = source
+        self.pos = pos
+
+    @property
+    def path(self):
+        return self.source.path
+
+    @property
+    def line(self):
+        return self.source.linecolumn(self.pos)[0]
+
+    @property
+    def column(self):
+        return self.source.linecolumn(self.pos)[1]
+
+    def offset(self, s, start, end):
+        """
+        Returns a new location offset by
+        the specified string.
+        """
+
+        if start == end:
+            return self
+
+        if s is self.source.s and start == self.pos:
+            return OffsetLocation(self.source, end)
+
+        line, column = self.source.linecolumn(self.pos)
+        return Location(self.source.path, line, column).offset(s, start, end)
+
+    def __reduce__(self):
+        return OffsetLocation, (self.source, self.pos)
+
+    def __str__(self):
+        line, column = self.source.linecolumn(self.pos)
+        return "%s:%s:%s" % (self.source.path, line, column)
+
 def _expandwildcards(makefile, tlist):
     for t in tlist:
         if not hasglob(t):
@@ -241,6 +400,50 @@ class Rule(Statement):
                 and self.depexp == other.depexp \
                 and self.doublecolon == other.doublecolon
 
+class Dependencies(Statement):
+    """
+    A line of a dependency file (see parser.parsedepfile) which doesn't reference any
+    variables, so its targets and prerequisites were split into lists when it was parsed.
+
+    Dependency files repeat the same prerequisites many times, so `prerequisites` may be
+    shared with other Dependencies and with the rules they create: it must not be modified.
+    """
+    __slots__ = ('targets', 'prerequisites')
+
+    def __init__(self, targets, prerequisites):
+        self.targets = targets
+        self.prerequisites = prerequisites
+
+    def execute(self, makefile, context):
+        if not context.weak:
+            Rule(data.StringExpansion(' '.join(self.targets), None),
+                 data.StringExpansion(' '.join(self.prerequisites), None),
+                 False).execute(makefile, context)
+            return
+
+        # Skip targets with no rules and no dependencies
+        if not self.prerequisites:
+            return
+
+        rule = data.Rule(self.prerequisites, False, loc=None, weakdeps=True)
+        for target in self.targets:
+            makefile.gettarget(target).addrule(rule)
+            makefile.foundtarget(target)
+        context.currule = rule
+
+    def dump(self, fd, indent):
+        print("%sDependencies %s: %s" % (indent, ' '.join(self.targets), ' '.join(self.prerequisites)), file=fd)
+
+    def to_source(self):
+        return '\n%s: %s' % (' '.join(self.targets), ' '.join(self.prerequisites))
+
+    def __eq__(self, other):
+        if not isinstance(other, Dependencies):
+            return False
+
+        return self.targets == other.targets \
+                and self.prerequisites == other.prerequisites
+
 class StaticPatternRule(Statement):
     """
     Static pattern rules are rules which specify multiple targets based on a
@@ -388,7 +591,7 @@ class SetVariable(Statement):
     assignment except the `targetexp` field is set to an Expansion representing
     the target they apply to.
     """
-    __slots__ = ('vnameexp', 'token', 'value', 'valueloc', 'targetexp', 'source')
+    __slots__ = ('vnameexp', 'token', 'value', 'valueloc', 'targetexp', 'source', '_valueexp')
 
     def __init__(self, vnameexp, token, value, valueloc, targetexp, source=None):
         assert isinstance(vnameexp, (data.Expansion, data.StringExpansion))
@@ -405,6 +608,20 @@ class SetVariable(Statement):
         self.targetexp = targetexp
         self.source = source
 
+        # Parsed when the statement is first executed: a malformed value in a branch which is
+        # never taken is not an error.
+        self._valueexp = None
+
+    def getvalueexp(self):
+        """
+        The value parsed into an expansion. This is only done once, however many times the
+        statement is executed.
+        """
+        if self._valueexp is None:
+            d = parser.Data.fromstring(self.value, self.valueloc)
+            self._valueexp, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
+        return self._valueexp
+
     def execute(self, makefile, context):
         vname = self.vnameexp.resolvestr(makefile, makefile.variables)
         if len(vname) == 0:
@@ -422,9 +639,13 @@ class SetVariable(Statement):
                 else:
                     setvariables.append(makefile.gettarget(t.gettarget()).variables)
 
+        # Recursive values are parsed when they're first expanded, if ever.
+        valueexp = self._valueexp
+        if valueexp is None:
+            valueexp = self.getvalueexp
         for v in setvariables:
             if self.token == '+=':
-                v.append(vname, self.source, self.value, makefile.variables, makefile)
+                v.append(vname, self.source, self.value, makefile.variables, makefile, valueexp)
                 continue
 
             if self.token == '?=':
@@ -432,19 +653,16 @@ class SetVariable(Statement):
                 oldflavor, oldsource, oldval = v.get(vname, expand=False)
                 if oldval is not None:
                     continue
-                value = self.value
+                v.set(vname, flavor, self.source, self.value, valueexp=valueexp)
             elif self.token == '=':
                 flavor = data.Variables.FLAVOR_RECURSIVE
-                value = self.value
+                v.set(vname, flavor, self.source, self.value, valueexp=valueexp)
             else:
                 assert self.token == ':='
 
                 flavor = data.Variables.FLAVOR_SIMPLE
-                d = parser.Data.fromstring(self.value, self.valueloc)
-                e, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
-                value = e.resolvestr(makefile, makefile.variables)
-
-            v.set(vname, flavor, self.source, value)
+                value = self.getvalueexp().resolvestr(makefile, makefile.variables)
+                v.set(vname, flavor, self.source, value)
 
     def dump(self, fd, indent):
         print("%sSetVariable<%s> %s %s\n%s %r" % (indent, self.valueloc, self.vnameexp, self.token, indent, self.value), file=fd)
@@ -612,6 +830,21 @@ class ElseCondition(Condition):
     def __eq__(self, other):
         return isinstance(other, ElseCondition)
 
+class UnparsedStatements(object):
+    """
+    The source text of a ConditionBlock branch which hasn't been parsed yet.
+    See parser.setlazyconditions.
+    """
+    __slots__ = ('source', 'loc', 'currule')
+
+    def __init__(self, source, loc, currule):
+        self.source = source
+        self.loc = loc
+        self.currule = currule
+
+    def parse(self):
+        return parser.parsebranch(self.source, self.loc, self.currule)
+
 class ConditionBlock(Statement):
     """
     A set of related Conditions.
@@ -626,6 +859,9 @@ class ConditionBlock(Statement):
 
     ConditionBlock instances may exist within other ConditionBlock if the
     conditional logic is multiple levels deep.
+
+    The statements of a branch may be held as UnparsedStatements, which are
+    parsed when the branch is first executed or inspected.
     """
     __slots__ = ('loc', '_groups')
 
@@ -649,12 +885,25 @@ class ConditionBlock(Statement):
     def append(self, statement):
         self._groups[-1][1].append(statement)
 
+    def setstatements(self, statements):
+        """
+        Replace the statements of the last branch, with a StatementList or UnparsedStatements.
+        """
+        self._groups[-1] = (self._groups[-1][0], statements)
+
+    def _getstatements(self, i):
+        c, statements = self._groups[i]
+        if isinstance(statements, UnparsedStatements):
+            statements = statements.parse()
+            self._groups[i] = (c, statements)
+        return statements
+
     def execute(self, makefile, context):
         i = 0
         for c, statements in self._groups:
             if c.evaluate(makefile):
                 _log.debug("Condition at %s met by clause #%i", self.loc, i)
-                statements.execute(makefile, context)
+                self._getstatements(i).execute(makefile, context)
                 return
 
             i += 1
@@ -663,7 +912,7 @@ class ConditionBlock(Statement):
         print("%sConditionBlock" % (indent,), file=fd)
 
         indent2 = indent + '  '
-        for c, statements in self._groups:
+        for c, statements in self:
             print("%s Condition %s" % (indent, c), file=fd)
             statements.dump(fd, indent2)
             print("%s ~Condition" % (indent,), file=fd)
@@ -770,13 +1019,14 @@ class ConditionBlock(Statement):
                 statement.__class__)
 
     def __iter__(self):
-        return iter(self._groups)
+        for i in range(0, len(self._groups)):
+            yield self[i]
 
     def __len__(self):
         return len(self._groups)
 
     def __getitem__(self, i):
-        return self._groups[i]
+        return self._groups[i][0], self._getstatements(i)
 
 class Include(Statement):
     """
@@ -982,18 +1232,14 @@ class StatementList(list):
     Consumers can iterate over all Statement instances in this collection to
     statically inspect (and even modify) make files before they are executed.
     """
-    __slots__ = ('mtime',)
+    __slots__ = ('mtime', 'segments')
 
     def append(self, statement):
         assert isinstance(statement, Statement)
         list.append(self, statement)
 
     def execute(self, makefile, context=None, weak=False):
-        if context is None:
-            context = _EvalContext(weak=weak)
-
-        for s in self:
-            s.execute(makefile, context)
+        executestatements(self, makefile, context, weak)
 
     def dump(self, fd, indent):
         for s in self:
@@ -1007,6 +1253,17 @@ class StatementList(list):
     def to_source(self):
         return '\n'.join([s.to_source() for s in self])
 
+def executestatements(stmts, makefile, context=None, weak=False):
+    """
+    Execute statements in order. stmts may be any iterable, such as the generator returned by
+    parser.iterparse, so execution can start before the rest of a makefile has been parsed.
+    """
+    if context is None:
+        context = _EvalContext(weak=weak)
+
+    for s in stmts:
+        s.execute(makefile, context)
+
 def iterstatements(stmts):
     for s in stmts:
         yield s
@@ -6,7 +6,7 @@ from __future__ import print_function
 
 #TODO: ship pyprocessing?
 import multiprocessing
-import subprocess, shlex, re, logging, sys, traceback, os, imp, glob
+import subprocess, shlex, re, logging, sys, traceback, os, imp, glob, atexit, binascii
 import site
 from collections import deque
 # XXXkhuey Work around http://bugs.python.org/issue1731717
@@ -277,6 +277,155 @@ def call_native(module, method, argv, env, cwd, loc, cb, context, echo, justprin
     context.call_native(module, method, argv, env=env, cwd=cwd, cb=cb,
                         echo=echo, justprint=justprint, pycommandpath=pycommandpath)
 
+def _shquote(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+class ShellCoprocess(object):
+    """
+    A long-lived shell which runs commands one after another, so that running a command doesn't
+    spawn a process from make.py, and commands which need a shell don't start a new one.
+
+    Each command runs in a subshell, so that it can't change the state of the coprocess, in the
+    given working directory and with its standard input redirected from /dev/null. Commands which
+    don't need a shell are run with exec, bypassing shell builtins and functions as spawning
+    them would. The output of a command is followed by a line holding a marker unique to the
+    coprocess and the exit status of the command.
+    """
+
+    _readsize = 64 * 1024
+
+    def __init__(self, shell, env):
+        self.shell = shell
+        self.marker = '__pymake_%s__' % (binascii.hexlify(os.urandom(8)),)
+        self._sentinel = '\n' + self.marker + ' '
+        self.p = subprocess.Popen([shell, '-s'], env=env, shell=False, close_fds=True,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @property
+    def alive(self):
+        return self.p is not None and self.p.poll() is None
+
+    def run(self, executable, argv, cwd, loc):
+        """
+        Run the command prepared by prepare_command and return its output, or None if the command
+        couldn't be sent to the coprocess.
+        """
+        if not len(argv) or not self.alive:
+            return None
+
+        if executable is None and len(argv) == 3 and argv[0] == self.shell and argv[1] == '-c':
+            script = 'eval ' + _shquote(argv[2])
+        else:
+            if executable is not None:
+                argv = [executable] + argv[1:]
+            script = 'exec ' + ' '.join(_shquote(arg) for arg in argv)
+
+        _log.debug("%s: running command '%s' in shell coprocess %i", loc, ' '.join(argv), self.p.pid)
+        try:
+            self.p.stdin.write("(cd %s && %s) </dev/null\nprintf '\\n%%s %%d\\n' %s \"$?\"\n"
+                               % (_shquote(cwd), script, self.marker))
+            self.p.stdin.flush()
+        except IOError as e:
+            _log.warning("%s: shell coprocess %i is not accepting commands: %s", loc, self.p.pid, e)
+            self.close()
+            return None
+
+        fd = self.p.stdout.fileno()
+        sentinel = self._sentinel
+        buf = ''
+        i = -1
+        while True:
+            data = os.read(fd, self._readsize)
+            if not data:
+                _log.warning("%s: shell coprocess %i exited while running '%s'", loc, self.p.pid, ' '.join(argv))
+                self.close()
+                return buf
+
+            if i == -1:
+                start = max(0, len(buf) - len(sentinel) + 1)
+                buf += data
+                i = buf.find(sentinel, start)
+            else:
+                buf += data
+
+            if i != -1:
+                j = buf.find('\n', i + len(sentinel))
+                if j != -1:
+                    break
+
+        status = int(buf[i + len(sentinel):j])
+        if status != 0:
+            _log.debug("%s: command '%s' exited with status %i", loc, ' '.join(argv), status)
+        return buf[:i]
+
+    def close(self):
+        if self.p is None:
+            return
+
+        p, self.p = self.p, None
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+        p.wait()
+        p.stdout.close()
+
+# Shells which are known to understand the commands sent to a ShellCoprocess
+_posixshells = ('sh', 'bash', 'dash', 'ksh', 'zsh')
+
+_maxcoprocesses = 4
+
+_coprocessing = False
+_coprocesses = {}
+
+def setcoprocessing(enabled):
+    """
+    Run the commands of $(shell) functions through a ShellCoprocess for each environment they
+    are run with, if the shell allows it.
+    """
+    global _coprocessing
+    _coprocessing = enabled
+    if not enabled:
+        closecoprocesses()
+
+def getcoprocess(env):
+    """
+    Get the ShellCoprocess running commands with the environment `env`, or None if coprocesses
+    are disabled or can't be used.
+    """
+    if not _coprocessing or sys.platform == 'win32':
+        return None
+
+    shell, msys = util.checkmsyscompat()
+    if msys or os.path.basename(shell) not in _posixshells:
+        return None
+
+    if env is None:
+        key = shell, None
+    else:
+        key = shell, tuple(sorted(env.items()))
+
+    coprocess = _coprocesses.get(key)
+    if coprocess is None or not coprocess.alive:
+        if len(_coprocesses) >= _maxcoprocesses:
+            closecoprocesses()
+
+        try:
+            coprocess = ShellCoprocess(shell, env)
+        except OSError as e:
+            _log.warning("Unable to start shell coprocess '%s': %s", shell, e)
+            return None
+        _coprocesses[key] = coprocess
+
+    return coprocess
+
+def closecoprocesses():
+    for coprocess in _coprocesses.values():
+        coprocess.close()
+    _coprocesses.clear()
+
+atexit.register(closecoprocesses)
+
 def statustoresult(status):
     """
     Convert the status returned from waitpid into a prettier numeric result.
@@ -520,7 +669,12 @@ class ParallelContext(object):
             dowait = util.any((len(c.running) for c in ParallelContext._allcontexts))
             if dowait:
                 # Wait on local jobs first for perf
-                for job, cb in ParallelContext._waitany(ParallelContext._condition):
+                jobs = ParallelContext._waitany(ParallelContext._condition)
+
+                # The jobs may have changed symbolic links
+                util.invalidaterealpaths()
+
+                for job, cb in jobs:
                     cb(job.exitcode)
             else:
                 assert any(len(c.pending) for c in ParallelContext._allcontexts)
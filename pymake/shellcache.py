@@ -0,0 +1,198 @@
+"""
+A cache of the results of $(shell) commands.
+
+A $(shell) call in a recursively expanded variable runs its command every time the variable
+is expanded, and every make.py process of a recursive build runs the same probes, such as
+$(shell uname -s). Commands may have side effects, or depend on files which other commands
+change, so only the results of commands which a makefile marks as cacheable are reused: those
+run while the variable .SHELL_CACHE_KEY is set to a non-empty value. When a cache has been set
+(see functions.setshellcache), their results are remembered by the process, keyed by the
+command line, the working directory, the environment and the value of .SHELL_CACHE_KEY, and
+reused when the same command is run again. Results may also be kept in a directory shared
+between processes, for a limited time.
+
+The value of .SHELL_CACHE_KEY should name whatever else the result depends on. Words of it
+which name files contribute their size and modification time, so a result is invalidated when
+those files change. Words with a directory part are relative to the working directory, and
+other words are looked up in the working directory, then on the PATH the command runs with:
+
+    .SHELL_CACHE_KEY = $(CC)
+    CC_VERSION := $(shell $(CC) -dumpversion)
+    .SHELL_CACHE_KEY =
+
+Each persistent entry is a file containing a pickle of its full key, the time it was stored,
+and the result. Expired or corrupt entries are discarded.
+"""
+
+import os, logging, hashlib, tempfile, time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_log = logging.getLogger('pymake.data')
+
+_SUFFIX = '.psc'
+
+DEFAULT_TTL = 60 * 60
+
+# Environment variables which differ between a make and its submakes, but which commands
+# don't usually depend on.
+_IGNOREDENV = ('MAKELEVEL', 'MAKEFLAGS', 'MFLAGS')
+
+def _digest(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
+
+class ShellCache(object):
+    """
+    The results of $(shell) commands marked as cacheable.
+
+    @param cachedir the directory in which to store the results, or None to keep them in memory
+           only. It is created if necessary.
+    @param ttl the number of seconds the entries stored in `cachedir` remain valid.
+    """
+
+    def __init__(self, cachedir=None, ttl=DEFAULT_TTL):
+        self.cachedir = cachedir
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._results = {}
+        self._env = None
+        self._envdigest = None
+
+        if cachedir is not None and not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # Another process may have created it first.
+                if not os.path.isdir(cachedir):
+                    raise
+
+    def _getenvdigest(self, env):
+        # A makefile runs every command with the same environment object.
+        if env is not self._env:
+            if env is None:
+                items = []
+            else:
+                items = sorted([(k, v) for k, v in env.items() if k not in _IGNOREDENV])
+            self._env = env
+            self._envdigest = _digest(repr(items))
+        return self._envdigest
+
+    def getkey(self, executable, cline, cwd, env, cachekey):
+        """
+        The key of the command `cline`, a list of arguments, run by `executable` in the directory
+        `cwd` with the environment `env`. `cachekey` is the non-empty value of .SHELL_CACHE_KEY.
+        """
+        if env is not None:
+            path = env.get('PATH', '')
+        else:
+            path = os.environ.get('PATH', '')
+        path = path.split(os.pathsep)
+
+        keyfiles = []
+        for word in cachekey.split():
+            if os.path.dirname(word):
+                dirs = [cwd]
+            else:
+                dirs = [cwd] + path
+            for dir in dirs:
+                try:
+                    st = os.stat(os.path.join(dir, word))
+                except OSError:
+                    continue
+                keyfiles.append((word, dir, st.st_size, st.st_mtime))
+                break
+
+        return (executable, tuple(cline), cwd, self._getenvdigest(env), cachekey,
+                tuple(keyfiles))
+
+    def _entrypath(self, key):
+        return os.path.join(self.cachedir, _digest(repr(key)) + _SUFFIX)
+
+    def get(self, key):
+        """
+        The result of the command with `key`, or None if it is not cached.
+        """
+        result = self._results.get(key)
+        if result is None and self.cachedir is not None:
+            result = self._load(key)
+            if result is not None:
+                self._results[key] = result
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Remember the result of the command with `key`. Errors writing the cache directory are
+        not fatal: they are logged and ignored.
+        """
+        self._results[key] = result
+        if self.cachedir is not None:
+            self._store(key, result)
+
+    def _load(self, key):
+        entrypath = self._entrypath(key)
+        try:
+            fd = open(entrypath, 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                storedkey, stored, result = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception as e:
+            _log.debug("Discarding corrupt shell cache entry %s: %s", entrypath, e)
+            self._remove(entrypath)
+            return None
+
+        if storedkey != key:
+            return None
+
+        if time.time() - stored > self.ttl:
+            _log.debug("Shell cache entry %s has expired", entrypath)
+            self._remove(entrypath)
+            return None
+
+        return result
+
+    def _store(self, key, result):
+        temppath = None
+        try:
+            fdno, temppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+            fd = os.fdopen(fdno, 'wb')
+            try:
+                pickle.dump((key, time.time(), result), fd, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+
+            entrypath = self._entrypath(key)
+            try:
+                os.rename(temppath, entrypath)
+            except OSError:
+                # Windows can't rename over an existing file.
+                self._remove(entrypath)
+                os.rename(temppath, entrypath)
+        except (EnvironmentError, pickle.PicklingError) as e:
+            _log.warning("Unable to write shell cache entry for '%s': %s", ' '.join(key[1]), e)
+            if temppath is not None:
+                self._remove(temppath)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
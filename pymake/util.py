@@ -1,14 +1,63 @@
-import os
+import os, collections
+
+# Path computations are memoized in plain dicts, which are emptied when they grow too large:
+# a bounded cache costs more to maintain than the computations it would save.
+_pathcachesize = 64 * 1024
+
+_joins = {}
+_slashjoins = {}
+_realpaths = {}
 
 def normaljoin(path, suffix):
     """
     Combine the given path with the suffix, and normalize if necessary to shrink the path to avoid hitting path length limits
     """
-    result = os.path.join(path, suffix)
-    if len(result) > 255:
-        result = os.path.normpath(result)
+    key = path, suffix
+    result = _joins.get(key, None)
+    if result is None:
+        result = os.path.join(path, suffix)
+        if len(result) > 255:
+            result = os.path.normpath(result)
+        if len(_joins) >= _pathcachesize:
+            _joins.clear()
+        _joins[key] = result
+    return result
+
+def slashjoin(path, suffix):
+    """
+    normaljoin, using forward slashes as the makefile sees paths.
+    """
+    key = path, suffix
+    result = _slashjoins.get(key, None)
+    if result is None:
+        result = normaljoin(path, suffix).replace('\\', '/')
+        if len(_slashjoins) >= _pathcachesize:
+            _slashjoins.clear()
+        _slashjoins[key] = result
     return result
 
+def realpath(path):
+    """
+    os.path.realpath, memoized until invalidaterealpaths is called. Relative paths depend on the
+    current directory, so only absolute paths are memoized.
+    """
+    result = _realpaths.get(path, None)
+    if result is None:
+        result = os.path.realpath(path)
+        if not os.path.isabs(path):
+            return result
+        if len(_realpaths) >= _pathcachesize:
+            _realpaths.clear()
+        _realpaths[path] = result
+    return result
+
+def invalidaterealpaths():
+    """
+    Forget the paths memoized by realpath. Make calls this whenever it runs a command, which may
+    create or change symbolic links.
+    """
+    _realpaths.clear()
+
 def joiniter(fd, it):
     """
     Given an iterator that returns strings, write the words with a space in between each.
@@ -78,61 +127,184 @@ except ImportError:
                 return True
         return False
 
-class _MostUsedItem(object):
-    __slots__ = ('key', 'o', 'count')
+class _CacheEntry(object):
+    __slots__ = ('key', 'o', 'weight', 'count')
 
-    def __init__(self, key):
+    def __init__(self, key, o, weight):
         self.key = key
-        self.o = None
+        self.o = o
+        self.weight = weight
         self.count = 1
 
     def __repr__(self):
-        return "MostUsedItem(key=%r, count=%i, o=%r)" % (self.key, self.count, self.o)
+        return "CacheEntry(key=%r, weight=%i, count=%i, o=%r)" % (self.key, self.weight, self.count, self.o)
+
+class _BoundedCache(object):
+    """
+    A cache of objects created by creationfunc(key), bounded by the total weight of its entries.
+    Subclasses choose which entry to evict when the cache is full.
+
+    @param capacity the maximum total weight of the entries.
+    @param creationfunc called as creationfunc(key) to create an object which isn't cached.
+    @param verifyfunc if not None, called as verifyfunc(key, o) to check that a cached object is
+      still valid. Invalid objects are created again.
+    @param weightfunc if not None, called as weightfunc(key, o) to get the weight of a new entry.
+      By default every entry weighs 1, so the capacity is a number of entries. An object heavier
+      than the whole capacity is returned but not cached.
+    @param refreshfunc if not None, called as refreshfunc(key, o) instead of creationfunc to create
+      an object again when the cached object `o` is invalid.
+
+    get, put and evictions take constant time. `hits`, `misses` and `evictions` count what
+    happened to the calls to get and put.
+    """
 
-class MostUsedCache(object):
-    def __init__(self, capacity, creationfunc, verifyfunc):
+    def __init__(self, capacity, creationfunc, verifyfunc=None, weightfunc=None, refreshfunc=None):
         self.capacity = capacity
         self.cfunc = creationfunc
         self.vfunc = verifyfunc
+        self.wfunc = weightfunc
+        self.rfunc = refreshfunc
 
-        self.d = {}
-        self.active = [] # lazily sorted!
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def setactive(self, item):
-        if item in self.active:
-            return
+        self._entries = {}
 
-        if len(self.active) == self.capacity:
-            self.active.sort(key=lambda i: i.count)
-            old = self.active.pop(0)
-            old.o = None
-            # print "Evicting %s" % old.key
+    def __len__(self):
+        return len(self._entries)
 
-        self.active.append(item)
+    def __contains__(self, key):
+        return key in self._entries
 
     def get(self, key):
-        item = self.d.get(key, None)
-        if item is None:
-            item = _MostUsedItem(key)
-            self.d[key] = item
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            if self.vfunc is None or self.vfunc(key, entry.o):
+                self.hits += 1
+                self._touch(entry)
+                return entry.o
+
+            self._remove(entry)
+
+        self.misses += 1
+        if entry is not None and self.rfunc is not None:
+            o = self.rfunc(key, entry.o)
         else:
-            item.count += 1
+            o = self.cfunc(key)
+        self.put(key, o)
+        return o
+
+    def put(self, key, o):
+        """
+        Store an object created elsewhere, replacing any cached object for the key.
+        """
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            self._remove(entry)
+
+        if self.wfunc is None:
+            weight = 1
+        else:
+            weight = self.wfunc(key, o)
+        if weight > self.capacity:
+            return
+
+        while self.weight + weight > self.capacity:
+            self._remove(self._victim())
+            self.evictions += 1
+
+        entry = _CacheEntry(key, o, weight)
+        self._entries[key] = entry
+        self.weight += weight
+        self._insert(entry)
+
+    def clear(self):
+        for entry in list(self._entries.values()):
+            self._remove(entry)
+
+    def _remove(self, entry):
+        del self._entries[entry.key]
+        self.weight -= entry.weight
+        self._unlink(entry)
+
+class LRUCache(_BoundedCache):
+    """
+    A bounded cache which evicts the least recently used entry. See _BoundedCache.
+    """
+
+    def __init__(self, capacity, creationfunc, verifyfunc=None, weightfunc=None, refreshfunc=None):
+        _BoundedCache.__init__(self, capacity, creationfunc, verifyfunc, weightfunc, refreshfunc)
+        self._order = collections.OrderedDict()
+
+    def _insert(self, entry):
+        self._order[entry.key] = entry
+
+    def _unlink(self, entry):
+        del self._order[entry.key]
+
+    def _touch(self, entry):
+        del self._order[entry.key]
+        self._order[entry.key] = entry
+
+    def _victim(self):
+        return self._order[next(iter(self._order))]
+
+    def debugitems(self):
+        """
+        The cached keys, most recently used first.
+        """
+        l = list(self._order.keys())
+        l.reverse()
+        return l
+
+class LFUCache(_BoundedCache):
+    """
+    A bounded cache which evicts the least frequently used entry, or the least recently used
+    of those if there are several. See _BoundedCache.
+    """
+
+    def __init__(self, capacity, creationfunc, verifyfunc=None, weightfunc=None, refreshfunc=None):
+        _BoundedCache.__init__(self, capacity, creationfunc, verifyfunc, weightfunc, refreshfunc)
+        self._buckets = {} # use count -> OrderedDict of entries, least recently used first
+        self._mincount = 1
+
+    def _insert(self, entry):
+        bucket = self._buckets.get(entry.count, None)
+        if bucket is None:
+            bucket = self._buckets[entry.count] = collections.OrderedDict()
+        bucket[entry.key] = entry
+        if entry.count < self._mincount:
+            self._mincount = entry.count
 
-        if item.o is not None and self.vfunc(key, item.o):
-            return item.o
+    def _unlink(self, entry):
+        bucket = self._buckets[entry.count]
+        del bucket[entry.key]
+        if not len(bucket):
+            del self._buckets[entry.count]
 
-        item.o = self.cfunc(key)
-        self.setactive(item)
-        return item.o
+    def _touch(self, entry):
+        self._unlink(entry)
+        if entry.count == self._mincount and entry.count not in self._buckets:
+            self._mincount += 1
+        entry.count += 1
+        self._insert(entry)
 
-    def verify(self):
-        for k, v in self.d.items():
-            if v.o:
-                assert v in self.active
-            else:
-                assert v not in self.active
+    def _victim(self):
+        # Entries removed because they were invalid can leave _mincount behind.
+        if self._mincount not in self._buckets:
+            self._mincount = min(self._buckets)
+        bucket = self._buckets[self._mincount]
+        return bucket[next(iter(bucket))]
 
     def debugitems(self):
-        l = [i.key for i in self.active]
-        l.sort()
+        """
+        The cached keys, most frequently used first.
+        """
+        l = []
+        for count in sorted(self._buckets, reverse=True):
+            keys = list(self._buckets[count].keys())
+            keys.reverse()
+            l.extend(keys)
         return l
@@ -1,6 +1,6 @@
 import pymake.data, pymake.functions, pymake.util
 import unittest
-import re
+import re, os, shutil, tempfile
 
 
 def multitest(cls):
@@ -41,6 +41,27 @@ class GetPatSubstTest(unittest.TestCase):
                           for word in words))
             self.assertEqual(a, e, 'Pattern(%r).subst(%r, %r)' % (s, r, d))
 
+class PatternSetTest(unittest.TestCase):
+    patterns = ('%.c', 'foo%', 'a%b.c', 'exact', 'the\\%weird\\\\%pattern\\\\', '\\%lit', '%')
+    words = ('foo.c', '.c', 'foo', 'fo', 'ab.c', 'axb.c', 'exact', 'exactly', 'the%weird\\xpattern\\',
+             '%lit', 'lit', '')
+
+    def runTest(self):
+        for i in range(0, len(self.patterns) + 1):
+            patterns = self.patterns[:i]
+            ps = pymake.data.getpatternset(' '.join(patterns))
+            for w in self.words:
+                expected = pymake.util.any((pymake.data.Pattern(p).match(w) is not None for p in patterns))
+                self.assertEqual(ps.match(w), expected, '%r matching %r' % (patterns, w))
+
+        self.assertTrue(pymake.data.getpatternset('%.c exact') is pymake.data.getpatternset('%.c exact'))
+
+        for p in self.patterns:
+            for r in ('%.o', 'x', 'a\\%b%', ''):
+                subst = pymake.data.getpatternsubst(p, r)
+                for w in self.words:
+                    self.assertEqual(subst.subst(w), pymake.data.Pattern(p).subst(r, w, False))
+
 class LRUTest(unittest.TestCase):
     # getkey, expected, funccount, debugitems
     expected = (
@@ -74,6 +95,80 @@ class LRUTest(unittest.TestCase):
             self.assertEqual(goti, di,
                              "debugitems, iteration %i, got %r expected %r" % (i, goti, di))
 
+class LFUTest(unittest.TestCase):
+    def runTest(self):
+        c = pymake.util.LFUCache(2, lambda k: k * 2)
+        self.assertEqual(c.get(1), 2)
+        c.get(1)
+        c.get(2)
+        self.assertEqual(c.debugitems(), [1, 2])
+
+        # 2 is used least, so it makes way for 3.
+        c.get(3)
+        self.assertEqual(c.debugitems(), [1, 3])
+        self.assertEqual((c.hits, c.misses, c.evictions), (1, 3, 1))
+
+        # Among equally used entries, the least recent goes first.
+        c.get(3)
+        c.get(4)
+        self.assertEqual(c.debugitems(), [3, 4])
+
+class WeightedCacheTest(unittest.TestCase):
+    def runTest(self):
+        c = pymake.util.LRUCache(10, lambda k: 'x' * k,
+                                 weightfunc=lambda k, v: len(v))
+        c.get(4)
+        c.get(5)
+        self.assertEqual((c.weight, len(c)), (9, 2))
+
+        c.get(3)
+        self.assertEqual(c.debugitems(), [3, 5])
+        self.assertEqual((c.weight, c.evictions), (8, 1))
+
+        # Too heavy to cache at all
+        self.assertEqual(c.get(11), 'x' * 11)
+        self.assertFalse(11 in c)
+        self.assertEqual(c.weight, 8)
+
+        c.put(5, 'y')
+        self.assertEqual((c.weight, c.get(5)), (4, 'y'))
+
+class PathCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+
+    def tearDown(self):
+        pymake.util.invalidaterealpaths()
+        shutil.rmtree(self.tempdir)
+
+    def test_join(self):
+        self.assertEqual(pymake.util.normaljoin('/a/b', 'c'), os.path.join('/a/b', 'c'))
+        self.assertEqual(pymake.util.normaljoin('/a/b', '/c'), '/c')
+        self.assertEqual(pymake.util.slashjoin('a', 'b\\c'), 'a/b/c')
+
+        deep = '/' + 'x' * 250 + '/..'
+        self.assertEqual(pymake.util.normaljoin(deep, 'c'), '/c')
+        self.assertEqual(pymake.util.normaljoin(deep, 'c'), '/c')
+
+    def test_realpath(self):
+        if not hasattr(os, 'symlink'):
+            return
+
+        for d in ('a', 'b'):
+            os.mkdir(os.path.join(self.tempdir, d))
+        link = os.path.join(self.tempdir, 'link')
+        os.symlink('a', link)
+
+        self.assertEqual(pymake.util.realpath(link), os.path.join(self.tempdir, 'a'))
+
+        os.remove(link)
+        os.symlink('b', link)
+        self.assertEqual(pymake.util.realpath(link), os.path.join(self.tempdir, 'a'))
+
+        # Running a command forgets the paths which might have changed.
+        pymake.util.invalidaterealpaths()
+        self.assertEqual(pymake.util.realpath(link), os.path.join(self.tempdir, 'b'))
+
 class EqualityTest(unittest.TestCase):
     def test_string_expansion(self):
         s1 = pymake.data.StringExpansion('foo bar', None)
@@ -120,6 +215,41 @@ class EqualityTest(unittest.TestCase):
 
         self.assertEqual(s1, s2)
 
+    def test_function_args_unchanged(self):
+        f1 = pymake.functions.SortFunction(None)
+        f1.append(pymake.data.StringExpansion(' foo', None))
+        f2 = pymake.functions.SortFunction(None)
+        f2.append(pymake.data.StringExpansion('foo', None))
+
+        self.assertEqual(f1, f2)
+        self.assertEqual(f1[0].s, ' foo')
+
+class InternTest(unittest.TestCase):
+    def _varref(self, name):
+        v = pymake.functions.VariableRef(None, pymake.data.StringExpansion(name, None))
+        v.internarguments()
+        return pymake.data.internnode(v)
+
+    def test_shared(self):
+        v1 = self._varref('CC')
+        v2 = self._varref('CC')
+        self.assertTrue(v1 is v2)
+        self.assertFalse(self._varref('CXX') is v1)
+
+        e1 = pymake.data.Expansion(None)
+        e1.appendstr('foo ')
+        e1.appendfunc(v1)
+        e2 = pymake.data.Expansion(None)
+        e2.appendstr('foo ')
+        e2.appendfunc(v2)
+        self.assertTrue(pymake.data.internnode(e1) is pymake.data.internnode(e2))
+
+    def test_weak(self):
+        v1 = self._varref('WEAK')
+        key = v1.internkey()
+        del v1
+        self.assertFalse(key in pymake.data._internednodes)
+
 
 class StringExpansionTest(unittest.TestCase):
     def test_base_expansion_interface(self):
@@ -232,6 +362,318 @@ class ExpansionTest(unittest.TestCase):
 
         self.assertTrue(e.is_filesystem_dependent)
 
+    def test_compile(self):
+        v = pymake.data.Variables()
+        v.set('FOO', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'foo')
+
+        e = pymake.data.Expansion()
+        e.appendstr('a')
+        e.appendstr('b')
+        e.appendfunc(pymake.functions.VariableRef(None,
+            pymake.data.StringExpansion('FOO', None)))
+        self.assertEqual(e.resolvestr(None, v), 'abfoo')
+
+        # Mutating the expansion discards the compiled form.
+        e.appendstr('c')
+        self.assertEqual(e.resolvestr(None, v), 'abfooc')
+
+        e.appendfunc(pymake.functions.VariableRef(None,
+            pymake.data.StringExpansion('BAR', None)))
+        self.assertEqual(e.resolvestr(None, v), 'abfooc')
+
+        self.assertEqual(pymake.data.Expansion().resolvestr(None, v), '')
+
+class MemoizeTest(unittest.TestCase):
+    def setUp(self):
+        pymake.data.setmemoizing(True)
+
+    def tearDown(self):
+        pymake.data.setmemoizing(False)
+
+    def set(self, v, name, value):
+        v.set(name, pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, value)
+
+    def test_invalidate(self):
+        v = pymake.data.Variables()
+        self.set(v, 'FLAGS', '$(OPT) $(DEFS)')
+        self.set(v, 'OPT', '-O$(LEVEL)')
+        self.set(v, 'LEVEL', '2')
+        self.set(v, 'DEFS', '-DA')
+        self.assertEqual(v.resolvestr('FLAGS', None), '-O2 -DA')
+
+        memo = v._memo['FLAGS']
+        self.assertEqual(v.resolvestr('FLAGS', None), '-O2 -DA')
+        self.assertTrue(v._memo['FLAGS'] is memo)
+
+        self.set(v, 'LEVEL', '3')
+        self.assertEqual(v.resolvestr('FLAGS', None), '-O3 -DA')
+
+        v.append('DEFS', pymake.data.Variables.SOURCE_MAKEFILE, '-DB', v, None)
+        self.assertEqual(v.resolvestr('FLAGS', None), '-O3 -DA -DB')
+
+        # A variable set later is read once it exists.
+        self.set(v, 'LEVEL', '$(EXTRA)')
+        self.assertEqual(v.resolvestr('FLAGS', None), '-O -DA -DB')
+        self.set(v, 'EXTRA', 's')
+        self.assertEqual(v.resolvestr('FLAGS', None), '-Os -DA -DB')
+
+    def test_scopes(self):
+        v = pymake.data.Variables()
+        self.set(v, 'FLAGS', '-O$(LEVEL)')
+        self.set(v, 'LEVEL', '2')
+
+        t1 = pymake.data.Variables(parent=v)
+        t2 = pymake.data.Variables(parent=v)
+        self.assertEqual(t1.resolvestr('FLAGS', None), '-O2')
+        memo = v._memo['FLAGS']
+        self.assertEqual(t2.resolvestr('FLAGS', None), '-O2')
+        self.assertTrue(v._memo['FLAGS'] is memo)
+
+        self.set(t2, 'LEVEL', '0')
+        self.assertEqual(t2.resolvestr('FLAGS', None), '-O0')
+        self.assertEqual(t1.resolvestr('FLAGS', None), '-O2')
+
+    def test_volatile(self):
+        m = pymake.data.Makefile()
+        v = m.variables
+        self.set(v, 'FILES', '$(wildcard *.nonexistent) x')
+        self.set(v, 'ALL', '$(FILES) y')
+        self.assertEqual(v.resolvestr('ALL', m), ' x y')
+        self.assertTrue(v._memo['FILES'][1])
+        self.assertTrue(v._memo['ALL'][1])
+
+    def test_recursive(self):
+        v = pymake.data.Variables()
+        self.set(v, 'A', '$(B)')
+        self.set(v, 'B', 'b')
+        self.assertEqual(v.resolvestr('A', None), 'b')
+        self.assertRaises(pymake.errors.DataError, v.resolvestr, 'A', None, ['B'])
+
+    def test_mixed_arguments(self):
+        m = pymake.data.Makefile()
+        v = m.variables
+        self.set(v, 'f', '[$(1)]')
+        self.set(v, 'X', '$(call f,a$(Y)b) $(patsubst %,$(D)/%,p q)')
+        self.set(v, 'Y', 'y')
+        self.set(v, 'D', 'd')
+        self.assertEqual(v.resolvestr('X', m), '[ayb] d/p d/q')
+
+        self.set(v, 'Y', 'z')
+        self.assertEqual(v.resolvestr('X', m), '[azb] d/p d/q')
+
+class AppendTest(unittest.TestCase):
+    def test_recursive(self):
+        v = pymake.data.Variables()
+        v.set('A', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, '$(B)')
+        v.set('B', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'b')
+        for i in range(0, 100):
+            v.append('A', pymake.data.Variables.SOURCE_MAKEFILE, 'x%i' % i, v, None)
+
+        flavor, source, value = v.get('A')
+        self.assertEqual(flavor, pymake.data.Variables.FLAVOR_RECURSIVE)
+        self.assertTrue(v.get('A')[2] is value)
+        self.assertEqual(v.get('A', expand=False)[2],
+                         '$(B) ' + ' '.join(['x%i' % i for i in range(0, 100)]))
+        self.assertEqual(v.resolvesplit('A', None)[:3], ['b', 'x0', 'x1'])
+
+        v.append('A', pymake.data.Variables.SOURCE_MAKEFILE, '$(B)', v, None)
+        self.assertFalse(v.get('A')[2] is value)
+        self.assertEqual(v.resolvesplit('A', None)[-2:], ['x99', 'b'])
+
+    def test_simple(self):
+        v = pymake.data.Variables()
+        v.set('A', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'a')
+        v.set('B', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'b')
+        v.append('A', pymake.data.Variables.SOURCE_MAKEFILE, '$(B)', v, None)
+        v.set('B', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'c')
+        v.append('A', pymake.data.Variables.SOURCE_MAKEFILE, '$(B)', v, None)
+
+        self.assertEqual(v.get('A')[0], pymake.data.Variables.FLAVOR_SIMPLE)
+        self.assertEqual(v.resolvestr('A', None), 'a b c')
+        self.assertTrue(('A', pymake.data.Variables.FLAVOR_SIMPLE,
+                         pymake.data.Variables.SOURCE_MAKEFILE, 'a b c') in list(v))
+
+    def test_scope(self):
+        v = pymake.data.Variables()
+        v.set('A', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'a')
+        t = pymake.data.Variables(parent=v)
+        t.append('A', pymake.data.Variables.SOURCE_MAKEFILE, 't', v, None)
+        t.append('A', pymake.data.Variables.SOURCE_MAKEFILE, 'u', v, None)
+
+        value = t.get('A')[2]
+        self.assertEqual(value.resolvestr(None, t), 'a t u')
+        self.assertTrue(t.get('A')[2] is value)
+        self.assertEqual(t.get('A', expand=False)[2], 'a t u')
+
+        v.set('A', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'b')
+        self.assertEqual(t.resolvestr('A', None), 'b t u')
+        self.assertEqual(v.resolvestr('A', None), 'b')
+
+class FreezeTest(unittest.TestCase):
+    def setUp(self):
+        pymake.data.setfreezing(True)
+
+    def tearDown(self):
+        pymake.data.setfreezing(False)
+
+    def set(self, v, name, value):
+        v.set(name, pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, value)
+
+    def test_freeze(self):
+        v = pymake.data.Variables()
+        self.set(v, 'CFLAGS', '$(OPT) $(DEFS)')
+        self.set(v, 'OPT', '-O2')
+        self.set(v, 'DEFS', '-D$(subst a,A,$(NAME))')
+        v.set('NAME', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'name')
+        self.set(v, 'OUT', '-o $@')
+        self.set(v, 'COMPUTED', '$($(NAME))')
+        v.freeze(['@'])
+
+        t = pymake.data.Variables(parent=v)
+        t.set('@', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_AUTOMATIC, 'out')
+        self.assertEqual(t.resolvestr('CFLAGS', None), '-O2 -DnAme')
+        self.assertEqual(v._frozen.values, {'CFLAGS': '-O2 -DnAme', 'OPT': '-O2', 'DEFS': '-DnAme'})
+        self.assertEqual(t.resolvestr('OUT', None), '-o out')
+        self.assertEqual(v.resolvestr('COMPUTED', None), '')
+        self.assertEqual(sorted(v._frozen.values), ['CFLAGS', 'DEFS', 'OPT'])
+
+        # A variable read by a frozen variable may be set in an inner scope.
+        t.set('OPT', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_MAKEFILE, '-O0')
+        self.assertEqual(t.resolvestr('CFLAGS', None), '-O0 -DnAme')
+        self.assertEqual(v.resolvestr('CFLAGS', None), '-O2 -DnAme')
+
+        self.set(v, 'OPT', '-Os')
+        self.assertEqual(v._frozen.values, {})
+        self.assertEqual(v.resolvestr('CFLAGS', None), '-Os -DnAme')
+
+    def test_foreach(self):
+        v = pymake.data.Variables()
+        self.set(v, 'X', 'x')
+        self.set(v, 'Y', '[$(X)]')
+        self.set(v, 'Z', '$(foreach X,a b,$(Y))')
+        v.freeze([])
+
+        self.assertEqual(v.resolvestr('Z', None), '[a] [b]')
+        self.assertEqual(v.resolvestr('Y', None), '[x]')
+        self.assertEqual(v.resolvestr('Z', None), '[a] [b]')
+
+    def test_mixed_arguments(self):
+        m = pymake.data.Makefile()
+        v = m.variables
+        self.set(v, 'f', '[$(1)]')
+        self.set(v, 'D', 'd')
+        self.set(v, 'X', '$(call f,a$(Y)b) $(patsubst %,$(D)/%,p q)')
+        v.set('Y', pymake.data.Variables.FLAVOR_SIMPLE,
+              pymake.data.Variables.SOURCE_MAKEFILE, 'y')
+        v.freeze([])
+
+        self.assertEqual(v.resolvestr('X', m), '[ayb] d/p d/q')
+        self.assertEqual(v._frozen.values['X'], '[ayb] d/p d/q')
+        self.assertEqual(v._frozenreads('X'), set(['X', 'f', '1', 'Y', 'D']))
+
+    def test_template(self):
+        m = pymake.data.Makefile()
+        self.set(m.variables, 'CC', 'cc')
+        m.variables.freeze(pymake.data._automaticvariables)
+
+        r = pymake.data.Rule([], False, None, False)
+        r.addcommand(pymake.data._parsevalue('$(CC) -o $@', None, 'command'))
+        t = m.gettarget('out')
+        t.vpathtarget, t.mtime = 'out', None
+
+        def command():
+            v = pymake.data.Variables(parent=t.variables)
+            pymake.data.setautomaticvariables(v, m, t, [])
+            return r.gettemplate(m).resolvestr(0, m, v)
+
+        template = r.gettemplate(m)
+        self.assertEqual(command(), 'cc -o out')
+        self.assertTrue(r.gettemplate(m) is template)
+
+        # A variable set for the target is read from its scope.
+        self.set(t.variables, 'CC', 'gcc')
+        self.assertEqual(command(), 'gcc -o out')
+        t.variables = pymake.data.Variables(parent=m.variables)
+        self.assertEqual(command(), 'cc -o out')
+
+        # Setting a global thaws the variables and invalidates the template.
+        self.set(m.variables, 'CC', 'clang')
+        self.assertEqual(command(), 'clang -o out')
+        self.assertFalse(r.gettemplate(m) is template)
+
+class AutomaticVariablesTest(unittest.TestCase):
+    def test_lazy(self):
+        m = pymake.data.Makefile()
+        t = m.gettarget('out/prog')
+        t.vpathtarget, t.mtime = 'out/prog', None
+        prerequisites = ['a/x.o', 'b/y.o', 'a/x.o']
+        for p in prerequisites:
+            m.gettarget(p).vpathtarget, m.gettarget(p).mtime = p, None
+
+        v = pymake.data.Variables(parent=t.variables)
+        pymake.data.setautomaticvariables(v, m, t, prerequisites)
+        self.assertEqual(v._map['^'][2]._joined, None)
+
+        self.assertEqual(v.resolvestr('@D', m), 'out')
+        self.assertEqual(v.resolvestr('<', m), 'a/x.o')
+        self.assertEqual(v.resolvestr('^', m), 'a/x.o b/y.o')
+        self.assertEqual(v.resolvestr('^D', m), 'a b')
+        self.assertEqual(v.resolvestr('+F', m), 'x.o y.o x.o')
+        self.assertEqual(v.resolvestr('?', m), 'a/x.o b/y.o')
+        self.assertEqual(v.get('+', expand=False),
+                         (pymake.data.Variables.FLAVOR_SIMPLE,
+                          pymake.data.Variables.SOURCE_AUTOMATIC, 'a/x.o b/y.o a/x.o'))
+
+        v = pymake.data.Variables(parent=t.variables)
+        pymake.data.setautomaticvariables(v, m, t, [])
+        self.assertEqual(v.resolvestr('<', m), None)
+        self.assertEqual(v.resolvestr('^', m), '')
+
+class ParameterScopeTest(unittest.TestCase):
+    def test_bind(self):
+        v = pymake.data.Variables()
+        v.set('X', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_OVERRIDE, 'over')
+        v.set('Y', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, '[$(X)]')
+
+        p = pymake.data.ParameterScope(parent=v)
+        for w in ('a', 'b$(X)'):
+            p.bind('X', w)
+            flavor, source, value = p.get('X')
+            self.assertEqual(flavor, pymake.data.Variables.FLAVOR_SIMPLE)
+            self.assertEqual(source, pymake.data.Variables.SOURCE_AUTOMATIC)
+            self.assertEqual(p.resolvestr('X', None), w)
+            self.assertEqual(p.resolvestr('Y', None), '[%s]' % w)
+
+        self.assertEqual(v.resolvestr('Y', None), '[over]')
+
+    def test_guard(self):
+        g = pymake.data.RecursionGuard('B', pymake.data.RecursionGuard('A', ['Z']))
+        for name in 'ABZ':
+            self.assertTrue(name in g)
+        self.assertFalse('C' in g)
+
+        v = pymake.data.Variables()
+        v.set('A', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, '$(B)')
+        v.set('B', pymake.data.Variables.FLAVOR_RECURSIVE,
+              pymake.data.Variables.SOURCE_MAKEFILE, '$(A)')
+        self.assertRaises(pymake.errors.DataError, v.resolvestr, 'A', None)
+
 
 if __name__ == '__main__':
     unittest.main()
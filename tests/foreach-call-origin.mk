@@ -0,0 +1,15 @@
+override X = outer
+Y = global
+
+ORIGINS := $(foreach X,a b,$(X):$(origin X):$(flavor X))
+describe = $(1):$(origin 1):$(flavor 1):$(origin 0)
+DESCRIBED := $(call describe,$(Y))
+NESTED := $(foreach X,a,$(foreach Y,b,$(call describe,$(X)$(Y))))
+
+all:
+	test "$(ORIGINS)" = "a:automatic:simple b:automatic:simple"
+	test "$(DESCRIBED)" = "global:automatic:simple:automatic"
+	test "$(NESTED)" = "ab:automatic:simple:automatic"
+	test "$(X)" = "outer"
+	test "$(origin X)" = "override"
+	@echo TEST-PASS
@@ -0,0 +1,34 @@
+#T gmake skip
+#T commandline: ['--freeze-variables']
+
+CXX = c++
+OPT = -O2
+CXXFLAGS = $(OPT) -DNAME=$(NAME)
+NAME = default
+COMPILE = $(CXX) $(CXXFLAGS)
+LINK = $(CXX) -o
+OBJDIR = obj
+objpath = $(OBJDIR)/$(1)
+wrap = [$(1)]
+
+all: a.o b.o special.o c.sub d.sub
+	test "$(COMPILE)" = "c++ -O2 -DNAME=default"
+	@echo TEST-PASS
+
+special.o: OPT = -O0
+%.sub: NAME = sub
+
+%.o: %.cpp
+	test "$(COMPILE) -c $< -o $@" = "c++ $(if $(filter special.o,$@),-O0,-O2) -DNAME=default -c $*.cpp -o $*.o"
+	test "$(foreach OPT,-Os,$(CXXFLAGS))" = "-Os -DNAME=default"
+	test "$(LINK) $@" = "c++ -o $*.o"
+	test "$(call objpath,x$(NAME)y)" = "obj/xdefaulty"
+	test "$(patsubst %,$(OBJDIR)/%,$@ $(call objpath,$*.d))" = "obj/$*.o obj/obj/$*.d"
+	test "$(call wrap,$(call objpath,a$(OPT)) b$(NAME))" = "[obj/a$(if $(filter special.o,$@),-O0,-O2) bdefault]"
+
+%.sub:
+	test "$(COMPILE) $@" = "c++ -O2 -DNAME=sub $*.sub"
+	test "$(call objpath,$(NAME)-$*)" = "obj/sub-$*"
+
+%.cpp:
+	@true
@@ -1,7 +1,11 @@
 import unittest
+import os, shutil, tempfile
 
 import pymake.data
 import pymake.functions
+import pymake.parser
+import pymake.process
+import pymake.shellcache
 
 class VariableRefTest(unittest.TestCase):
     def test_get_expansions(self):
@@ -50,5 +54,175 @@ class GetExpansionsTest(unittest.TestCase):
 
         self.assertFalse(f.is_filesystem_dependent)
 
+    def test_descend_mixed(self):
+        d = pymake.parser.Data.fromstring('$(call f,a$(Y)b$(wildcard $(D)/*))', 'GetExpansionsTest')
+        e, t, o = pymake.parser.parsemakesyntax(d, 0, (), pymake.parser.iterdata)
+
+        # Literal text within the arguments is skipped.
+        for exp in next(e.functions()).expansions(True):
+            self.assertTrue(isinstance(exp, pymake.data.BaseExpansion), exp)
+
+        names = sorted(f.vname.s for f in e.variable_references(descend=True))
+        self.assertEqual(names, ['D', 'Y'])
+        self.assertTrue(e.is_filesystem_dependent)
+
+class ResolveSplitTest(unittest.TestCase):
+    variables = {
+        'SRCS': 'a.c  dir/b.c c.h dir/ .c',
+        'OBJS': '$(SRCS:.c=.o)',
+        'SP': 'x y',
+    }
+
+    testdata = (
+        '$(filter %.c,$(SRCS))',
+        '$(filter-out %.h,$(sort $(notdir $(SRCS)) z))',
+        '$(sort $(patsubst %.c,%.o,$(filter %.c,$(SRCS))))',
+        '$(patsubst %.c,%,$(SRCS))',
+        '$(patsubst %.c,$(SP)%,$(SRCS))',
+        '$(addprefix obj/,$(basename $(SRCS)))',
+        '$(addsuffix $(SP),$(OBJS))',
+        '$(addprefix ,$(OBJS))',
+        '$(dir $(SRCS)) $(suffix $(SRCS) a.)',
+        '$(join $(SRCS),1 2)',
+        '$(strip $(wordlist 2,4,$(OBJS)))',
+        '$(foreach s,$(SRCS),$(s) -I$(dir $(s)))',
+        '$(if $(SP),$(OBJS:.o=),$(SRCS))',
+        '$(OBJS:%.o=% .x)',
+        '$(UNSET)',
+    )
+
+    def runTest(self):
+        m = pymake.data.Makefile()
+        for name, value in self.variables.items():
+            m.variables.set(name, pymake.data.Variables.FLAVOR_RECURSIVE,
+                            pymake.data.Variables.SOURCE_MAKEFILE, value)
+
+        for s in self.testdata:
+            d = pymake.parser.Data.fromstring(s, 'ResolveSplitTest')
+            e, t, o = pymake.parser.parsemakesyntax(d, 0, (), pymake.parser.iterdata)
+            self.assertEqual(e.resolvesplit(m, m.variables),
+                             e.resolvestr(m, m.variables).split(), s)
+
+class ShellCacheTest(unittest.TestCase):
+    # The output changes every time the command runs.
+    command = '$(shell echo x >> runs; wc -l < runs)'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.env = dict(os.environ)
+
+    def tearDown(self):
+        pymake.functions.setshellcache(None)
+        shutil.rmtree(self.tempdir)
+
+    def resolve(self, key=None):
+        m = pymake.data.Makefile(workdir=self.tempdir, env=self.env)
+        if key is not None:
+            m.variables.set('.SHELL_CACHE_KEY', pymake.data.Variables.FLAVOR_SIMPLE,
+                            pymake.data.Variables.SOURCE_MAKEFILE, key)
+        d = pymake.parser.Data.fromstring(self.command, 'ShellCacheTest')
+        e, t, o = pymake.parser.parsemakesyntax(d, 0, (), pymake.parser.iterdata)
+        return e.resolvestr(m, m.variables).strip()
+
+    def test_memory(self):
+        cache = pymake.shellcache.ShellCache()
+        pymake.functions.setshellcache(cache)
+
+        # Commands which aren't marked as cacheable run every time.
+        self.assertEqual(self.resolve(), '1')
+        self.assertEqual(self.resolve(' '), '2')
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+        self.assertEqual(self.resolve('x'), '3')
+        self.assertEqual(self.resolve('x'), '3')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Commands run with a different key are cached separately.
+        self.assertEqual(self.resolve('y'), '4')
+
+    def test_persistent(self):
+        cache = pymake.shellcache.ShellCache(self.cachedir)
+        pymake.functions.setshellcache(cache)
+        self.assertEqual(self.resolve('probe'), '1')
+
+        # A different process would have a different cache object.
+        cache = pymake.shellcache.ShellCache(self.cachedir)
+        pymake.functions.setshellcache(cache)
+        self.assertEqual(self.resolve(), '2')
+        self.assertEqual(self.resolve('probe'), '1')
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        # Expired entries are discarded.
+        cache = pymake.shellcache.ShellCache(self.cachedir, ttl=-1)
+        pymake.functions.setshellcache(cache)
+        self.assertEqual(self.resolve('probe'), '3')
+
+    def test_keyfiles(self):
+        keyfile = os.path.join(self.tempdir, 'tool')
+        open(keyfile, 'w').write('1')
+
+        pymake.functions.setshellcache(pymake.shellcache.ShellCache(self.cachedir))
+        self.assertEqual(self.resolve('tool'), '1')
+        self.assertEqual(self.resolve('tool'), '1')
+
+        # Changing a file named by the key invalidates the result.
+        open(keyfile, 'w').write('22')
+        pymake.functions.setshellcache(pymake.shellcache.ShellCache(self.cachedir))
+        self.assertEqual(self.resolve('tool'), '2')
+
+    def test_keypath(self):
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.mkdir(bindir)
+        tool = os.path.join(bindir, 'cc-tool')
+        open(tool, 'w').write('1')
+        self.env['PATH'] = bindir + os.pathsep + self.env.get('PATH', '')
+
+        # Names without a directory are also looked up on the PATH.
+        pymake.functions.setshellcache(pymake.shellcache.ShellCache())
+        self.assertEqual(self.resolve('cc-tool'), '1')
+        self.assertEqual(self.resolve('cc-tool'), '1')
+
+        open(tool, 'w').write('22')
+        self.assertEqual(self.resolve('cc-tool'), '2')
+
+class ShellCoprocessTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+        self.env = dict(os.environ)
+        pymake.process.setcoprocessing(True)
+
+    def tearDown(self):
+        pymake.process.setcoprocessing(False)
+        shutil.rmtree(self.tempdir)
+
+    def resolve(self, s, env=None):
+        m = pymake.data.Makefile(workdir=self.tempdir, env=env or self.env)
+        d = pymake.parser.Data.fromstring(s, 'ShellCoprocessTest')
+        e, t, o = pymake.parser.parsemakesyntax(d, 0, (), pymake.parser.iterdata)
+        return e.resolvestr(m, m.variables)
+
+    def runTest(self):
+        coprocess = pymake.process.getcoprocess(self.env)
+        if coprocess is None:
+            return
+
+        self.assertEqual(self.resolve('$(shell echo a; echo b)'), 'a b')
+        self.assertEqual(self.resolve('$(shell printf "a\\r\\nb\\n\\n")'), 'a b ')
+        self.assertEqual(self.resolve('$(shell printf x)'), 'x')
+        self.assertEqual(self.resolve('$(shell pwd)'), self.tempdir)
+
+        # Commands can't change the state of the coprocess.
+        self.assertEqual(self.resolve('$(shell cd /; X=1; exit 3)'), '')
+        self.assertEqual(self.resolve('$(shell pwd; echo x$$X)'), self.tempdir + ' x')
+        self.assertEqual(self.resolve('$(shell echo a; fi)'), '')
+        self.assertEqual(self.resolve('$(shell cat)'), '')
+        self.assertTrue(pymake.process.getcoprocess(self.env) is coprocess)
+        self.assertTrue(coprocess.alive)
+
+        env = dict(self.env, PYMAKE_TEST='1')
+        self.assertEqual(self.resolve('$(shell echo $$PYMAKE_TEST)', env), '1')
+        self.assertTrue(pymake.process.getcoprocess(env) is not coprocess)
+
 if __name__ == '__main__':
     unittest.main()
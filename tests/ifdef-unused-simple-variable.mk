@@ -0,0 +1,6 @@
+ifdef NOPE
+X := $(subst a,b
+endif
+
+all:
+	@echo TEST-PASS
@@ -1,4 +1,5 @@
 #T commandline: ['-w', 'OVAR=oval']
+#T exact-makeflags
 
 OVAR=mval
 
@@ -0,0 +1,13 @@
+#T gmake skip
+
+# A submake run without --parse-cache doesn't use the cache of its parent. This makefile was
+# already parsed by the top-level make, so nothing is stored.
+all:
+	printf 'all:\n\t@true\n' > inner.mk
+	+$(MAKE) --parse-cache=cache -f $(TESTPATH)/parse-cache-submake.mk submake
+	test "$$(ls cache | wc -l)" = 0
+	@echo TEST-PASS
+
+submake: MAKEFLAGS :=
+submake:
+	+$(MAKE) -f inner.mk
@@ -1,6 +1,13 @@
 import pymake.data, pymake.parser, pymake.parserdata, pymake.functions
+import pymake.parsecache, pymake.evaltemplates, pymake.errors
 import unittest
 import logging
+import os, shutil, tempfile, pickle
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 def multitest(cls):
@@ -35,6 +42,36 @@ class DataTest(TestBase):
             self.assertEqual(loc.column, col, "data col offset %i" % pos)
 multitest(DataTest)
 
+class OffsetLocationTest(TestBase):
+    def test_matches_location(self):
+        s = "a = b\n\tfoo \\\n  \tbar\n\nx\ty: z\n"
+        for d in pymake.parser.enumeratelines(s, 'f'):
+            self.assertTrue(isinstance(d.loc, pymake.parserdata.OffsetLocation))
+            eager = pymake.parserdata.Location('f', d.loc.line, d.loc.column)
+            for pos in range(d.lstart, d.lend + 1):
+                loc = d.getloc(pos)
+                expected = eager.offset(s, d.lstart, pos)
+                self.assertEqual((loc.path, loc.line, loc.column),
+                                 (expected.path, expected.line, expected.column))
+                self.assertEqual(str(loc), str(expected))
+
+    def test_released(self):
+        s = "a = b\n\tfoo \\\n  \tbar\n\nx\ty: z\n\t\t\tq\tr"
+        locs = [d.getloc(pos)
+                for d in pymake.parser.enumeratelines(s, 'f', 3)
+                for pos in range(d.lstart, d.lend + 1)]
+        source = locs[0].source
+        self.assertTrue(source.s is None)
+
+        kept = pymake.parserdata.Source('f', s, 3)
+        for loc in locs + [pickle.loads(pickle.dumps(loc)) for loc in locs]:
+            self.assertEqual(loc.source.linecolumn(loc.pos), kept.linecolumn(loc.pos))
+
+        source.shiftlines(10, 2)
+        kept.shiftlines(10, 2)
+        for loc in locs:
+            self.assertEqual(source.linecolumn(loc.pos), kept.linecolumn(loc.pos))
+
 class LineEnumeratorTest(TestBase):
     testdata = {
         'simple': (
@@ -125,14 +162,14 @@ class IterTest(TestBase):
             ),
     }
 
-    def runSingle(self, ifunc, idata, expected):
+    def runSingle(self, mode, idata, expected):
         d = pymake.parser.Data.fromstring(idata, 'IterTest data')
 
-        it = pymake.parser._alltokens.finditer(d.s, 0, d.lend)
-        actual = ''.join( [c for c, t, o, oo in ifunc(d, 0, ('dummy-token',), it)] )
-        self.assertEqual(actual, expected)
+        e, t, o = pymake.parser.parsemakesyntax(d, 0, (), mode)
+        self.assertTrue(e.is_static_string)
+        self.assertEqual(e.s, expected)
 
-        if ifunc == pymake.parser.itermakefilechars:
+        if mode == pymake.parser.itermakefilechars:
             print("testing %r" % expected)
             self.assertEqual(pymake.parser.flattenmakesyntax(d, 0), expected)
 
@@ -201,6 +238,15 @@ class MakeSyntaxTest(TestBase):
                         [{'type': 'VariableRef',
                           '.vname': ['VAL']},
                          ]),
+        'midtoken': ('$$(VAR)', 1, (), None,
+                     [{'type': 'VariableRef',
+                       '.vname': ['VAR']},
+                      ]),
+        'comment': ('FOO $(VAR) \\\\# comment', 0, (), None,
+                    ['FOO ',
+                     {'type': 'VariableRef',
+                      '.vname': ['VAR']},
+                     ' \\']),
         }
 
     def compareRecursive(self, actual, expected, path):
@@ -239,6 +285,12 @@ class MakeSyntaxTest(TestBase):
 
 multitest(MakeSyntaxTest)
 
+class MakeSyntaxErrorTest(TestBase):
+    def test_unterminated(self):
+        d = pymake.parser.Data.fromstring('echo $(subst a,b,c', 'testdata')
+        self.assertRaises(pymake.errors.SyntaxError, pymake.parser.parsemakesyntax,
+                          d, 0, (), pymake.parser.itermakefilechars)
+
 class VariableTest(TestBase):
     testdata = """
     VAR = value
@@ -308,6 +360,447 @@ all:: test test2 $(VAR)
         self.assertEqual(len(irule.prerequisites), 1, "%.o prerequisite count")
         self.assertEqual(irule.targetpatterns[0].match('foo.o'), 'foo', "%.o stem")
 
+class IterParseTest(TestBase):
+    testdata = """
+VAR = value
+ifdef VAR
+all: $(VAR) \\
+  more
+	echo $@
+else
+define MULTI
+line1
+endef
+endif
+"""
+
+    def test_matches_parsestring(self):
+        expected = pymake.parser.parsestring(self.testdata, 'IterParseTest')
+        actual = list(pymake.parser.iterparse(StringIO(self.testdata), 'IterParseTest'))
+        self.assertEqual(len(actual), 2)
+        self.assertEqual(actual, list(expected))
+
+    def test_incremental(self):
+        it = pymake.parser.iterparse(StringIO("VAR = value\nifdef VAR\n"), 'IterParseTest')
+        self.assertTrue(isinstance(next(it), pymake.parserdata.SetVariable))
+        self.assertRaises(pymake.errors.SyntaxError, next, it)
+
+    def test_execute(self):
+        m = pymake.data.Makefile()
+        pymake.parserdata.executestatements(
+            pymake.parser.iterparse(StringIO(self.testdata), 'IterParseTest'), m)
+        self.assertTrue(m.hastarget('all'))
+        self.assertEqual(m.gettarget('all').rules[0].prerequisites, ['value', 'more'])
+
+class LazyConditionsTest(TestBase):
+    testdata = """
+ifdef FOO
+all:
+endif
+\techo command after block
+ifeq ($(BAR),)
+t: ; echo
+\tendif-is-a-command
+define X
+endif
+endef
+else ifdef C
+t2: $(if a:b,c:d) foo
+else
+  ifndef Z
+  v := 1
+  endif
+endif
+"""
+
+    def setUp(self):
+        pymake.parser.setlazyconditions(True)
+
+    def tearDown(self):
+        pymake.parser.setlazyconditions(False)
+
+    def test_matches_eager(self):
+        stmts = pymake.parser.parsestring(self.testdata, 'LazyConditionsTest')
+        self.assertTrue(isinstance(stmts[0]._groups[0][1], pymake.parserdata.UnparsedStatements))
+
+        pymake.parser.setlazyconditions(False)
+        expected = pymake.parser.parsestring(self.testdata, 'LazyConditionsTest')
+        self.assertEqual(list(stmts), list(expected))
+
+    def test_execute(self):
+        stmts = pymake.parser.parsestring(self.testdata, 'LazyConditionsTest')
+        m = pymake.data.Makefile()
+        m.variables.set('FOO', pymake.data.Variables.FLAVOR_SIMPLE,
+                        pymake.data.Variables.SOURCE_COMMANDLINE, '1')
+        stmts.execute(m)
+        self.assertEqual(len(m.gettarget('all').rules[0].commands), 1)
+        self.assertTrue(m.hastarget('t'))
+        self.assertFalse(m.hastarget('t2'))
+        self.assertEqual(len(m.gettarget('t').rules[0].commands), 2)
+        self.assertTrue(isinstance(stmts[2]._groups[1][1], pymake.parserdata.UnparsedStatements))
+
+    def test_structure_errors(self):
+        for s in ("ifdef A\nifdef B\nendif\n",
+                  "ifdef A\nendef\nendif\n",
+                  "ifdef A\nelse\nelse\nendif\n",
+                  "ifdef A\ndefine B\nendif\n"):
+            self.assertRaises(pymake.errors.SyntaxError, pymake.parser.parsestring, s, 'LazyConditionsTest')
+
+    def test_unused_branch_errors(self):
+        stmts = pymake.parser.parsestring("ifdef A\nall: | order-only\nendif\n", 'LazyConditionsTest')
+        stmts.execute(pymake.data.Makefile())
+
+class FoldingTest(TestBase):
+    testdata = ("OBJS := $(addprefix obj/,$(patsubst %.c,%.o,$(sort b.c a.c)))\n"
+                "X := $(subst a,b,$(Y)) $(words $(strip  a  b ))\n"
+                "all: $(if $(filter a,a b),yes,no)\n"
+                "\techo $(word x,a b)\n")
+
+    def setUp(self):
+        pymake.parser.setfolding(True)
+
+    def tearDown(self):
+        pymake.parser.setfolding(False)
+
+    def test_fold(self):
+        stmts = pymake.parser.parsestring(self.testdata, 'FoldingTest')
+        self.assertTrue(stmts[0].getvalueexp().is_static_string)
+        self.assertEqual(stmts[0].getvalueexp().s, 'obj/a.o obj/b.o')
+
+        funcs = list(stmts[1].getvalueexp().functions())
+        self.assertEqual([type(f) for f in funcs], [pymake.functions.SubstFunction])
+        self.assertEqual(stmts[1].getvalueexp().to_source(), '$(subst a,b,$(Y)) 2')
+        self.assertEqual(stmts[2].depexp.to_source(), ' yes')
+
+        # Errors are left to be reported when the function is used.
+        self.assertEqual(stmts[3].exp.to_source(), 'echo $(word x,a b)')
+
+    def test_execute(self):
+        def execute():
+            m = pymake.data.Makefile()
+            pymake.parser.parsestring(self.testdata, 'FoldingTest').execute(m)
+            return [m.variables.get(v)[2].resolvestr(m, m.variables) for v in ('OBJS', 'X')]
+
+        folded = execute()
+        pymake.parser.setfolding(False)
+        self.assertEqual(folded, execute())
+
+class DepfileTest(TestBase):
+    testdata = ("./foo.o: foo.c \\\n"
+                "  foo.h \\  \n"
+                "  bar.h\n"
+                "\n"
+                "bar.o: $(OBJDIR)/bar.c\n"
+                "foo.h:\n"
+                "bar.h:\n"
+                "baz.o: foo.c foo.h bar.h \\")
+
+    def setUp(self):
+        fdno, self.path = tempfile.mkstemp(suffix='.pp')
+        fd = os.fdopen(fdno, 'w')
+        fd.write(self.testdata)
+        fd.close()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_parse(self):
+        stmts = pymake.parser.parsedepfile(self.path)
+        self.assertEqual([type(s).__name__ for s in stmts],
+                         ['Dependencies', 'Rule', 'Dependencies', 'Dependencies', 'Dependencies'])
+        self.assertEqual(stmts[0].targets, ['foo.o'])
+        self.assertEqual(stmts[0].prerequisites, ['foo.c', 'foo.h', 'bar.h'])
+        self.assertEqual(stmts[2].prerequisites, [])
+        self.assertTrue(stmts[2].prerequisites is stmts[3].prerequisites)
+
+    def test_execute(self):
+        m = pymake.data.Makefile()
+        m.variables.set('OBJDIR', pymake.data.Variables.FLAVOR_SIMPLE,
+                        pymake.data.Variables.SOURCE_MAKEFILE, 'obj')
+        pymake.parser.parsedepfile(self.path).execute(m, weak=True)
+
+        self.assertEqual(m.gettarget('foo.o').rules[0].prerequisites, ['foo.c', 'foo.h', 'bar.h'])
+        self.assertTrue(m.gettarget('foo.o').rules[0].weakdeps)
+        self.assertEqual(m.gettarget('bar.o').rules[0].prerequisites, ['obj/bar.c'])
+        self.assertEqual(m.gettarget('baz.o').rules[0].prerequisites, ['foo.c', 'foo.h', 'bar.h'])
+        self.assertFalse(m.hastarget('foo.h'))
+
+class ValueExpansionTest(TestBase):
+    testdata = ("X := $(Y) x\n"
+                "A = $(X) a\n"
+                "A += $(Y)\n"
+                "Y = y\n")
+
+    def test_parsed_once(self):
+        stmts = pymake.parser.parsestring(self.testdata, 'ValueExpansionTest')
+        self.assertTrue(stmts[0]._valueexp is None)
+        self.assertTrue(stmts[1]._valueexp is None)
+
+        valueexp = None
+        for i in range(0, 2):
+            m = pymake.data.Makefile()
+            stmts.execute(m)
+            if valueexp is None:
+                valueexp = stmts[0]._valueexp
+            self.assertTrue(valueexp is not None and stmts[0]._valueexp is valueexp)
+            self.assertEqual(m.variables.get('X')[2].resolvestr(m, m.variables), ' x')
+            self.assertEqual(m.variables.get('A')[2].resolvestr(m, m.variables), ' x a y')
+            self.assertTrue(m.variables.get('Y')[2] is stmts[3]._valueexp)
+
+class EvalCacheTest(TestBase):
+    def test_reuse(self):
+        cache = pymake.parser.evalcache
+        hits, misses = cache.hits, cache.misses
+
+        s1 = pymake.parser.parseeval('A = 1', 'EvalCacheTest')
+        self.assertTrue(pymake.parser.parseeval('A = 1', 'EvalCacheTest') is s1)
+        self.assertFalse(pymake.parser.parseeval('A = 1', 'elsewhere') is s1)
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 2))
+
+class EvalTemplateTest(TestBase):
+    testdata = """
+define PROG
+$(1)_OBJS := $$(patsubst %.c,%.o,$$($(1)_SRCS))
+ALL += $(1)
+ifeq ($(1),bar)
+IS_BAR := yes
+endif
+$(1): $$($(1)_OBJS)
+\t$(CC) -o $$@ $$^ $(2)
+endef
+CC = cc
+foo_SRCS = a.c b.c
+bar_SRCS = c.c
+$(foreach x,foo bar export a+b,$(eval $(call PROG,$(x),-O$(words $(ALL) x))))
+"""
+
+    def tearDown(self):
+        pymake.evaltemplates.setenabled(False)
+
+    def execute(self):
+        m = pymake.data.Makefile()
+        pymake.parser.parsestring(self.testdata, 'EvalTemplateTest').execute(m)
+
+        values = {}
+        for name in ('ALL', 'IS_BAR', 'foo_OBJS', 'bar_OBJS', 'export_OBJS'):
+            flavor, source, value = m.variables.get(name)
+            values[name] = value.resolvestr(m, m.variables)
+
+        rules = {}
+        for t in ('foo', 'bar', 'export', 'a+b'):
+            r = m.gettarget(t).rules[0]
+            rules[t] = ([p for p in r.prerequisites],
+                        [c.resolvestr(m, m.variables) for c in r.commands])
+        return values, rules
+
+    def test_matches_eval(self):
+        expected = self.execute()
+        self.assertEqual(expected[0]['ALL'], 'foo bar export a+b')
+
+        pymake.evaltemplates.setenabled(True)
+        hits = pymake.evaltemplates._templates.hits
+        self.assertEqual(self.execute(), expected)
+        self.assertEqual(pymake.evaltemplates._templates.hits - hits, 3)
+
+class ParseCacheTest(TestBase):
+    testdata = """
+VAR = $(subst a,b,aaa)
+ifdef VAR
+all: $(VAR)
+	echo $@
+endif
+"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.makefile = os.path.join(self.tempdir, 'Makefile')
+        self.write(self.testdata)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, s):
+        fd = open(self.makefile, 'w')
+        fd.write(s)
+        fd.close()
+
+    def parse(self, cache):
+        fd = open(self.makefile)
+        st = os.fstat(fd.fileno())
+        fd.close()
+
+        stmts = cache.load(self.makefile, st)
+        if stmts is None:
+            stmts = pymake.parser.parsestring(open(self.makefile).read(), self.makefile)
+            cache.store(self.makefile, st, stmts)
+        return stmts
+
+    def test_roundtrip(self):
+        cache = pymake.parsecache.ParseCache(self.cachedir)
+        stmts = self.parse(cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # A different process would have a different cache object.
+        cache = pymake.parsecache.ParseCache(self.cachedir)
+        cached = self.parse(cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(cached.to_source(), stmts.to_source())
+        self.assertTrue(cached == stmts)
+
+    def test_stale(self):
+        cache = pymake.parsecache.ParseCache(self.cachedir)
+        self.parse(cache)
+        self.write(self.testdata + "\nFOO = bar\n")
+        os.utime(self.makefile, (0, 0))
+        stmts = self.parse(cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(len(stmts), 3)
+
+    def test_corrupt(self):
+        cache = pymake.parsecache.ParseCache(self.cachedir)
+        self.parse(cache)
+        for name in os.listdir(self.cachedir):
+            fd = open(os.path.join(self.cachedir, name), 'wb')
+            fd.write(b'garbage')
+            fd.close()
+
+        stmts = self.parse(cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(len(stmts), 2)
+
+        self.parse(cache)
+        self.assertEqual(cache.hits, 1)
+
+    def test_evict(self):
+        cache = pymake.parsecache.ParseCache(self.cachedir, maxsize=1)
+        self.parse(cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+class ReparseTest(TestBase):
+    testdata = ["A = 1",
+                "all: foo",
+                "\techo $@ \\",
+                "  continued",
+                "ifdef A",
+                "B = 2",
+                "endif",
+                "define C",
+                "endif",
+                "endef",
+                "D = 4"]
+
+    # (start, end, replacement lines), applied in turn
+    edits = [
+        (5, 6, ["B = 3", "E = 5"]),
+        (3, 4, ["  continued", "\techo more"]),
+        (8, 8, ["else", "B = 0"]),
+        (12, 13, ["ifdef Q"]),
+        (0, 0, ["Z = 0", "", "# comment"]),
+        (18, 18, ["F = 6 \\"]),
+        (19, 19, ["G = 7"]),
+    ]
+
+    def setUp(self):
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+        self.makefile = os.path.join(self.tempdir, 'Makefile')
+        self.mtime = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, lines):
+        fd = open(self.makefile, 'w')
+        fd.write('\n'.join(lines))
+        fd.close()
+        self.mtime += 1
+        os.utime(self.makefile, (self.mtime, self.mtime))
+
+    def test_matches_parsestring(self):
+        lines = list(self.testdata)
+        self.write(lines)
+        stmts = pymake.parser.parsefile(self.makefile)
+
+        for start, end, replacement in self.edits:
+            lines[start:end] = replacement
+            self.write(lines)
+            expected = pymake.parser.parsestring('\n'.join(lines), self.makefile)
+
+            reparsed = pymake.parser.parsefile(self.makefile)
+            self.assertEqual(str(reparsed), str(expected))
+
+            # Statements before the edit are reused.
+            if start > 1:
+                self.assertTrue(reparsed[0] is stmts[0])
+            stmts = reparsed
+
+    def test_lazy_branch_lines(self):
+        pymake.parser.setlazyconditions(True)
+        try:
+            self.write(["A = 1", "ifdef A", "B = 2", "endif", ""])
+            stmts = pymake.parser.parsefile(self.makefile)
+            cond, branch = stmts[1][0]
+            self.assertEqual(branch[0].valueloc.line, 3)
+
+            self.write(["Z = 0", "A = 1", "ifdef A", "B = 2", "endif", ""])
+            reparsed = pymake.parser.parsefile(self.makefile)
+            self.assertTrue(reparsed[2] is stmts[1])
+
+            # The branch parsed before the edit follows its lines, like one parsed afterwards.
+            expected = pymake.parser.parsestring(open(self.makefile).read(), self.makefile)
+            self.assertEqual(str(branch[0].valueloc), str(expected[2][0][1][0].valueloc))
+            self.assertEqual(branch[0].valueloc.line, 4)
+        finally:
+            pymake.parser.setlazyconditions(False)
+
+class PrefetchTest(TestBase):
+    files = {
+        'Makefile': "include a.mk\n-include $(NOTSTATIC).mk\nall:\n\t$(MAKE) -C sub\n",
+        'a.mk': "A = a\ninclude b.mk\n",
+        'b.mk': "B = b\n",
+    }
+
+    def setUp(self):
+        self.tempdir = os.path.realpath(tempfile.mkdtemp())
+        for name, s in self.files.items():
+            fd = open(os.path.join(self.tempdir, name), 'w')
+            fd.write(s)
+            fd.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_paths(self):
+        stmts = pymake.parser.parsefile(os.path.join(self.tempdir, 'Makefile'))
+        paths = list(pymake.parser._iterprefetchpaths(stmts, self.tempdir))
+        self.assertEqual(paths, [(os.path.join(self.tempdir, 'a.mk'), False),
+                                 (os.path.join(self.tempdir, 'sub', 'Makefile'), True)])
+
+    def test_prefetch(self):
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=2)
+        try:
+            stmts = pymake.parser.parsefile(os.path.join(self.tempdir, 'Makefile'))
+            pymake.parser.prefetch(stmts, self.tempdir, pool)
+
+            a = os.path.join(self.tempdir, 'a.mk')
+            b = os.path.join(self.tempdir, 'b.mk')
+            self.assertTrue(a in pymake.parser._prefetched)
+            stmts = pymake.parser.parsefile(a)
+            self.assertFalse(a in pymake.parser._prefetched)
+            self.assertEqual(stmts.to_source(), "A = a\ninclude b.mk")
+
+            # Includes of prefetched files are prefetched when those files are used.
+            self.assertFalse(b in pymake.parser._prefetched)
+            pymake.parser.prefetch(stmts, self.tempdir, pool)
+            self.assertTrue(b in pymake.parser._prefetched)
+            self.assertEqual(pymake.parser.parsefile(b).to_source(), "B = b")
+            self.assertFalse(b in pymake.parser._prefetched)
+        finally:
+            pool.close()
+            pool.join()
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
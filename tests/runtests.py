@@ -14,6 +14,11 @@ The test file may contain lines at the beginning to alter the default behavior.
 #T returncode-on: {'win32': 2}
 #T environment: {'VAR': 'VALUE}
 #T grep-for: "text"
+#T exact-makeflags
+
+Optional pymake features can be checked against the whole suite by passing them to pymake with
+-p, e.g. `runtests.py -p --freeze-variables`. They are added to MAKEFLAGS, so tests marked with
+exact-makeflags, which check its value, are skipped for pymake then.
 """
 from __future__ import print_function
 
@@ -45,8 +50,12 @@ o.add_option('-g', '--gmake',
              dest="gmake", default="gmake")
 o.add_option('-d', '--tempdir',
              dest="tempdir", default="_mktests")
+o.add_option('-p', '--pymake-flag', action="append",
+             dest="pymakeflags", default=[])
 opts, args = o.parse_args()
 
+pymake += opts.pymakeflags
+
 if len(args) == 0:
     args = [thisdir]
 
@@ -118,6 +127,7 @@ for makefile in makefiles:
         'commandline': cline,
         'pass': True,
         'skip': False,
+        'exactmakeflags': False,
         }
 
     gmakeoptions = ParentDict(options)
@@ -153,6 +163,8 @@ for makefile in makefiles:
             d['pass'] = False
         elif key == 'skip':
             d['skip'] = True
+        elif key == 'exact-makeflags':
+            d['exactmakeflags'] = True
         else:
             print("%s: Unexpected #T key: %s" % (makefile, key), file=sys.stderr)
             sys.exit(1)
@@ -177,6 +189,8 @@ for makefile in makefiles:
 
     if pymakeoptions['skip']:
         pymakepass, pymakemsg = True, ''
+    elif pymakeoptions['exactmakeflags'] and len(opts.pymakeflags):
+        pymakepass, pymakemsg = True, 'SKIP (exact-makeflags)'
     else:
         pymakepass, pymakemsg = runTest(makefile, pymake,
                                         makefile + '.pymakelog', pymakeoptions)
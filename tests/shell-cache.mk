@@ -0,0 +1,20 @@
+#T gmake skip
+#T commandline: ['--shell-cache']
+
+# Only the results of commands marked as cacheable are reused.
+N := $(shell ls)
+
+.SHELL_CACHE_KEY = probe
+P := $(shell ls)
+.SHELL_CACHE_KEY =
+
+all: gen marked
+	test "$(shell ls)" = "newfile"
+	@echo TEST-PASS
+
+gen:
+	touch newfile
+
+marked: .SHELL_CACHE_KEY = probe
+marked: gen
+	test "$(shell ls)" = ""